@@ -0,0 +1,88 @@
+# compares the extent allocator with the original linear bitarray scan
+# usage: python bench_allocator.py [number_of_blocks]
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from settings import BLOCK_SIZE, FREE_START
+from allocator import Allocator, to_runs, to_blocks
+from bitarray import bitarray
+
+# the allocator FileSystem used before, one scan from block 0 per requested block
+class LinearAllocator:
+    def __init__(self, free: bitarray):
+        self.free = free
+
+    def allocate_blocks(self, n: int) -> list[int]:
+        blocks = []
+        for _ in range(n):
+            for i, space in enumerate(self.free):
+                if space:
+                    self.free[i] = False
+                    blocks.append((i + FREE_START // BLOCK_SIZE) * BLOCK_SIZE)
+                    break
+            else:
+                raise MemoryError("No free spaces available.")
+        return blocks
+
+    def free_blocks(self, blocks: list[int]):
+        for block in blocks:
+            self.free[(block - FREE_START) // BLOCK_SIZE] = True
+
+class ExtentAllocator(Allocator):
+    def allocate_blocks(self, n: int) -> list[int]:
+        return to_blocks(self.allocate_extent(n))
+
+def new_bitmap(n: int) -> bitarray:
+    free = bitarray(n)
+    free.setall(True)
+    return free
+
+# allocates files of random sizes until the disk is 75% full
+def fill(allocator, n: int, rng: random.Random) -> list:
+    files = []
+    used = 0
+    while used < n * 0.75:
+        size = rng.randint(1, 64)
+        files.append(allocator.allocate_blocks(size))
+        used += size
+    return files
+
+# deletes and recreates random files, this is what fragments the disk
+def churn(allocator, files: list, rounds: int, rng: random.Random):
+    for _ in range(rounds):
+        i = rng.randrange(len(files))
+        allocator.free_blocks(files[i])
+        files[i] = allocator.allocate_blocks(min(rng.randint(1, 64), allocator.free.count(True)))
+
+def report(name: str, allocator, files: list, fill_time: float, churn_time: float):
+    runs_per_file = sum(len(to_runs(blocks)) for blocks in files) / len(files)
+    free_runs = to_runs([FREE_START + i * BLOCK_SIZE for i in allocator.free.search(1)])
+    largest = max((count for _, count in free_runs), default=0)
+    print(f"{name:<8}{fill_time:>10.3f}{churn_time:>10.3f}{runs_per_file:>14.2f}{len(free_runs):>12}{largest:>14}")
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 8192
+    rounds = n // 8
+    print(f"{n} blocks, {rounds} churn rounds")
+    print(f"{'':<8}{'fill s':>10}{'churn s':>10}{'runs/file':>14}{'free runs':>12}{'largest free':>14}")
+
+    for name, cls in (('linear', LinearAllocator), ('extent', ExtentAllocator)):
+        rng = random.Random(0)
+        allocator = cls(new_bitmap(n))
+
+        start = time.perf_counter()
+        files = fill(allocator, n, rng)
+        fill_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        churn(allocator, files, rounds, rng)
+        churn_time = time.perf_counter() - start
+
+        report(name, allocator, files, fill_time, churn_time)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# time and blocks taken by clone_file() compared with copying a file by reading and writing it,
+# and blocks taken by many files made from one template with and without dedup
+# usage: python bench_dedup.py [megabytes ...]
+import os
+import sys
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from dedup import ContentIndex
+from nodes import File
+from bench_metadata import timed
+
+BLOCK_SIZE = 4096
+MB = 2**20
+TEMPLATE_FILES = 200
+TEMPLATE_BLOCKS = 16    # each file is the template with its first block changed
+
+def open_disk(megabytes: int) -> FileSystem:
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    FileSystem.format(path, (megabytes + 1) * MB, BLOCK_SIZE, 64 * BLOCK_SIZE, 16 * BLOCK_SIZE)
+    return FileSystem(path)
+
+def close_disk(fs: FileSystem):
+    path = fs.disk.file.name
+    fs.unmount()
+    os.remove(path)
+
+def clone(megabytes: int):
+    fs = open_disk(3 * megabytes)
+    fs.create('/source').write_to_file(random.Random(0).randbytes(megabytes * MB), 0)
+    used = fs.sharing()[0]
+    _, copy_time = timed(lambda: fs.create('/copy').write_to_file(fs.search_path('/source', File).read_from_file(), 0))
+    copy_blocks = fs.sharing()[0] - used
+    used = fs.sharing()[0]
+    _, clone_time = timed(lambda: fs.clone_file('/source', '/clone'))
+    clone_blocks = fs.sharing()[0] - used
+    _, write_time = timed(lambda: fs.search_path('/clone', File).write_to_file(b'x', MB))  # copies one block
+    close_disk(fs)
+    print(f"{megabytes:>6}{copy_time:>10.3f}{copy_blocks:>10}{clone_time:>10.4f}{clone_blocks:>10}{write_time:>14.4f}")
+
+def template(dedup: bool):
+    fs = open_disk(2 * TEMPLATE_FILES * TEMPLATE_BLOCKS * BLOCK_SIZE // MB + 1)
+    if dedup:
+        fs.dedup = ContentIndex(fs.block_size)
+    body = random.Random(0).randbytes((TEMPLATE_BLOCKS - 1) * BLOCK_SIZE)
+
+    def write():
+        for i in range(TEMPLATE_FILES):
+            fs.create(f'/file{i}').write_to_file(f"{i}".encode().ljust(BLOCK_SIZE, b'.') + body, 0)
+    _, seconds = timed(write)
+    used, referenced = fs.sharing()
+    close_disk(fs)
+    print(f"{'on' if dedup else 'off':>6}{seconds:>10.3f}{used:>10}{referenced:>12}{referenced / used:>8.2f}")
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [16, 64]
+    print(f"{'MB':>6}{'copy s':>10}{'blocks':>10}{'clone s':>10}{'blocks':>10}{'write 1 s':>14}")
+    for megabytes in sizes:
+        clone(megabytes)
+    print(f"\n{TEMPLATE_FILES} files of {TEMPLATE_BLOCKS} blocks that differ in their first block")
+    print(f"{'dedup':>6}{'write s':>10}{'blocks':>10}{'file blocks':>12}{'ratio':>8}")
+    for dedup in (False, True):
+        template(dedup)
+
+if __name__ == "__main__":
+    main()
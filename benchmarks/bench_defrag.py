@@ -0,0 +1,53 @@
+# fragmentation and the time to read every file back from a freshly opened disk, before and after defragmenting it
+# the files are written by appending a block to each in turn, so their blocks are interleaved across the disk
+# usage: python bench_defrag.py [files ...]
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from defrag import Defragmenter, fragmentation
+from bench_metadata import timed
+
+BLOCK_SIZE = 4096
+BLOCKS_PER_FILE = 64
+
+def read_all(path: str) -> float:
+    fs = FileSystem(path)
+    _, seconds = timed(lambda: [file.read_from_file(0, file.size) for file in fs.walk_files()])
+    fs.unmount()
+    return seconds
+
+def run(files: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    metadata = (files // 16 + 64) * BLOCK_SIZE
+    FileSystem.format(path, metadata + 2 * files * BLOCKS_PER_FILE * BLOCK_SIZE, BLOCK_SIZE, metadata, metadata // 4)
+    fs = FileSystem(path)
+    block = b'x' * BLOCK_SIZE
+    nodes = [fs.create(f'/file{i}') for i in range(files)]
+    with fs.guard():
+        for _ in range(BLOCKS_PER_FILE):
+            for file in nodes:
+                file.write_to_file(block, file.size)
+    before = fragmentation(fs)
+    fs.unmount()
+    read_before = read_all(path)
+
+    fs = FileSystem(path)
+    moved, defrag_time = timed(lambda: Defragmenter(fs).run())
+    after = fragmentation(fs)
+    fs.unmount()
+    read_after = read_all(path)
+    os.remove(path)
+    print(f"{files:>8}{before:>10.3f}{read_before:>10.2f}{moved:>10}{defrag_time:>11.2f}{after:>10.3f}{read_after:>10.2f}")
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 500]
+    print(f"{'files':>8}{'before':>10}{'read s':>10}{'moved':>10}{'defrag s':>11}{'after':>10}{'read s':>10}")
+    for files in sizes:
+        run(files)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# time and peak memory of reads with the file and the mmap disk backends, with the block cache on and off
+# a file in one extent is read at once and in small pieces at random positions, reads of the mmap backend
+# return views of the mapping so their peak should stay near zero, reads larger than the cache go around it
+# usage: python bench_disk.py [megabytes ...]
+import os
+import sys
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from settings import CACHE_BLOCKS
+from bench_stream import peak, BLOCK_SIZE, MB
+from bench_metadata import timed
+
+PIECE = 1000    # bytes per small read
+PIECES = 20_000
+
+def run(megabytes: int, backend: str, cache_blocks: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    FileSystem.format(path, (megabytes + 1) * MB, BLOCK_SIZE, 64 * BLOCK_SIZE, 16 * BLOCK_SIZE)
+    fs = FileSystem(path)
+    fs.create('/big').write_to_file(b'x' * (megabytes * MB), 0)
+    fs.unmount()
+
+    fs = FileSystem(path, backend)
+    fs.cache.size = cache_blocks
+    file = fs.open('/big', 'r')
+    rng = random.Random(0)
+    positions = [rng.randrange(megabytes * MB - PIECE) for _ in range(PIECES)]
+    whole = lambda: len(file.read_from_file())
+    pieces = lambda: sum(len(file.read_from_file(at, PIECE)) for at in positions)
+    # tracing slows down every allocation, so the reads are timed without it and run again for their peak
+    whole_time, pieces_time = timed(whole)[1], timed(pieces)[1]
+    whole_peak, pieces_peak = peak(whole)[2], peak(pieces)[2]
+    fs.close(file)
+    fs.unmount()
+    os.remove(path)
+    print(f"{backend:>8}{cache_blocks:>8}{whole_time:>10.3f}{whole_peak:>10.1f}{pieces_time:>10.3f}{pieces_peak * 1024:>10.0f}")
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [64]
+    for megabytes in sizes:
+        print(f"{megabytes} MB file, {PIECES} reads of {PIECE} bytes")
+        print(f"{'backend':>8}{'cache':>8}{'read s':>10}{'peak MB':>10}{'pieces s':>10}{'peak KB':>10}")
+        for backend in ('file', 'mmap'):
+            for cache_blocks in (0, CACHE_BLOCKS):
+                run(megabytes, backend, cache_blocks)
+
+if __name__ == "__main__":
+    main()
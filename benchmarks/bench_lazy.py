@@ -0,0 +1,46 @@
+# time and memory to open a saved disk and list one directory, compared with reading the whole tree
+# directories are read from the disk when first used, so opening should not depend on the size of the tree
+# usage: python bench_lazy.py [entries ...]
+import os
+import sys
+import gc
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from nodes import Directory
+from bench_metadata import open_disk, build_tree, timed
+
+# saves a generated tree of entries nodes and returns the path of the disk
+def make_disk(entries: int) -> str:
+    fs = open_disk(entries)
+    fs.root = build_tree(fs, entries)
+    fs.save()
+    path = fs.disk.file.name
+    fs.unmount()
+    return path
+
+def run(entries: int):
+    path = make_disk(entries)
+    gc.collect()
+
+    tracemalloc.start()
+    fs, open_time = timed(lambda: FileSystem(path))
+    _, ls_time = timed(lambda: fs.root.get('dir0', Directory).children)
+    used = tracemalloc.get_traced_memory()[0]
+    _, walk_time = timed(lambda: sum(1 for file in fs.walk_files()))
+    loaded = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    fs.unmount()
+    os.remove(path)
+    print(f"{entries:>10}{open_time:>10.3f}{ls_time:>10.3f}{used / 2**20:>10.1f}{walk_time:>12.3f}{loaded / 2**20:>12.1f}")
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    print(f"{'entries':>10}{'open s':>10}{'ls s':>10}{'MB':>10}{'read all s':>12}{'all MB':>12}")
+    for entries in sizes:
+        run(entries)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# compares the inode format of checkpoints with pickling the tree, as checkpoints were stored before
+# usage: python bench_metadata.py [entries ...]
+import os
+import sys
+import gc
+import time
+import pickle
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from nodes import Directory, File
+from inodes import Image
+
+BLOCK_SIZE = 512
+FILES_PER_DIR = 50
+
+# a disk with room for the blocks of the generated files and a slot large enough for their tree,
+# only what is written takes space as the file stays sparse
+def open_disk(entries: int) -> FileSystem:
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    metadata = (200 * entries // BLOCK_SIZE + 64) * BLOCK_SIZE
+    FileSystem.format(path, metadata + 4 * entries * BLOCK_SIZE, BLOCK_SIZE, metadata, metadata // 4)
+    return FileSystem(path)
+
+# directories of FILES_PER_DIR files, every file has two extents
+def build_tree(fs: FileSystem, entries: int) -> Directory:
+    root = Directory('/')
+    dir = None
+    for i in range(entries):
+        if i % (FILES_PER_DIR + 1) == 0:
+            dir = Directory(f"dir{i}")
+            root.add(dir)
+            continue
+        file = File(f"file{i}.txt", fs)
+        start = fs.sb.free_start + 4 * i * BLOCK_SIZE
+        file.blocks.append([(start, 2), (start + 3 * BLOCK_SIZE, 1)])
+        file.size = 3 * BLOCK_SIZE - 100
+        dir.add(file)
+    return root
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+def run(entries: int):
+    fs = open_disk(entries)
+    root = build_tree(fs, entries)
+    free = fs.allocator.free
+
+    (encoded, head), encode_time = timed(lambda: fs.image.encode(root, free, 0))
+    pickled, pickle_time = timed(lambda: pickle.dumps({'free': free, 'root': root, 'seq': 0}))
+    fs.slots.write(encoded, head)
+    root = None     # the built tree is freed before it is read back
+    gc.collect()
+
+    def decode():   # directories are read when first used, read all of them to compare with unpickling
+        root = Image(fs).open(encoded[:head], fs.slots.base)[0]
+        for file in fs.walk_files(root):
+            pass
+    _, decode_time = timed(decode)
+    gc.collect()
+
+    def unpickle():
+        metadata = pickle.loads(pickled)
+        fs.set_fs(metadata['root'])     # loading a pickled tree also had to reconnect files to the file system
+        return metadata
+    _, unpickle_time = timed(unpickle)
+    gc.collect()
+
+    fs.unmount()
+    print(f"{entries:>10} {'pickle':<8}{len(pickled):>14}{pickle_time:>12.3f}{unpickle_time:>12.3f}")
+    print(f"{'':>10} {'inodes':<8}{len(encoded):>14}{encode_time:>12.3f}{decode_time:>12.3f}")
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 1_000_000]
+    print(f"{'entries':>10} {'format':<8}{'bytes':>14}{'save s':>12}{'load s':>12}")
+    for entries in sizes:
+        run(entries)
+
+if __name__ == "__main__":
+    main()
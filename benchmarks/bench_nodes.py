@@ -0,0 +1,122 @@
+# memory taken by the nodes of the directory tree, per node, with the slotted nodes and with nodes laid out as
+# before they had slots: an instance dict each and a lock created with the node
+# usage: python bench_nodes.py [entries ...]
+import os
+import sys
+import gc
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from blockmap import BlockMap
+from bench_metadata import open_disk, build_tree, BLOCK_SIZE, FILES_PER_DIR
+
+# the fields of RWLock before it had slots, its read side left the grown reader dict behind
+class DictLock:
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers: dict[int, int] = {}
+        self.writer: int = None
+        self.writes = 0
+        self.waiting = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self.cond:
+            self.readers[me] = self.readers.get(me, 0) + 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                del self.readers[me]
+
+# the fields of a BlockMap in an instance dict, the extent arrays are the ones of the map
+class DictBlockMap:
+    def __init__(self, blocks: BlockMap):
+        for name in BlockMap.__slots__:
+            setattr(self, name, getattr(blocks, name))
+
+class DictNode:
+    def __init__(self, name):
+        self.name = name
+        self.parent = None
+        self.lock = DictLock()
+
+class DictDirectory(DictNode):
+    def __init__(self, name):
+        super().__init__(name)
+        self.entries = {}
+        self.number = None
+        self.image = None
+        self.used = True
+
+    def add(self, node: DictNode):
+        self.entries[(type(node), node.name)] = node
+        node.parent = self
+
+class DictFile(DictNode):
+    def __init__(self, name, fs):
+        super().__init__(name)
+        self.size = 0
+        self.blocks = None
+        self.fs = fs
+
+# the same tree as build_tree() out of the dict nodes
+def build_dict_tree(fs, entries: int) -> DictDirectory:
+    root = DictDirectory('/')
+    dir = None
+    for i in range(entries):
+        if i % (FILES_PER_DIR + 1) == 0:
+            dir = DictDirectory(f"dir{i}")
+            root.add(dir)
+            continue
+        file = DictFile(f"file{i}.txt", fs)
+        start = fs.sb.free_start + 4 * i * BLOCK_SIZE
+        blocks = BlockMap(BLOCK_SIZE)
+        blocks.append([(start, 2), (start + 3 * BLOCK_SIZE, 1)])
+        file.blocks = DictBlockMap(blocks)
+        file.size = 3 * BLOCK_SIZE - 100
+        dir.add(file)
+    return root
+
+# returns bytes per node once the tree is built and once every node was locked
+def measure(build, entries: int) -> tuple[float, float]:
+    fs = open_disk(entries)
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    root = build(fs, entries)
+    built = tracemalloc.get_traced_memory()[0]
+
+    # every node locked once, as after a run that touched the whole tree
+    nodes = [root]
+    for node in nodes:
+        with node.lock.read():
+            pass
+        if hasattr(node, 'entries'):
+            nodes.extend(node.entries.values())
+    del nodes
+    gc.collect()
+    locked = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del root
+    fs.unmount()
+    return (built - start) / entries, (locked - start) / entries
+
+def run(entries: int):
+    before, before_locked = measure(build_dict_tree, entries)
+    after, after_locked = measure(build_tree, entries)
+    print(f"{entries:>10}{before:>10.0f}{before_locked:>10.0f}{after:>10.0f}{after_locked:>10.0f}")
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    print("bytes per node, dict nodes before slots and slotted nodes, as built and once every node was locked")
+    print(f"{'entries':>10}{'before':>10}{'locked':>10}{'after':>10}{'locked':>10}")
+    for entries in sizes:
+        run(entries)
+
+if __name__ == "__main__":
+    main()
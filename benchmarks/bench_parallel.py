@@ -0,0 +1,58 @@
+# writes per second and flushes of the disk when every thread writes its own file, each write followed by its journal
+# record, the records of threads that write at the same time are written together after one flush (group commit)
+# latency adds that many milliseconds to every flush, like a disk slower to sync than the one the benchmark runs on
+# usage: python bench_parallel.py [writes_per_thread] [latency_ms]
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+
+BLOCK_SIZE = 4096
+
+def run(threads: int, writes: int, latency: float) -> tuple[float, int]:
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    FileSystem.format(path, 64 * 1024 * 1024, BLOCK_SIZE, 256 * BLOCK_SIZE, 64 * BLOCK_SIZE)
+    fs = FileSystem(path)
+    files = [fs.create(f'/file{i}') for i in range(threads)]
+
+    flushes = 0
+    flush = fs.disk.flush
+
+    def slow_flush():
+        nonlocal flushes
+        flushes += 1
+        time.sleep(latency / 1000)
+        flush()
+    fs.disk.flush = slow_flush
+
+    def work(file):
+        for i in range(writes):
+            file.write_to_file(b'x' * 200, i * 200)
+    workers = [threading.Thread(target=work, args=(file,)) for file in files]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    fs.unmount()
+    os.remove(path)
+    return elapsed, flushes
+
+def main():
+    writes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    print(f"{writes} writes per thread, {latency} ms added to every flush")
+    print(f"{'threads':>8}{'seconds':>10}{'writes/s':>10}{'flushes':>10}")
+    for threads in (1, 2, 4, 8):
+        elapsed, flushes = run(threads, writes, latency)
+        print(f"{threads:>8}{elapsed:>10.3f}{threads * writes / elapsed:>10.0f}{flushes:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# compares running the input_thread<x>.txt scripts on threads command by command with running them from worker
+# processes, which do their own data I/O against the disk file, and with running every script as one transaction on
+# threads, which logs its changes once at the end
+# the stress scripts of stress.py mostly change the tree, the data scripts write and read back data_kb KB at a time
+# usage: python bench_runner.py [threads] [commands_per_thread] [data_kb]
+import os
+import sys
+import time
+import random
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from stress import make_script
+import main as runner
+import processes
+
+# count writes of size bytes to four files of the thread, each read back
+def data_script(thread_id: int, count: int, size: int) -> list[str]:
+    commands = [f"mkdir /t{thread_id}", f"chdir /t{thread_id}"]
+    for i in range(count):
+        path = f"f{i % 4}"
+        data = (f"{thread_id}.{i}." * size)[:size]
+        commands += [f"open {path}, w", f"write_to_file {path}, {data}", f"close {path}",
+                     f"open {path}, r", f"read_from_file {path}", f"close {path}"]
+    return commands
+
+# writes the same scripts for every mode, returns the number of commands
+def write_scripts(work_dir: str, mix: str, threads: int, count: int, size: int) -> int:
+    rng = random.Random(0)
+    total = 0
+    for i in range(threads):
+        commands = make_script(i, count, rng)[0] if mix == 'stress' else data_script(i, count, size)
+        total += len(commands)
+        with open(os.path.join(work_dir, f"input_thread{i}.txt"), 'w') as f:
+            f.write('\n'.join(commands) + '\n')
+    return total
+
+def run(mix: str, mode: str, threads: int, count: int, size: int) -> tuple[float, int]:
+    work_dir = tempfile.mkdtemp()
+    total = write_scripts(work_dir, mix, threads, count, size)
+    runner.fs = FileSystem(os.path.join(work_dir, "sample.dat"))
+    runner.fs.mkdir("/shared")
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):     # the file system prints its warnings
+        if mode == 'processes':
+            processes.run_processes(runner.fs, threads, work_dir)
+        else:
+            runner.run_threads(threads, work_dir, batch=mode == 'batch')
+    elapsed = time.perf_counter() - start
+
+    runner.fs.unmount()
+    return elapsed, total
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    size = int(sys.argv[3]) * 1024 if len(sys.argv) > 3 else 64 * 1024
+    steps = max(1, count // 20)     # a step of the data scripts moves far more bytes
+    print(f"{threads} threads, {count} steps per stress script, {steps} writes of {size // 1024} KB per data script")
+    print(f"{'':<8}{'':<11}{'seconds':>10}{'commands/s':>14}")
+
+    for mix, steps in (('stress', count), ('data', steps)):
+        for mode in ('threads', 'processes', 'batch'):
+            elapsed, total = run(mix, mode, threads, steps, size)
+            print(f"{mix:<8}{mode:<11}{elapsed:>10.3f}{total / elapsed:>14.0f}")
+
+if __name__ == "__main__":
+    main()
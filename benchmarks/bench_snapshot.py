@@ -0,0 +1,63 @@
+# time and space of a snapshot of a tree of small files compared with copying the whole disk file,
+# and what it takes after a few of the files are changed, then the time to roll back to it
+# usage: python bench_snapshot.py [files ...]
+import os
+import sys
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from nodes import File
+from bench_metadata import timed
+
+BLOCK_SIZE = 4096
+FILES_PER_DIR = 100
+FILE_BLOCKS = 2
+CHANGED = 0.01  # part of the files written to after the snapshot
+
+def open_disk(files: int) -> FileSystem:
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    metadata = (400 * files // BLOCK_SIZE + 64) * BLOCK_SIZE
+    FileSystem.format(path, metadata + 2 * (FILE_BLOCKS + 1) * files * BLOCK_SIZE, BLOCK_SIZE, metadata, metadata // 4)
+    return FileSystem(path)
+
+def run(files: int):
+    fs = open_disk(files)
+    rng = random.Random(0)
+    for i in range(files):
+        fs.create(f"/dir{i // FILES_PER_DIR}/file{i}").write_to_file(rng.randbytes(FILE_BLOCKS * BLOCK_SIZE), 0)
+    fs.save()
+    path = fs.disk.file.name
+    _, copy_time = timed(lambda: shutil.copyfile(path, path + ".copy"))
+    copy_size = os.path.getsize(path + ".copy")
+    os.remove(path + ".copy")
+
+    image = len(fs.encode()[0])
+    _, snapshot_time = timed(lambda: fs.snapshot("before"))
+    snapshot_size = len(fs.encode()[0]) - image
+
+    # one block of a few files is written, each gets a copy of that block and its directory a new record
+    for i in rng.sample(range(files), int(files * CHANGED)):
+        fs.search_path(f"/dir{i // FILES_PER_DIR}/file{i}", File).write_to_file(b'changed', 0)
+    fs.save()
+    changed_size = len(fs.encode()[0]) - image
+    held = fs.held.count()
+    _, rollback_time = timed(lambda: fs.rollback("before"))
+    fs.unmount()
+    os.remove(path)
+    print(f"{files:>8}{copy_time:>10.3f}{copy_size // 1024:>10}{snapshot_time:>12.3f}{snapshot_size // 1024:>10}"
+          f"{changed_size // 1024:>12}{held * BLOCK_SIZE // 1024:>12}{rollback_time:>12.3f}")
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [2_000, 10_000]
+    print(f"{int(CHANGED * 100)}% of the files get one block written after the snapshot, sizes in KB")
+    print(f"{'files':>8}{'copy s':>10}{'copy KB':>10}{'snapshot s':>12}{'image KB':>10}"
+          f"{'changed KB':>12}{'held KB':>12}{'rollback s':>12}")
+    for files in sizes:
+        run(files)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# time and blocks taken by writing one byte far past the end of an empty file, the gap is left as a hole
+# then the time to read back a megabyte of the hole and to punch a hole over a written megabyte
+# usage: python bench_sparse.py [offset ...]
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from bench_metadata import timed
+
+BLOCK_SIZE = 4096
+MB = 2**20
+
+def open_disk() -> FileSystem:
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    FileSystem.format(path, 64 * MB, BLOCK_SIZE, 64 * BLOCK_SIZE, 16 * BLOCK_SIZE)
+    return FileSystem(path)
+
+def run(offset: int):
+    fs = open_disk()
+    file = fs.create('/sparse')
+    free = fs.allocator.free_count
+    _, write_time = timed(lambda: file.write_to_file(b'x', offset))
+    used = free - fs.allocator.free_count
+    _, read_time = timed(lambda: file.read_from_file(offset // 2, MB))
+
+    file.write_to_file(b'y' * MB, 0)
+    free = fs.allocator.free_count
+    _, punch_time = timed(lambda: file.punch_hole(0, MB))
+    freed = fs.allocator.free_count - free
+
+    path = fs.disk.file.name
+    fs.unmount()
+    os.remove(path)
+    print(f"{offset:>14}{write_time:>10.4f}{used:>8}{read_time:>12.4f}{punch_time:>10.4f}{freed:>8}")
+
+def main():
+    offsets = [int(arg) for arg in sys.argv[1:]] or [MB, 100 * MB, 2**30]
+    print(f"{'offset':>14}{'write s':>10}{'blocks':>8}{'read 1MB s':>12}{'punch s':>10}{'freed':>8}")
+    for offset in offsets:
+        run(offset)
+
+if __name__ == "__main__":
+    main()
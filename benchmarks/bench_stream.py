@@ -0,0 +1,60 @@
+# peak memory of reading a large file at once compared with iterating over an open handle, and of writing it
+# through write_chunk() in small pieces, the streamed runs should not depend on the size of the file
+# usage: python bench_stream.py [megabytes ...]
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from session import Session
+from bench_metadata import timed
+
+BLOCK_SIZE = 4096
+PIECE = 1000    # bytes per write_chunk() call
+MB = 2**20
+
+def peak(function):
+    tracemalloc.start()
+    result, seconds = timed(function)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / MB
+
+def run(megabytes: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    FileSystem.format(path, (megabytes + 1) * MB, BLOCK_SIZE, 64 * BLOCK_SIZE, 16 * BLOCK_SIZE)
+    fs = FileSystem(path)
+    session = Session(fs)
+    fs.create('/big')
+    handle = session.handles[session.open('/big', 'w+')]
+    piece = bytes(range(256)) * (PIECE // 256) + b'x' * (PIECE % 256)
+
+    def write():
+        for _ in range(megabytes * MB // PIECE):
+            handle.write_chunk(piece)
+        handle.flush()
+    _, write_time, write_peak = peak(write)
+
+    def stream():
+        handle.seek(0)
+        return sum(len(chunk) for chunk in handle)
+    streamed, stream_time, stream_peak = peak(stream)
+    whole, read_time, read_peak = peak(lambda: len(handle.read()))
+    assert streamed == whole == handle.file.size
+
+    session.close_all()
+    fs.unmount()
+    os.remove(path)
+    print(f"{megabytes:>6}{write_time:>10.2f}{write_peak:>10.1f}{stream_time:>10.2f}{stream_peak:>10.1f}{read_time:>10.2f}{read_peak:>10.1f}")
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [16, 64]
+    print(f"{'MB':>6}{'write s':>10}{'peak MB':>10}{'stream s':>10}{'peak MB':>10}{'read s':>10}{'peak MB':>10}")
+    for megabytes in sizes:
+        run(megabytes)
+
+if __name__ == "__main__":
+    main()
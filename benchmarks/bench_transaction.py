@@ -0,0 +1,40 @@
+# time and peak memory of many partial block writes inside one transaction, the time per write should not grow with
+# the number of writes and the dirty blocks over the cache size are spilled instead of kept in memory, the memory that
+# grows is what abort needs to undo the writes
+# usage: python bench_transaction.py [writes ...]
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from bench_stream import peak, BLOCK_SIZE, MB
+
+def run(writes: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    FileSystem.format(path, 2 * writes * BLOCK_SIZE + MB, BLOCK_SIZE, 64 * BLOCK_SIZE, 16 * BLOCK_SIZE)
+    fs = FileSystem(path)
+    old = fs.create('/old')
+    old.write_to_file(b'o' * (writes * BLOCK_SIZE), 0)     # committed blocks, written over in place
+    new = fs.create('/new')     # blocks given to it are free when the transaction begins
+
+    def transaction():
+        fs.begin()
+        for i in range(writes):
+            old.write_to_file(b'x' * 100, i * BLOCK_SIZE + 10)
+            new.write_to_file(b'y' * 100, i * BLOCK_SIZE + 10)
+        fs.commit()
+    _, seconds, peak_mb = peak(transaction)
+    fs.unmount()
+    os.remove(path)
+    print(f"{writes:>8}{seconds:>10.2f}{seconds / (2 * writes) * 1e6:>10.0f}{peak_mb:>10.1f}")
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1_000, 2_000, 4_000, 8_000]
+    print(f"{'writes':>8}{'s':>10}{'us/write':>10}{'peak MB':>10}")
+    for writes in sizes:
+        run(writes)
+
+if __name__ == "__main__":
+    main()
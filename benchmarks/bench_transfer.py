@@ -0,0 +1,78 @@
+# time to copy a tree of small host files into a disk with transfer.import_tree() on one and on several threads,
+# compared with creating and writing every file as its own operation, as a script of commands does
+# usage: python bench_transfer.py [files ...]
+import os
+import sys
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from FileSystem import FileSystem
+from settings import TRANSFER_THREADS
+from transfer import import_tree, export_tree, host_tree
+from bench_metadata import timed
+
+BLOCK_SIZE = 4096
+FILES_PER_DIR = 100
+
+# a host directory of files of up to 8 KB, FILES_PER_DIR in each directory
+def make_corpus(files: int) -> str:
+    host = tempfile.mkdtemp()
+    rng = random.Random(0)
+    for i in range(files):
+        dir = os.path.join(host, f"dir{i // FILES_PER_DIR}")
+        os.makedirs(dir, exist_ok=True)
+        with open(os.path.join(dir, f"file{i}.txt"), 'wb') as f:
+            f.write(rng.randbytes(rng.randint(1, 8192)))
+    return host
+
+def open_disk(files: int) -> FileSystem:
+    path = os.path.join(tempfile.mkdtemp(), "bench.dat")
+    metadata = (200 * files // BLOCK_SIZE + 64) * BLOCK_SIZE
+    FileSystem.format(path, metadata + 3 * files * BLOCK_SIZE, BLOCK_SIZE, metadata, metadata // 4)
+    return FileSystem(path)
+
+def close_disk(fs: FileSystem):
+    path = fs.disk.file.name
+    fs.unmount()
+    os.remove(path)
+
+# every directory and file created and written by its own operation
+def one_by_one(fs: FileSystem, host: str):
+    dirs, files = [], []
+    host_tree(host, '/in', dirs, files)
+    for dir in dirs:
+        fs.mkdir(dir)
+    for host_path, path, size in files:
+        with open(host_path, 'rb') as f:
+            fs.create(path).write_to_file(f.read())
+
+def run(files: int):
+    host = make_corpus(files)
+    times = []
+    for copy in (lambda fs: one_by_one(fs, host),
+                 lambda fs: import_tree(fs, host, '/in', 1),
+                 lambda fs: import_tree(fs, host, '/in', TRANSFER_THREADS)):
+        fs = open_disk(files)
+        times.append(timed(lambda: copy(fs))[1])
+        close_disk(fs)
+
+    fs = open_disk(files)
+    import_tree(fs, host, '/in')
+    out = tempfile.mkdtemp()
+    times.append(timed(lambda: export_tree(fs, '/in', out))[1])
+    close_disk(fs)
+    shutil.rmtree(host)
+    shutil.rmtree(out)
+    print(f"{files:>8}" + "".join(f"{seconds:>14.2f}" for seconds in times))
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [2_000, 10_000]
+    print(f"{'files':>8}{'one by one s':>14}{'import 1 s':>14}{f'import {TRANSFER_THREADS} s':>14}{'export s':>14}")
+    for files in sizes:
+        run(files)
+
+if __name__ == "__main__":
+    main()
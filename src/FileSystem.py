@@ -1,59 +1,394 @@
-from settings import BLOCK_SIZE, FREE_START, TOTAL_MEMORY
+from settings import BLOCK_SIZE, FREE_START, TOTAL_MEMORY, JOURNAL_SIZE, CHECKPOINT_INTERVAL, DISK_BACKEND, AUTO_GROW, DIRECTORY_CACHE, DEDUP
 from nodes import Directory, File
+from journal import Journal
+from superblock import Superblock, SUPERBLOCK_SIZE, VERSION
+from metadata import MetadataSlots, HEADER as SLOT_HEADER
+import inodes
+from allocator import Allocator, to_runs
+from blockmap import BlockMap, HOLE, allocated
+from dcache import DentryCache, MISS
+from dedup import RefCounts, ContentIndex
+from snapshot import Snapshot
+from disk import Disk, MmapDisk
+from cache import BlockCache
+from locks import RWLock, operation
+from transaction import Transaction
+from contextlib import contextmanager
+from collections import deque
 from bitarray import bitarray
+from bitarray.util import zeros
+from array import array
+import threading
 import pickle
+import io
 import os
 import re
 
 class FileSystem:
-    def __init__(self, file_name):
-        if os.path.exists(file_name):
-            self.file = open(file_name, 'r+b')
-            self.load()
+    # backend is 'file' for positional reads and writes or 'mmap' to memory-map the disk file
+    # migrate allows loading disks that earlier versions saved with pickle, see migrate.py
+    # snapshot mounts the disk read only with that snapshot as its tree, see mount()
+    def __init__(self, file_name, backend=DISK_BACKEND, migrate=False, snapshot=None):
+        self.dcache = DentryCache()
+        
+        # lock order: lock, rename_lock, directories (parents first), files, alloc_lock, log_lock, meta_lock, image.lock
+        self.lock = RWLock()    # every operation holds it shared, checkpoints hold it exclusively
+        self.rename_lock = threading.Lock()     # operations changing more than one directory
+        self.alloc_lock = threading.Lock()      # allocator and disk size
+        self.log_lock = threading.Lock()    # writing queued records to the journal, see write_log()
+        self.meta_lock = threading.RLock()      # a tree change and queueing its journal record
+        self.queued: list[tuple] = []   # journal records of changes made to the tree, not yet written
+        self.batch = 0  # number of the next write of the queued records, a thread keeps the one its last record is in
+        self.local = threading.local()      # nesting depth of operations and open transaction of each thread
+        self.checkpoint_due = False
+        self.read_only = snapshot is not None
+        if not os.path.exists(file_name):
+            FileSystem.format(file_name)    # new disks get the geometry in settings
+        
+        # disks from before the superblock existed were built with the geometry in settings
+        self.sb = Superblock.read(file_name) or Superblock()
+        if backend == 'mmap':
+            self.disk = MmapDisk(file_name, size=self.sb.total)
         else:
-            self.file = open(file_name, 'w+b')
-            self.root: Directory = Directory('/')
-            # denotes free blocks, custom bitarray() is used as it is much smaller to store in file
-            self.free_spaces = bitarray((TOTAL_MEMORY - FREE_START) // BLOCK_SIZE)
-            self.free_spaces.setall(True)
+            self.disk = Disk(file_name)
+        self.cache = BlockCache(self.disk, self.sb.block_size)  # file content goes through the cache, metadata does not
+        self.journal = Journal(self.disk, self.sb.journal_start, self.sb.journal_size)
+        self.slots = MetadataSlots(self.disk, SUPERBLOCK_SIZE, self.sb.journal_start - SUPERBLOCK_SIZE)
+        self.image = inodes.Image(self)     # directories are read from the last checkpoint when first used
+        self.dedup = ContentIndex(self.sb.block_size) if DEDUP else None   # contents of written blocks, see dedup.py
+        self.load(migrate)
+        if snapshot is not None:
+            self.mount(snapshot)
+        
+    # creates an empty disk, only the superblock is written, the tree is created when the disk is first loaded
+    @staticmethod
+    def format(file_name, total=TOTAL_MEMORY, block_size=BLOCK_SIZE, free_start=FREE_START, journal_size=JOURNAL_SIZE):
+        sb = Superblock(block_size, free_start, total, journal_size)
+        sb.validate()
+        
+        disk = Disk(file_name, create=True)
+        disk.write(0, sb.pack())
+        Journal(disk, sb.journal_start, sb.journal_size).reset()
+        disk.close()
+        
+    @property
+    def block_size(self) -> int:
+        return self.sb.block_size
+        
+    # checkpoint, writes the entire tree and empties the journal
+    # the tree goes to the slot not holding the newest copy, and only once it is on the disk is the journal emptied,
+    # so a crash at any point leaves a complete tree and the journal records that come after it
+    def save(self, layout_changed=False):
+        if self.read_only:
+            return
+        # journal records up to seq are included in this checkpoint, see inodes.py for the format
+        data, head = self.encode()
+        self.cache.flush()
+        
+        # the metadata area is moved into the data area when the tree outgrows it, this changes block lists so encode again
+        while len(data) > self.slots.capacity:
+            self.grow_metadata(len(data))
+            layout_changed = True
+            data, head = self.encode()     # moved files were logged
+        self.write_log()    # to the journal of the tree the disk has until the superblock is written, see grow_metadata()
+        
+        self.disk.flush()   # file content reaches the disk before the metadata that points to it
+        self.slots.write(data, head)
+        self.disk.flush()
+        self.image.saved(data, self.slots.base, self.snapshots.values())
+        
+        # a new layout only takes effect with the superblock, until then a crash loads the old one
+        if layout_changed:
+            self.sb.version = VERSION
+            self.disk.write(0, self.sb.pack())
+            self.disk.flush()
+        
+        self.journal.reset()
+        self.disk.flush()
+        self.checkpoint_due = False
+        self.image.evict(self.root, DIRECTORY_CACHE)    # every loaded directory was just saved
+        
+    # the tree, the allocator's bitmap and the snapshots as one image, see inodes.py
+    def encode(self) -> tuple[bytes, int]:
+        return self.image.encode(self.root, self.allocator.free, self.seq, self.refs.items(), self.snapshots.values(), self.held)
+        
+    # checkpoint once no operation is running, inside a transaction it is left to commit()
+    def checkpoint(self):
+        if self.transaction():
+            self.checkpoint_due = True
+            return
+        with self.lock.write():
             self.save()
-
-        self.current_path: list[Directory] = [self.root]
-        self.opened_files = []
+            
+    # every public operation runs inside this, nested operations only count the depth
+    # the checkpoint is left to the end of the outermost operation as it needs the tree to itself
+    @contextmanager
+    def guard(self):
+        depth = getattr(self.local, 'depth', 0)
+        if depth == 0:
+            self.lock.acquire_read()
+        self.local.depth = depth + 1
+        try:
+            yield
+        except Exception:
+            if depth == 0 and self.transaction():
+                self.transaction().failed = True
+            raise
+        finally:
+            self.local.depth = depth
+            if depth == 0:
+                try:
+                    if self.queued:
+                        self.write_log()
+                finally:
+                    self.lock.release_read()
         
-    def save(self):
-        # as root contains references to all its children which further contain references, simply pickling the root stores the entire tree
-        metadata = {
-            'free': self.free_spaces,
-            'root': self.root
-        }
+        # a checkpoint would save the uncommitted changes, commit() checkpoints instead
+        if depth == 0 and self.checkpoint_due and not self.transaction():
+            with self.lock.write():
+                if self.checkpoint_due:     # another thread may have checkpointed first
+                    self.save()
         
-        data = pickle.dumps(metadata)
+    def load(self, migrate=False):
+        # disks from before the superblock existed store the tree at offset 0, version 1 disks right after the superblock
+        # both keep a single copy and are moved to the slots with the first checkpoint
+        # disks before version 3 pickled the tree and the journal records, unpickling can run code so it needs migrate
+        # version 3 disks store the whole tree in one checksummed block and are read at once
+        legacy = Superblock.unpack(self.disk.read(0, SUPERBLOCK_SIZE)) is None
+        pickled = legacy or self.sb.version < 3
+        if legacy:
+            data = self.disk.read(0, self.sb.free_start)
+        elif self.sb.version < 2:
+            data = self.disk.read(SUPERBLOCK_SIZE, self.sb.journal_start - SUPERBLOCK_SIZE)
+        else:
+            data = self.slots.read()
         
-        if len(data) > FREE_START:
-            raise MemoryError("Directory tree is too big to store in provided space, consider increasing FREE_START in settings.")
+        if data is None or data[0] == 0:    # freshly formatted, nothing has been saved yet
+            self.seq = 0    # number of the last logged change
+            self.root: Directory = Directory('/')
+            # denotes free blocks, custom bitarray() is used as it is much smaller to store in file
+            free_spaces = bitarray(self.sb.blocks)
+            free_spaces.setall(True)
+            self.allocator = Allocator(free_spaces, self.sb.block_size, self.sb.free_start)
+            self.refs = RefCounts(self.sb.block_size)     # blocks used by more than one file
+            self.snapshots: dict[str, Snapshot] = {}    # by name, in the order they were taken
+            self.held = zeros(self.sb.blocks, endian='big')     # blocks only snapshots use
+            self.pin()
+            self.save(layout_changed=pickled)
+            return
         
-        # pad nulls for cleanliness
-        data += b'\x00' * (FREE_START - len(data))
+        if pickled:
+            if not migrate:
+                raise ValueError("The disk was saved with pickle by an earlier version, convert it with migrate.py first.")
+            stream = io.BytesIO(data)
+            metadata = pickle.load(stream)   # trailing null padding and journal are ignored by pickle
+            if self.sb.version < 2:
+                self.slots.keep(0 if legacy else SUPERBLOCK_SIZE, stream.tell())
+            self.root, free = metadata['root'], metadata['free']
+            self.root.parent = None     # missing in trees saved before nodes had parents
+            self.set_fs(self.root)
+            journaled = 'seq' in metadata   # trees saved before the journal existed may reach into the journal area
+            self.seq = metadata.get('seq', 0)
+            shared, snapshots, held = [], [], None
+        else:
+            self.root, free, self.seq, shared, snapshots, held = self.image.open(data, self.slots.base)
+            journaled = True
         
-        self.file.seek(0)
-        self.file.write(data)
+        self.allocator = Allocator(free, self.sb.block_size, self.sb.free_start)
+        self.refs = RefCounts(self.sb.block_size, shared)
+        self.snapshots = {name: Snapshot(name, image, used, runs) for name, image, used, runs in snapshots}
+        self.held = held if held is not None else zeros(len(free), endian='big')
+        if len(self.allocator.free) < self.sb.blocks:   # stopped while growing, before the checkpoint
+            self.allocator.grow(self.sb.blocks - len(self.allocator.free))
+        self.pin()
         
-    def load(self):
-        self.file.seek(0)
-        data = self.file.read(FREE_START)
-        metadata = pickle.loads(data.rstrip(b'\x00'))   # rstrip to remove null padding
-        self.free_spaces = metadata['free']
-        self.root = metadata['root']
-        self.set_fs(self.root)
+        if journaled and not self.read_only:    # a snapshot is mounted as it was saved
+            for record in self.journal.read(pickled):
+                if record[0] > self.seq:
+                    self.replay(record)
+                    self.seq = record[0]
+        self.dcache.clear()     # replay resolves paths while the tree is still changing
+        
+        # move old disks to the current layout
+        if pickled or self.sb.version < VERSION:
+            self.save(layout_changed=True)
         
     def set_fs(self, root):
         for child in root.children:
+            child.parent = root
             if type(child) == File:
                 child.fs = self
+                if type(child.blocks) == list:     # files saved before extents stored every block address
+                    child.blocks = BlockMap(self.block_size, child.blocks)
             else:
                 self.set_fs(child)
                 
+    # queues a change for the journal, the caller holds meta_lock while it changes the tree so the records are in the
+    # order of the changes, write_log() writes them at the end of the operation
+    # the change is already in the tree so a checkpoint includes it
+    # inside a transaction the record is kept until commit()
+    def log(self, op: str, *args):
+        with self.meta_lock:
+            if self.transaction():
+                self.transaction().records.append((op,) + args)
+                return
+            self.seq += 1
+            self.queued.append((self.seq, op) + args)
+            self.local.batch = self.batch
+            
+    # writes the queued records to the journal, the tree is checkpointed at the end of the operation when it is full
+    # whatever was written before the records, file content they point to and the records before them, is flushed
+    # first, so the disk never has a record without what comes before it
+    # this is a group commit: the thread that gets log_lock first flushes once and writes the records every thread
+    # queued by then with one write, the others find their records written and return without flushing, and no thread
+    # flushes while holding meta_lock, so changes to other files go on in the meantime
+    # the last records reach the disk with the flush of the next ones, before blocks are freed, or on sync()
+    def write_log(self):
+        with self.log_lock:
+            with self.meta_lock:
+                if getattr(self.local, 'batch', self.batch) < self.batch:    # written with the records of another thread
+                    return
+                records, self.queued = self.queued, []
+                self.batch += 1
+            if not records:
+                return
+            if self.disk.dirty:
+                self.disk.flush()
+            # once a record is left out the next ones must wait for the checkpoint too, replay cannot skip a record
+            written = 0 if self.checkpoint_due else self.journal.extend(records)
+            if written < len(records) or self.journal.count >= CHECKPOINT_INTERVAL:
+                self.checkpoint_due = True
+            
+    # a disk mounted with a snapshot as its tree is never changed
+    def writable(self) -> bool:
+        if self.read_only:
+            print("The disk is mounted read only.")
+        return not self.read_only
+            
+    # starts a transaction in the calling thread, the other threads wait until it is committed or aborted
+    # so the transaction sees no changes but its own and abort can simply undo them
+    def begin(self) -> bool:
+        if not self.writable():
+            return False
+        if self.transaction():
+            print("A transaction is already open.")
+            return False
+        self.lock.acquire_write()
+        self.local.transaction = Transaction()
+        free = self.allocator.free.copy()   # nothing committed uses these blocks, the cache may write them in place
+        
+        def fresh(block: int) -> bool:
+            index = self.allocator.to_index(block)
+            return index >= len(free) or free[index]
+        self.cache.hold(fresh)
+        return True
+    
+    # transaction of the calling thread, None outside of one
+    def transaction(self) -> Transaction:
+        return getattr(self.local, 'transaction', None)
+    
+    # makes the changes of the transaction durable with a single journal record, or a checkpoint if they do not fit
+    # a transaction that failed or cannot be written is rolled back instead
+    def commit(self) -> bool:
+        txn = self.transaction()
+        if txn is None:
+            print("No transaction is open.")
+            return False
+        if txn.failed:
+            print("The transaction failed, its changes were rolled back.")
+            self.abort()
+            return False
+        
+        try:
+            self.cache.release()
+            self.cache.flush()  # file content reaches the disk before the record that points to it
+        except Exception:
+            self.abort()
+            raise
+        
+        self.local.transaction = None
+        try:
+            if txn.records:
+                self.log('batch', txn.records)
+                self.write_log()
+            self.free_runs(txn.freed)
+            if self.checkpoint_due:
+                self.save()
+        finally:
+            self.lock.release_write()
+        return True
+    
+    # undoes every change of the transaction in memory, nothing of it was logged
+    def abort(self) -> bool:
+        txn = self.transaction()
+        if txn is None:
+            print("No transaction is open.")
+            return False
+        
+        self.local.transaction = None
+        try:
+            for undo in reversed(txn.undo):
+                undo()
+            self.dcache.clear()
+        finally:
+            self.cache.release()
+            self.lock.release_write()
+        return True
+    
+    # registers a function that reverts a change if the transaction of the calling thread is aborted
+    def on_abort(self, undo):
+        txn = self.transaction()
+        if txn:
+            txn.undo.append(undo)
+        
+    # applies a logged change to the tree
+    def replay(self, record):
+        op, args = record[1], record[2:]
+        match op:
+            case 'batch':   # a committed transaction
+                for change in args[0]:
+                    self.replay((record[0], *change))
+            case 'mkdir':
+                self.dir_at(args[0]).add(Directory(args[1]))
+            case 'create':
+                self.dir_at(args[0]).add(File(args[1], self))
+            case 'remove':
+                parent = self.dir_at(args[0])
+                parent.remove(self.search_dir(parent, args[1], Directory if args[2] == 'd' else File))
+            case 'move':
+                parent = self.dir_at(args[0])
+                node = self.search_dir(parent, args[1], Directory if args[2] == 'd' else File)
+                parent.remove(node)
+                self.dir_at(args[3]).add(node)
+            case 'file':
+                file = self.walk_path(*self.str_to_path(args[0]), File)     # not cached, replayed removes do not invalidate
+                size, keep, added = args[1:]
+                if added and type(added[0]) == int:     # logged before extents, a list of block addresses
+                    added = to_runs(added, self.block_size)
+                self.free_runs(file.blocks.truncate(keep))
+                self.use_runs(added)
+                file.blocks.append(added)
+                file.size = size
+                
+    def path_of(self, node) -> str:
+        names = []
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(names))
+    
+    # False once node or one of its parents was deleted
+    def attached(self, node) -> bool:
+        while node.parent is not None:
+            node = node.parent
+        return node is self.root
+    
+    def dir_at(self, path: str) -> Directory:
+        node, path_list = self.str_to_path(path)
+        for name in path_list:
+            node = self.search_dir(node, name, Directory)
+        return node
+                
     def is_abs(self, path: str):
         if path.startswith('/'):
             return True
@@ -63,26 +398,50 @@ class FileSystem:
         if self.is_abs(path):
             node = self.root
             path_list = path.split('/')[1:]     # first is just ''
-        else:   # relative path
-            node = self.current_path[-1]
+        else:   # relative to the root, sessions turn paths relative to their directory into absolute ones
+            node = self.root
             path_list = path.split('/')
             
-        while '' in path_list:
-            path_list.remove('')
+        path_list = [name for name in path_list if name != '']
             
         return node, path_list
     
+    # absolute path of path_list relative to node, used as the path cache key
+    def normalize(self, node, path_list: list[str]) -> str:
+        base = self.path_of(node)
+        if len(path_list) == 0:
+            return base
+        return base.rstrip('/') + '/' + '/'.join(path_list)
+    
     def search_dir(self, dir: Directory, name: str, t):
-        for node in dir.children:
-            if node.name == name and type(node) == t:
-                return node
-        return None
+        return dir.get(name, t)
     
     def search_path(self, path: str, t, parent=False, warn=False):
         node, path_list = self.str_to_path(path)
-        prev_node = node
+        key = self.normalize(node, path_list)
+        
+        cached = self.dcache.get(key, t)
+        if cached is not MISS:
+            if cached == None and warn:
+                print(f"{path} does not exist.")
+            if not parent:
+                return cached
+            return cached, cached and cached.parent
+        
+        generation = self.dcache.generation
+        found = self.walk_path(node, path_list, t, warn, path)
+        self.dcache.put(key, t, found, generation)
+        
+        if not parent:
+            return found
+        return found, found and found.parent
+    
+    # resolves path_list relative to node without the path cache
+    def walk_path(self, node, path_list: list[str], t, warn=False, path=''):
+        if len(path_list) == 0:     # path of the root or current directory itself
+            return node if t == Directory else None
+        
         for i in range(len(path_list) - 1):
-            prev_node = node
             node = self.search_dir(node, path_list[i], Directory)
             if node == None:
                 if warn:
@@ -92,14 +451,13 @@ class FileSystem:
         node = self.search_dir(node, path_list[-1], t)
         if node == None and warn:
             print(f"{path} does not exist.")
-        
-        if not parent:
-            return node
-        else:
-            return node, prev_node
+        return node
 
 
+    @operation
     def mkdir(self, path: str, file=False):
+        if not self.writable():
+            return None
         node, path_list = self.str_to_path(path)
         
         i = 0
@@ -110,118 +468,533 @@ class FileSystem:
             node = new_node
             i += 1
 
-        # create each directory
+        # create each directory, another thread may have created it since the lookup
         for dir_name in path_list[i:-1]:
-            this_dir = Directory(dir_name)
-            node.children.append(this_dir)
+            with node.lock.write():
+                if not self.attached(node):
+                    print(f"Directory of {path} was deleted.")
+                    return
+                this_dir = self.search_dir(node, dir_name, Directory)
+                if this_dir == None:
+                    this_dir = Directory(dir_name)
+                    self.attach(this_dir, node, 'mkdir')
             node = this_dir
-            
-        if file:
-            if self.search_dir(node, path_list[-1], File):
-                print(f"File {'/' * self.is_abs(path) + str(path_list)} already exists.")
-            else:
-                node.children.append(File(path_list[-1], self))
-        else:
-            if self.search_dir(node, path_list[-1], Directory):
-                print(f"Directory {'/' * self.is_abs(path) + str(path_list)} already exists.")
-            else:
-                node.children.append(Directory(path_list[-1]))
-
-        self.save()
-        
-        return node.children[-1]
-
-    def chdir(self, path: str):
-        # to go backwards
-        if path == ".." and len(self.current_path) > 1:
-            self.current_path.pop()
-            return
-        
-        node, path_list = self.str_to_path(path)
-        if self.is_abs(path):
-            self.current_path = [self.root]
         
-        for i in range(len(path_list)):
-            found = self.search_dir(self.current_path[-1], path_list[i], Directory)
+        t = File if file else Directory
+        with node.lock.write():
+            if not self.attached(node):
+                print(f"Directory of {path} was deleted.")
+                return
+            found = self.search_dir(node, path_list[-1], t)
             if found:
-                self.current_path.append(found)
+                print(f"{t.__name__} {'/' * self.is_abs(path) + str(path_list)} already exists.")
             else:
-                print(f"Directory {'/' * self.is_abs(path) + '/'.join(path_list[:i+1])} does not exist.")
-
-    def ls(self):
-        output = ''
-        if len(self.current_path[-1].children) == 0:
-            output = "Empty"
-        else:
-            for child in self.current_path[-1].children:
-                output += f"{child.name}\n"
-        return output
+                found = File(path_list[-1], self) if file else Directory(path_list[-1])
+                self.attach(found, node, 'create' if file else 'mkdir')
+        
+        return found
+    
+    # adds a new node to parent and logs it, the caller holds the parent's lock
+    def attach(self, node, parent: Directory, op: str):
+        with self.meta_lock:
+            parent.add(node)
+            self.log(op, self.path_of(parent), node.name)
+            self.dcache.invalidate(self.path_of(node), type(node))     # may be cached as not existing
+            self.on_abort(lambda: self.unlink(node, parent))
+            
+    # removes a node without logging it, reverts attach() when a transaction is aborted
+    def unlink(self, node, parent: Directory):
+        parent.remove(node)
+        node.parent = None
+            
+    # removes node from parent and logs it, the caller holds the locks of both
+    def detach(self, node, parent: Directory):
+        with self.meta_lock:
+            path = self.path_of(node)
+            parent.remove(node)
+            self.log('remove', self.path_of(parent), node.name, 'd' if type(node) == Directory else 'f')
+            node.parent = None
+            self.on_abort(lambda: parent.add(node))
+            if type(node) == Directory:
+                self.dcache.invalidate_tree(path)
+            else:
+                self.dcache.invalidate(path, File)
+    
+    # moves node from its parent to dest and logs it, the caller holds the locks of both directories
+    def relocate(self, node, dest: Directory):
+        with self.meta_lock:
+            parent = node.parent
+            parent_path = self.path_of(parent)
+            old_path = self.path_of(node)
+            parent.remove(node)
+            dest.add(node)
+            
+            def undo():
+                dest.remove(node)
+                parent.add(node)
+            self.on_abort(undo)
+            self.log('move', parent_path, node.name, 'd' if type(node) == Directory else 'f', self.path_of(dest))
+            if type(node) == Directory:
+                self.dcache.invalidate_tree(old_path)
+                self.dcache.invalidate_tree(self.path_of(node))     # negative entries at the new location
+            else:
+                self.dcache.invalidate(old_path, File)
+                self.dcache.invalidate(self.path_of(node), File)
+                
+    # write locks on two directories, always taken in the same order
+    @contextmanager
+    def lock_pair(self, a: Directory, b: Directory):
+        first, second = sorted((a, b), key=id)
+        with first.lock.write(), second.lock.write():
+            yield
 
     def create(self, path: str) -> File:
         return self.mkdir(path, True)
 
+    @operation
     def delete_file(self, path: str):
+        if not self.writable():
+            return
         found, parent = self.search_path(path, File, True, True)
-        if found:
-            found.truncate_file(0)
-            parent.children.remove(found)
-            del found
-            self.save()
+        if not found:
+            return
+        if parent:
+            with parent.lock.write():
+                if found.parent is parent:
+                    self.delete_file_t(found, parent)
+                    return
+        print(f"{path} does not exist.")    # deleted or moved since the lookup
 
+    # the caller holds the parent's lock
     def delete_file_t(self, file: File, parent: Directory):
-        file.truncate_file(0)
-        parent.children.remove(file)
-        del file
-        self.save()
+        with file.lock.write():
+            file.truncate_file(0)
+            self.detach(file, parent)
         
+    # the caller holds the parent's lock, the directory is locked before its children are listed
     def delete_dir_t(self, dir: Directory, parent: Directory):
-        for child in dir.children:
-            if type(child) == File:
-                self.delete_file_t(child, dir)
-            else:
-                self.delete_dir_t(child, dir) 
-        parent.children.remove(dir)
-        del dir
-        self.save()
-
-    def delete_dir(self, name: str):
-        dir, parent = self.search_path(name, Directory, parent=True)
-        if dir:
+        with dir.lock.write():
             for child in dir.children:
                 if type(child) == File:
                     self.delete_file_t(child, dir)
                 else:
                     self.delete_dir_t(child, dir)
-            parent.children.remove(dir)
-            del dir
-            self.save()
+            self.detach(dir, parent)
+
+    @operation
+    def delete_dir(self, name: str):
+        if not self.writable():
+            return
+        with self.rename_lock:
+            dir, parent = self.search_path(name, Directory, parent=True)
+            if dir and parent:      # root cannot be deleted
+                with parent.lock.write():
+                    if dir.parent is parent:
+                        self.delete_dir_t(dir, parent)
             
+    @operation
     def move_file(self, src: str, dest: str):
-        found_src, parent_src = self.search_path(src, File, True, True)
-        found_dest = self.search_path(dest, Directory, False, True)
-        if not found_src or not found_dest:
+        if not self.writable():
             return
+        with self.rename_lock:
+            found_src, parent_src = self.search_path(src, File, True, True)
+            found_dest = self.search_path(dest, Directory, False, True)
+            if not found_src or not found_dest:
+                return
+            
+            if parent_src is None:      # deleted since the lookup
+                print(f"{src} does not exist.")
+                return
+            
+            with self.lock_pair(parent_src, found_dest):
+                if found_src.parent is not parent_src:
+                    print(f"{src} does not exist.")
+                    return
+                if self.search_dir(found_dest, found_src.name, File):
+                    print(f"File {found_src.name} already exists in {dest}.")
+                    return
+                self.relocate(found_src, found_dest)
         
-        found_dest.children.append(found_src)
-        parent_src.children.remove(found_src)
-        
+    @operation
     def move_dir(self, src: str, dest: str):
-        found_src, parent_src = self.search_path(src, Directory, True, True)
-        found_dest = self.search_path(dest, Directory, False, True)
-        if not found_src or not found_dest:
+        if not self.writable():
             return
-        
-        found_dest.children.append(found_src)
-        parent_src.children.remove(found_src)
+        with self.rename_lock:
+            found_src, parent_src = self.search_path(src, Directory, True, True)
+            found_dest = self.search_path(dest, Directory, False, True)
+            if not found_src or not found_dest:
+                return
+            
+            # a directory cannot be moved inside itself
+            node = found_dest
+            while node is not None:
+                if node == found_src:
+                    print(f"Cannot move {src} inside itself.")
+                    return
+                node = node.parent
+                
+            with self.lock_pair(parent_src, found_dest):
+                if self.search_dir(found_dest, found_src.name, Directory):
+                    print(f"Directory {found_src.name} already exists in {dest}.")
+                    return
+                self.relocate(found_src, found_dest)
             
+    # creates dest as a copy of the file src that shares its blocks, only the block map is copied
+    # either file gets its own copy of a block when it is next written to, see File.unshare()
+    @operation
+    def clone_file(self, src: str, dest: str) -> File:
+        if not self.writable():
+            return None
+        source = self.search_path(src, File, warn=True)
+        if not source:
+            return None
+        if self.search_path(dest, File):
+            print(f"File {dest} already exists.")
+            return None
+        target = self.create(dest)
+        if target is None:
+            return None
+        
+        # no other operation holds two file locks, so taking them in this order cannot deadlock
+        with source.lock.read(), target.lock.write():
+            if source.parent is None or target.parent is None:
+                print(f"{src if source.parent is None else dest} was deleted.")
+                return None
+            if len(target.blocks) > 0:  # created by another thread since the lookup
+                print(f"File {dest} already exists.")
+                return None
+            self.share(source.blocks.extents())
+            target.blocks = source.blocks.copy()
+            target.size = source.size
+            target.commit(0)
+        return target
+
+    # keeps the tree as it is now as the snapshot name, files changed afterwards get copies of the blocks they write to
+    # costs a checkpoint, after that only what changes takes space, see snapshot.py
+    def snapshot(self, name: str) -> bool:
+        if not self.writable():
+            return False
+        if self.transaction():
+            print("Cannot take a snapshot inside a transaction.")
+            return False
+        if not 0 < len(name.encode()) < 2 ** 16:
+            print("A snapshot name takes 1 to 65535 bytes.")
+            return False
+        with self.lock.write():
+            if name in self.snapshots:
+                print(f"Snapshot {name} already exists.")
+                return False
+            with self.alloc_lock:
+                used = ~self.allocator.free & ~self.held
+                self.snapshots[name] = Snapshot(name, inodes.Image(self), used, self.refs.items())
+                self.pinned |= used
+            self.save()     # the snapshot gets the records the tree is saved with
+        return True
+    
+    # names of the snapshots, oldest first
+    def list_snapshots(self) -> list[str]:
+        return list(self.snapshots)
+    
+    # makes the tree what it was when the snapshot name was taken, the snapshot is kept so it can be rolled back to again
+    # every change since is lost, files that were open are left as if they were deleted
+    def rollback(self, name: str) -> bool:
+        if not self.writable():
+            return False
+        if self.transaction():
+            print("Cannot roll back inside a transaction.")
+            return False
+        with self.lock.write():
+            snapshot = self.snapshots.get(name)
+            if snapshot is None:
+                print(f"Snapshot {name} does not exist.")
+                return False
+            # the tree starts with the snapshot's records and blocks, the blocks only the old tree used are free
+            self.image = inodes.Image(self)
+            self.image.table, self.image.base = array('Q', snapshot.image.table), snapshot.image.base
+            self.root = Directory('/', 0, self.image)
+            with self.alloc_lock:
+                self.refs = RefCounts(self.block_size, snapshot.shared)
+                self.held = self.pinned & ~snapshot.used
+                self.allocator = Allocator(~self.pinned, self.block_size, self.sb.free_start)
+                if self.dedup:
+                    self.dedup.clear()
+            self.dcache.clear()
+            self.save()
+        return True
+    
+    # drops the snapshot name, the blocks only it kept are freed
+    def delete_snapshot(self, name: str) -> bool:
+        if not self.writable():
+            return False
+        if self.transaction():
+            print("Cannot delete a snapshot inside a transaction.")
+            return False
+        with self.lock.write():
+            if self.snapshots.pop(name, None) is None:
+                print(f"Snapshot {name} does not exist.")
+                return False
+            with self.alloc_lock:
+                self.pin()
+                freed = self.held & ~self.pinned
+                self.held &= self.pinned
+                everything = [(self.allocator.to_address(0), len(freed))]
+                self.allocator.free_runs([(start, count) for start, count, bit in self.segments(freed, everything) if bit])
+            self.save()     # before another operation can be given its blocks, a crash until then brings the snapshot back
+        return True
+    
+    # makes the snapshot name the tree of a disk mounted read only, as if it had been rolled back to
+    # for checking or copying out what a snapshot holds while no other process changes the disk
+    def mount(self, name: str):
+        snapshot = self.snapshots.get(name)
+        if snapshot is None:
+            raise ValueError(f"Snapshot {name} does not exist.")
+        self.image, self.root = snapshot.image, snapshot.root
+        self.allocator = Allocator(~snapshot.used, self.block_size, self.sb.free_start)
+        self.refs = RefCounts(self.block_size, snapshot.shared)
+        self.snapshots = {}
+        self.held = zeros(len(snapshot.used), endian='big')
+        self.pin()
+
+    # (blocks used on the disk, blocks used by files), the second counts a shared block once for every file using it
+    # blocks only snapshots use are left out
+    def sharing(self) -> tuple[int, int]:
+        with self.alloc_lock:
+            used = len(self.allocator.free) - self.allocator.free_count - self.held.count()
+            return used, used + self.refs.total
+
     # returns start index of a free block
     def allocate(self) -> int:
-        for i, space in enumerate(self.free_spaces):
-            if space:
-                self.free_spaces[i] = False
-                return (i + FREE_START // BLOCK_SIZE) * BLOCK_SIZE
-        raise MemoryError("No free spaces available in file. Consider truncating existing files or changing TOTAL_MEMORY in settings.")
+        return self.allocate_extent(1)[0][0]
+    
+    # returns contiguous (start, number of blocks) runs covering n blocks
+    # blocks allocated ahead for the calling thread are handed out first, see allocate_ahead()
+    def allocate_extent(self, n: int) -> list[tuple[int, int]]:
+        runs = []
+        ahead = getattr(self.local, 'ahead', None)
+        while ahead and n:
+            start, count = ahead[0]
+            if count > n:
+                ahead[0] = (start + n * self.block_size, count - n)
+                count = n
+            else:
+                ahead.popleft()
+            runs.append((start, count))
+            n -= count
+        if n == 0:
+            return runs
+        with self.alloc_lock:
+            if AUTO_GROW and n > self.allocator.free_count:
+                # at least double the data area so growing stays rare
+                missing = n - self.allocator.free_count
+                self.extend(self.sb.total + max(missing, len(self.allocator.free)) * self.block_size)
+                self.checkpoint_due = True
+            return runs + self.allocator.allocate_extent(n)
+
+    # allocates n blocks at once for the files the calling thread writes next, so many small files take their blocks
+    # from one allocation, they are used in order by allocate_extent() and what is left is freed by release_ahead()
+    # nothing points to them until a file takes them, so they are not logged
+    def allocate_ahead(self, n: int):
+        self.release_ahead()
+        self.local.ahead = deque(self.allocate_extent(n))
 
+    def release_ahead(self):
+        ahead = getattr(self.local, 'ahead', None)
+        self.local.ahead = None
+        if ahead:
+            with self.alloc_lock:
+                self.allocator.free_runs(list(ahead))
+        
+    # frees (start address, number of blocks) runs, holes among them are skipped
+    # blocks another file still uses only lose a reference, blocks of a snapshot are held for it
+    # a transaction keeps them until commit so abort can give them back to their file
+    def free_runs(self, runs: list[tuple[int, int]]):
+        runs = allocated(runs)
+        if self.transaction():
+            self.transaction().freed.extend(runs)
+            return
+        self.write_log()    # the record that frees them is on the disk before another file can be given them
+        if self.disk.dirty:
+            self.disk.flush()
+        with self.alloc_lock:
+            runs = self.refs.add(runs, -1)
+            if self.dedup:
+                self.dedup.forget(runs)
+            self.allocator.free_runs(self.unpinned(runs))
+                
+    # one more file uses the blocks of (start address, number of blocks) runs, they stay used until it frees them too
+    def share(self, runs: list[tuple[int, int]]):
+        runs = allocated(runs)
+        with self.alloc_lock:
+            self.refs.add(runs, 1)
+        self.on_abort(lambda: self.free_runs(runs))
+        
+    # marks the blocks a replayed record gives a file as used, blocks that are already used are shared with it
+    # blocks held for snapshots are the file's again, a record that keeps fewer blocks than it could frees and uses them again
+    def use_runs(self, runs: list[tuple[int, int]]):
+        for start, count, free in self.segments(self.allocator.free, runs):
+            if free:
+                self.allocator.mark_used(start, count)
+                continue
+            for part, n, held in self.segments(self.held, [(start, count)]):
+                if held:
+                    index = self.allocator.to_index(part)
+                    self.held[index:index + n] = False
+                else:
+                    self.refs.add([(part, n)], 1)
+                    
+    # (start address, number of blocks, bit) parts of (start address, number of blocks) runs, split where the bit
+    # of their blocks in a bitmap of the data area changes
+    def segments(self, bits: bitarray, runs: list[tuple[int, int]]):
+        for start, count in allocated(runs):
+            index = self.allocator.to_index(start)
+            end = index + count
+            while index < end:
+                bit = bits[index]
+                stop = bits.find(not bit, index, end)
+                stop = end if stop == -1 else stop
+                yield self.allocator.to_address(index), stop - index, bit
+                index = stop
+                
+    # the parts of (start address, number of blocks) runs the tree let go of that no snapshot uses
+    # the others are held for the snapshots, the caller holds alloc_lock
+    def unpinned(self, runs: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        if not self.snapshots:
+            return runs
+        free = []
+        for start, count, pinned in self.segments(self.pinned, runs):
+            if pinned:
+                index = self.allocator.to_index(start)
+                self.held[index:index + count] = True
+            else:
+                free.append((start, count))
+        return free
+    
+    # (start address, number of blocks) parts of count blocks from start that another file or a snapshot also uses
+    # the caller holds alloc_lock
+    def shared_parts(self, start: int, count: int) -> list[tuple[int, int]]:
+        parts = self.refs.shared(start, count)
+        if not self.snapshots:
+            return parts
+        parts += [(part, n) for part, n, pinned in self.segments(self.pinned, [(start, count)]) if pinned]
+        merged = []
+        for part, n in sorted(parts):
+            if merged and part <= merged[-1][0] + merged[-1][1] * self.block_size:
+                end = max(merged[-1][0] + merged[-1][1] * self.block_size, part + n * self.block_size)
+                merged[-1] = (merged[-1][0], (end - merged[-1][0]) // self.block_size)
+            else:
+                merged.append((part, n))
+        return merged
+    
+    # sizes the bitmaps of the snapshots to the data area and finds the blocks they pin, every block one of them uses
+    def pin(self):
+        blocks = len(self.allocator.free)
+        for bits in [self.held] + [snapshot.used for snapshot in self.snapshots.values()]:
+            bits.extend(zeros(blocks - len(bits), endian='big'))
+        self.pinned = zeros(blocks, endian='big')
+        for snapshot in self.snapshots.values():
+            self.pinned |= snapshot.used
+    
+    # grows the disk to new_total bytes while it is in use, the new space is added as free blocks at the end
+    def grow(self, new_total: int):
+        if not self.writable():
+            return
+        if new_total <= self.sb.total:
+            print(f"Disk is already {self.sb.total} bytes.")
+            return
+        with self.lock.write():
+            self.extend(new_total)
+            self.save()
+        
+    # same as grow but without the checkpoint, the superblock is written first so a crash before
+    # the next checkpoint only leaves the new blocks out of the stored bitmap, which load() repairs
+    def extend(self, new_total: int):
+        self.sb.total = new_total
+        self.disk.resize(new_total)
+        self.disk.write(0, self.sb.pack())
+        self.allocator.grow(self.sb.blocks - len(self.allocator.free))
+        self.pin()
+        
+    # moves the start of the data area so the tree fits in a metadata slot with room to spare
+    # the first blocks of the data area are taken over, used ones are copied elsewhere first
+    # a new slot is at least as large as the whole old metadata area, so the new copy of the tree is written behind it
+    # and a crash before save() writes the superblock loads the old tree and journal, moved files are logged to that journal
+    # when the journal is already full their records are left out and such a crash loses the content of the moved files
+    def grow_metadata(self, size: int):
+        bs = self.block_size
+        slot = max(2 * (size + SLOT_HEADER.size), self.sb.free_start - SUPERBLOCK_SIZE)
+        free_start = -(-(SUPERBLOCK_SIZE + 2 * slot + self.sb.journal_size) // bs) * bs
+        k = (free_start - self.sb.free_start) // bs     # blocks taken from the data area
+        
+        # after the move every used block must fit behind the new start, with as much free space as the move took
+        used = len(self.allocator.free) - self.allocator.free_count
+        required = k + used + k
+        if len(self.allocator.free) < required:
+            self.extend(self.sb.free_start + required * bs)
+        self.cache.clear()  # cached blocks must not be written back over the metadata area later
+        if self.dedup:
+            self.dedup.clear()
+        
+        # reserve the taken blocks so nothing is moved into them
+        in_way = []
+        for i in range(k):
+            if self.allocator.free[i]:
+                self.allocator.mark_used(self.allocator.to_address(i))
+            else:
+                in_way.append(self.allocator.to_address(i))
+        
+        if in_way:
+            in_way = set(in_way)
+            copies = {}     # block in the way -> its copy
+            # the files of snapshots are moved too, in memory until the checkpoint this is for saves their directories
+            # a snapshot that was never saved gets the records of the tree, see Image.encode()
+            trees = [self.root] + [snapshot.root for snapshot in self.snapshots.values() if len(snapshot.image.table)]
+            counts = [RefCounts(bs, snapshot.shared) for snapshot in self.snapshots.values()]
+            bitmaps = [self.held] + [snapshot.used for snapshot in self.snapshots.values()]
+            for file in (file for root in trees for file in self.walk_files(root)):
+                runs = file.blocks.extents()
+                if all(start == HOLE or start >= free_start for start, count in runs):
+                    continue
+                moved = []
+                for start, count in runs:     # only extents that start in the taken blocks are split into blocks
+                    if start == HOLE or start >= free_start:
+                        moved.append((start, count))
+                        continue
+                    for block in range(start, start + count * bs, bs):
+                        if block in copies:     # shared with a file moved before
+                            block = copies[block]
+                        elif block in in_way:
+                            new = self.allocator.allocate()
+                            self.disk.write(new, self.disk.read(block, bs))
+                            for refs in [self.refs] + counts:
+                                refs.move(block, new)
+                            for bits in bitmaps:
+                                bits[self.allocator.to_index(new)] = bits[self.allocator.to_index(block)]
+                            copies[block] = block = new
+                        moved.append((block, 1))
+                file.blocks = BlockMap.from_extents(bs, moved)
+                if self.attached(file):
+                    file.commit(0)
+            for snapshot, refs in zip(self.snapshots.values(), counts):
+                snapshot.shared = refs.items()
+                        
+        self.allocator = Allocator(self.allocator.free[k:], bs, free_start)
+        self.held = self.held[k:]
+        for snapshot in self.snapshots.values():
+            snapshot.used = snapshot.used[k:]
+        self.pin()
+        self.sb.free_start = free_start
+        self.journal = Journal(self.disk, self.sb.journal_start, self.sb.journal_size)
+        self.slots.resize(self.sb.journal_start - SUPERBLOCK_SIZE)
+    
+    # every file in the tree below node
+    def walk_files(self, node=None):
+        for child in (node or self.root).children:
+            if type(child) == File:
+                yield child
+            else:
+                yield from self.walk_files(child)
+
+    @operation
     def open(self, name: str, mode: str) -> File:
         if re.fullmatch(r'[raw]\+?$', mode) is None:    # valid modes are r, a, w, r+, a+, w+
             print(f"Invalid mode: {mode}")
@@ -238,30 +1011,17 @@ class FileSystem:
         elif not found:
             print(f"File {name} does not exist.")
             return
-        elif found in self.opened_files:
-            print(f"File {name} already opened.")
-            return
-        
-        if len(mode) == 2:      # if r+, a+, or w+, both read and write are allowed
-            found.set_mode('all')
-        else:
-            found.set_mode(mode[0])     # only first letter is allowed
-        self.opened_files.append(found)
-        return found
+        return found     # the mode is kept by the session's handle
     
+    # called by sessions when they close a file
     def close(self, file: File):
-        if file in self.opened_files:
-            self.opened_files.remove(file)
-        else:
-            print("File not open.")
-        
-    def print_current_path(self):
-        print("PS /", end='')
-        for dir in self.current_path[1:-1]:
-            print(dir.name, end='/')
-        if len(self.current_path) > 1:
-            print(f"{self.current_path[-1].name}", end='')
-        print("> ", end='')
+        self.cache.on_close()
+            
+    # writes back every cached block and commits the disk
+    def sync(self):
+        self.cache.flush()
+        self.write_log()
+        self.disk.flush()
         
     def print_dir_tree(self, file_details: list[str], node=None, prefix='', is_last=True):
         if not node:
@@ -280,6 +1040,7 @@ class FileSystem:
         else:
             file_details.append(node.get_details())
 
+    @operation
     def show_memory_map(self):
         file_details = []
         self.print_dir_tree(file_details)
@@ -289,7 +1050,23 @@ class FileSystem:
             output += "\nFile Memory\n"
             for details in file_details:
                 output += details + '\n'
+        used, referenced = self.sharing()
+        if self.dedup is not None and used > 0:
+            output += f"\n{referenced} blocks of files are stored in {used} blocks, dedup ratio {referenced / used:.2f}\n"
+        if self.snapshots:
+            output += f"Snapshots keep {self.held.count()} blocks the files no longer use\n"
         return output
             
+    # closes the disk file, the file system cannot be used afterwards
+    def unmount(self):
+        if not hasattr(self, 'cache'):  # __init__ failed before the disk was opened
+            return
+        self.cache.close()
+        if self.queued and not self.disk.file.closed:
+            self.write_log()
+        if self.disk.dirty and not self.disk.file.closed:
+            self.disk.flush()
+        self.disk.close()
+            
     def __del__(self):
-        self.file.close()
\ No newline at end of file
+        self.unmount()
\ No newline at end of file
@@ -0,0 +1,144 @@
+from settings import BLOCK_SIZE, FREE_START
+from bitarray import bitarray
+import bisect
+
+class Allocator:
+    def __init__(self, free: bitarray, block_size: int = BLOCK_SIZE, free_start: int = FREE_START):
+        self.free = free    # True for a free block, this is what gets stored on disk
+        self.block_size = block_size
+        self.free_start = free_start    # address of block 0
+        self.free_count = free.count(True)
+
+        # index of free extents built from the bitmap, sorted by start block
+        self.starts: list[int] = []
+        self.lengths: dict[int, int] = {}
+        pos = free.find(True)
+        while pos != -1:
+            end = free.find(False, pos)
+            if end == -1:
+                end = len(free)
+            self.starts.append(pos)
+            self.lengths[pos] = end - pos
+            pos = free.find(True, end)
+
+    def to_index(self, address: int) -> int:
+        return (address - self.free_start) // self.block_size
+
+    def to_address(self, index: int) -> int:
+        return index * self.block_size + self.free_start
+
+    # returns the start address of a single free block
+    def allocate(self) -> int:
+        return self.allocate_extent(1)[0][0]
+
+    # returns a list of (start address, number of blocks) runs covering n blocks
+    # a single contiguous run is used if one is big enough, otherwise the first free extents are taken in order
+    def allocate_extent(self, n: int) -> list[tuple[int, int]]:
+        if n <= 0:
+            return []
+        if n > self.free_count:
+            raise MemoryError("No free spaces available in file. Consider truncating existing files or formatting a bigger disk.")
+
+        for start in self.starts:
+            if self.lengths[start] >= n:
+                self.take(start, n)
+                return [(self.to_address(start), n)]
+
+        runs = []
+        while n > 0:
+            start = self.starts[0]
+            count = min(n, self.lengths[start])
+            self.take(start, count)
+            runs.append((self.to_address(start), count))
+            n -= count
+        return runs
+
+    # (index, number of blocks) of the first free run at or after block index, None if every block from there is used
+    def free_after(self, index: int) -> tuple[int, int]:
+        i = bisect.bisect_right(self.starts, index) - 1
+        if i >= 0 and self.starts[i] + self.lengths[self.starts[i]] > index:
+            return index, self.starts[i] + self.lengths[self.starts[i]] - index
+        if i + 1 < len(self.starts):
+            return self.starts[i + 1], self.lengths[self.starts[i + 1]]
+        return None
+
+    # removes count blocks from the beginning of the free extent at start
+    def take(self, start: int, count: int):
+        length = self.lengths.pop(start)
+        i = bisect.bisect_left(self.starts, start)
+        if length == count:
+            del self.starts[i]
+        else:
+            self.starts[i] = start + count
+            self.lengths[start + count] = length - count
+        self.free[start:start + count] = False
+        self.free_count -= count
+
+    # marks a run of blocks as used, only for blocks that are known to be free (journal replay)
+    def mark_used(self, address: int, count: int = 1):
+        index = self.to_index(address)
+        i = bisect.bisect_right(self.starts, index) - 1
+        start = self.starts[i]
+        length = self.lengths.pop(start)
+        del self.starts[i]
+
+        # split the extent around the used run
+        if index > start:
+            self.starts.insert(i, start)
+            self.lengths[start] = index - start
+            i += 1
+        if start + length > index + count:
+            self.starts.insert(i, index + count)
+            self.lengths[index + count] = start + length - index - count
+        self.free[index:index + count] = False
+        self.free_count -= count
+
+    def free_extent(self, address: int, count: int = 1):
+        index = self.to_index(address)
+        start, end = index, index + count
+        i = bisect.bisect_left(self.starts, start)
+
+        # merge with the following extent
+        if i < len(self.starts) and self.starts[i] == end:
+            end += self.lengths.pop(self.starts[i])
+            del self.starts[i]
+        # merge with the preceding extent
+        if i > 0 and self.starts[i - 1] + self.lengths[self.starts[i - 1]] == start:
+            start = self.starts[i - 1]
+            self.lengths[start] = end - start
+        else:
+            self.starts.insert(i, start)
+            self.lengths[start] = end - start
+        self.free[index:index + count] = True
+        self.free_count += count
+
+    # adds count free blocks at the end, used when the disk grows
+    def grow(self, count: int):
+        start = len(self.free)
+        extra = bitarray(count)
+        extra.setall(False)
+        self.free.extend(extra)
+        self.free_extent(self.to_address(start), count)
+
+    # frees a list of block addresses, adjacent blocks are returned as whole runs
+    def free_blocks(self, blocks: list[int]):
+        self.free_runs(to_runs(blocks, self.block_size))
+        
+    # frees (start address, number of blocks) runs
+    def free_runs(self, runs: list[tuple[int, int]]):
+        for address, count in runs:
+            self.free_extent(address, count)
+
+# groups block addresses into (start address, number of blocks) runs of adjacent blocks
+def to_runs(blocks: list[int], block_size: int = BLOCK_SIZE) -> list[tuple[int, int]]:
+    runs = []
+    for block in blocks:
+        if runs and runs[-1][0] + runs[-1][1] * block_size == block:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((block, 1))
+    return runs
+
+# expands runs back into a list of block addresses
+def to_blocks(runs: list[tuple[int, int]], block_size: int = BLOCK_SIZE) -> list[int]:
+    return [start + i * block_size for start, count in runs for i in range(count)]
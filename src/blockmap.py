@@ -0,0 +1,198 @@
+from allocator import to_runs
+from array import array
+import bisect
+
+# block addresses of a file, in file order
+# stored as extents of adjacent blocks so a large contiguous file takes a few ints instead of one per block:
+#   starts[i] is the address of the first block of extent i
+#   ends[i] is the number of file blocks up to the end of extent i, bisected to find the extent of a block
+# fragmented files, where the extents would take more space than the addresses themselves, keep a plain
+# array of addresses in flat instead
+# a hole is a range of file blocks with no block on the disk behind it, it reads as zeros
+# its blocks have the address HOLE, which is inside the superblock so no data block has it
+HOLE = 0
+
+class BlockMap:
+    __slots__ = ('block_size', 'starts', 'ends', 'flat', 'extents_count')
+
+    def __init__(self, block_size: int, blocks=()):
+        self.block_size = block_size
+        self.starts = array('Q')
+        self.ends = array('Q')
+        self.flat: array = None
+        self.extents_count = 0      # number of extents, also tracked while the map is flat
+        if blocks:
+            self.append(to_runs(blocks, block_size))
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in BlockMap.__slots__}
+
+    # also reads the instance dicts pickled before the map had slots
+    def __setstate__(self, state):
+        for name in BlockMap.__slots__:
+            setattr(self, name, state[name])
+
+    # builds a map from (start address, number of blocks) runs in one pass, used when loading the tree
+    @staticmethod
+    def from_extents(block_size: int, runs: list[tuple[int, int]]):
+        blocks = BlockMap(block_size)
+        end = 0
+        next_address = None     # address right after the last extent, a run starting there extends it
+        for start, count in runs:
+            if count == 0:
+                continue
+            end += count
+            if start == next_address:   # holes are always extended by holes
+                blocks.ends[-1] = end
+            else:
+                blocks.starts.append(start)
+                blocks.ends.append(end)
+            next_address = start + count * block_size if start != HOLE else HOLE
+        blocks.extents_count = len(blocks.starts)
+        blocks.compact()
+        return blocks
+
+    def __len__(self) -> int:
+        if self.flat is not None:
+            return len(self.flat)
+        return self.ends[-1] if self.ends else 0
+
+    def __getitem__(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("block index out of range")
+        if self.flat is not None:
+            return self.flat[index]
+        i = bisect.bisect_right(self.ends, index)
+        first = self.ends[i - 1] if i > 0 else 0
+        if self.starts[i] == HOLE:
+            return HOLE
+        return self.starts[i] + (index - first) * self.block_size
+
+    def __iter__(self):
+        if self.flat is not None:
+            return iter(self.flat)
+        return (start + i * self.block_size if start != HOLE else HOLE for start, count in self.extents() for i in range(count))
+
+    # (start address, number of blocks) of every extent covering file blocks from first to the end
+    def extents(self, first: int = 0) -> list[tuple[int, int]]:
+        return self.spans(first, len(self) - first)
+
+    # (start address, number of blocks) extents covering count file blocks from first
+    def spans(self, first: int, count: int) -> list[tuple[int, int]]:
+        if count <= 0:
+            return []
+
+        spans = []
+        if self.flat is not None:
+            last = None
+            for block in self.flat[first:first + count]:
+                if last is not None and adjacent(last, block, self.block_size):
+                    spans[-1] = (spans[-1][0], spans[-1][1] + 1)
+                else:
+                    spans.append((block, 1))
+                last = block
+            return spans
+
+        end = first + count
+        i = bisect.bisect_right(self.ends, first)
+        position = first
+        while position < end:
+            extent_first = self.ends[i - 1] if i > 0 else 0
+            length = min(self.ends[i], end) - position
+            start = self.starts[i]
+            spans.append((start + (position - extent_first) * self.block_size if start != HOLE else HOLE, length))
+            position += length
+            i += 1
+        return spans
+
+    # adds (start address, number of blocks) runs at the end of the file, a run starting at HOLE adds a hole
+    def append(self, runs: list[tuple[int, int]]):
+        for start, count in runs:
+            if count == 0:
+                continue
+            contiguous = len(self) > 0 and adjacent(self[-1], start, self.block_size)
+            if not contiguous:
+                self.extents_count += 1
+
+            if self.flat is not None:
+                if start == HOLE:
+                    self.flat.extend([HOLE] * count)
+                else:
+                    self.flat.extend(range(start, start + count * self.block_size, self.block_size))
+            elif contiguous:
+                self.ends[-1] += count
+            else:
+                self.starts.append(start)
+                self.ends.append(len(self) + count)
+        self.compact()
+
+    # keeps the first count blocks, returns the removed ones as (start address, number of blocks) runs
+    def truncate(self, count: int) -> list[tuple[int, int]]:
+        removed = self.extents(count)
+        if self.flat is not None:
+            del self.flat[count:]
+            self.extents_count = len(self.spans(0, count))
+        else:
+            i = bisect.bisect_left(self.ends, count)
+            if i < len(self.ends):
+                self.ends[i] = count
+                if count == (self.ends[i - 1] if i > 0 else 0):   # the extent is now empty
+                    i -= 1
+                del self.starts[i + 1:]
+                del self.ends[i + 1:]
+            self.extents_count = len(self.starts)
+        self.compact()
+        return removed
+
+    # puts (start address, number of blocks) runs in place of as many blocks from first, used to fill and punch holes
+    def replace(self, first: int, runs: list[tuple[int, int]]):
+        count = sum(count for start, count in runs)
+        if self.flat is not None and first + count <= len(self):
+            # only the extents around the replaced blocks can change, they are counted before and after
+            low, high = max(first - 1, 0), min(first + count + 1, len(self))
+            before = len(self.spans(low, high - low))
+            self.flat[first:first + count] = array('Q', (start + i * self.block_size if start != HOLE else HOLE
+                                                         for start, n in runs for i in range(n)))
+            self.extents_count += len(self.spans(low, high - low)) - before
+            self.compact()
+            return
+        tail = self.extents(first + count)
+        self.truncate(first)
+        self.append(runs + tail)
+
+    # copy that later changes to either map do not affect
+    def copy(self):
+        blocks = BlockMap(self.block_size)
+        blocks.starts = array('Q', self.starts)
+        blocks.ends = array('Q', self.ends)
+        blocks.flat = array('Q', self.flat) if self.flat is not None else None
+        blocks.extents_count = self.extents_count
+        return blocks
+
+    # switches to whichever layout is smaller, an extent takes two ints and a flat block one
+    def compact(self):
+        if self.flat is None and 2 * self.extents_count > len(self) + 1:
+            self.flat = array('Q', iter(self))
+            self.starts = array('Q')
+            self.ends = array('Q')
+        elif self.flat is not None and 2 * self.extents_count <= len(self):
+            extents = self.extents()
+            self.flat = None
+            self.starts = array('Q', (start for start, count in extents))
+            self.ends = array('Q')
+            end = 0
+            for start, count in extents:
+                end += count
+                self.ends.append(end)
+
+# whether block follows last in the same extent, blocks of a hole follow each other
+def adjacent(last: int, block: int, block_size: int) -> bool:
+    if last == HOLE or block == HOLE:
+        return last == block
+    return last + block_size == block
+
+# (start address, number of blocks) runs of a list that are on the disk, without the holes
+def allocated(runs: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    return [(start, count) for start, count in runs if start != HOLE]
@@ -0,0 +1,451 @@
+from settings import CACHE_BLOCKS, CACHE_POLICY, FLUSH_INTERVAL
+from disk import Disk
+from blockmap import HOLE
+from collections import OrderedDict
+from itertools import islice
+import threading
+import tempfile
+import bisect
+import os
+
+POLICIES = ('write-through', 'close', 'interval', 'sync')
+
+# LRU cache of data blocks between File and Disk, same read_runs/writev interface as Disk
+# dirty blocks are written back depending on the policy:
+#   write-through - every write goes to the disk immediately, the cache only serves reads
+#   close         - when a file is closed
+#   interval      - every FLUSH_INTERVAL ms from a background thread
+#   sync          - only when FileSystem.sync() is called
+# every policy writes back on checkpoints and when the file system is unmounted
+# while a transaction is open nothing committed is written over, see hold()
+# the lock only guards the bookkeeping, disk reads and writes are done after it is released so threads working on
+# different files do not wait for each other's I/O, a block being written is in writing until its write is done
+class BlockCache:
+    def __init__(self, disk, block_size: int, policy: str = CACHE_POLICY, size: int = CACHE_BLOCKS):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown cache policy {policy}, valid policies are {', '.join(POLICIES)}.")
+        self.disk = disk
+        self.block_size = block_size
+        self.policy = policy
+        self.size = size
+        # block address -> content, least recently used first, the dirty blocks are kept apart so dropping the least
+        # recently used clean block never has to look past dirty ones
+        self.clean: OrderedDict[int, bytearray] = OrderedDict()
+        self.dirty: OrderedDict[int, bytearray] = OrderedDict()
+        self.held = False   # a transaction is open, dirty blocks are not written where they belong, see hold()
+        self.fresh = None   # while held, whether a block was free when the transaction began
+        self.shadow: Disk = None    # while held, file next to the disk the dirty blocks over the size are spilled to
+        self.spilled: dict[int, int] = {}   # block address -> offset of its content in shadow
+        self.slots: list[int] = []  # offsets in shadow that are free again
+        self.shadow_end = 0
+        self.lock = threading.Lock()    # the interval thread flushes while files are written
+        self.io = threading.Condition(self.lock)    # notified when writes to the disk are done
+        self.writing: set[int] = set()  # blocks whose content is being written to the disk
+
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+
+        self.timer = None
+        if policy == 'interval':
+            self.stopped = threading.Event()
+            self.timer = threading.Thread(target=self.flush_periodically, daemon=True)
+            self.timer.start()
+
+    def flush_periodically(self):
+        while not self.stopped.wait(FLUSH_INTERVAL / 1000):
+            self.flush()
+
+    # cached content of block, None if it is not in memory
+    def lookup(self, block: int) -> bytearray:
+        content = self.clean.get(block)
+        if content is not None:
+            self.clean.move_to_end(block)
+            return content
+        content = self.dirty.get(block)
+        if content is not None:
+            self.dirty.move_to_end(block)
+        return content
+
+    def is_dirty(self, block: int) -> bool:
+        return block in self.dirty or block in self.spilled
+
+    # returns the cached content of the blocks in blocks, missing ones are read with one call per run of adjacent blocks
+    def fetch(self, blocks: list[int]) -> list[bytearray]:
+        with self.lock:
+            contents, missing = self.find(blocks)
+        if not missing:
+            return contents
+
+        read = {}
+        for offset, length in self.merge(sorted(set(blocks[i] for i in missing))):
+            data = self.disk.read(offset, length)
+            if length == self.block_size:   # most misses are a single block, kept without copying it
+                read[offset] = data
+                continue
+            for i in range(0, length, self.block_size):
+                read[offset + i] = data[i:i + self.block_size]
+        with self.lock:
+            for i in missing:
+                contents[i] = self.lookup(blocks[i])
+                if contents[i] is None:     # another thread may have read it meanwhile
+                    contents[i] = self.clean[blocks[i]] = read[blocks[i]]
+            job = self.evict()
+        self.write_out(job)
+        return contents
+
+    # cached content of the blocks and the indexes of those to read from the disk, called with the lock held
+    # a block that is not cached while it is written to the disk is waited for, the disk holds its content after that
+    def find(self, blocks: list[int]) -> tuple[list[bytearray], list[int]]:
+        while True:
+            contents = [self.lookup(block) for block in blocks]
+            missing = []
+            for i, block in enumerate(blocks):
+                if contents[i] is None:
+                    if block in self.spilled:
+                        contents[i] = self.unspill(block)
+                    else:
+                        missing.append(i)
+            if not any(blocks[i] in self.writing for i in missing):
+                break
+            self.io.wait()
+        self.hits += len(blocks) - len(missing)
+        self.misses += len(missing)
+        return contents, missing
+
+    # (address, length) runs of sorted block addresses, adjacent blocks in one run
+    def merge(self, blocks: list[int]) -> list[tuple[int, int]]:
+        runs = []
+        for block in blocks:
+            if runs and runs[-1][0] + runs[-1][1] == block:
+                runs[-1] = (runs[-1][0], runs[-1][1] + self.block_size)
+            else:
+                runs.append((block, self.block_size))
+        return runs
+
+    # the block was written with content, the caller may have fetched it before it was evicted or spilled
+    def mark(self, block: int, content: bytearray):
+        self.clean.pop(block, None)
+        if block in self.spilled:
+            self.slots.append(self.spilled.pop(block))
+        self.dirty[block] = content
+        self.dirty.move_to_end(block)
+
+    # blocks touched by runs, in order
+    def blocks_of(self, runs: list[tuple[int, int]]) -> list[int]:
+        blocks = []
+        for offset, length in runs:
+            start = offset - offset % self.block_size
+            blocks.extend(range(start, offset + length, self.block_size))
+        return blocks
+
+    # the pages of a memory-mapped disk are already in memory, a read of blocks that are not dirty is left to the
+    # disk so a single run is returned as a view of the mapping instead of a copy
+    def read_runs(self, runs: list[tuple[int, int]], size: int):
+        if self.size == 0:
+            return self.disk.read_runs(runs, size)
+        if self.disk.mapped:
+            with self.lock:
+                if not any(self.is_dirty(block) or block in self.writing for block in self.blocks_of(runs)):
+                    return self.disk.read_runs(runs, size)
+        buffer = bytearray(size)
+        self.readv(runs, buffer)
+        return buffer
+
+    # reads every run into consecutive parts of buffer
+    def readv(self, runs: list[tuple[int, int]], buffer):
+        if self.size == 0:
+            self.disk.readv(runs, buffer)
+            return
+
+        blocks = self.blocks_of(runs)
+        if len(blocks) > self.size:
+            self.read_direct(runs, buffer, blocks)
+            return
+        # the file lock of the reader keeps the fetched blocks from changing while they are copied
+        view = memoryview(buffer)
+        contents = iter(self.fetch(blocks))
+        pos = 0
+        for offset, length in runs:
+            end = offset + length
+            while offset < end:
+                block_offset = offset % self.block_size
+                count = min(self.block_size - block_offset, end - offset)
+                view[pos:pos + count] = next(contents)[block_offset:block_offset + count]
+                offset += count
+                pos += count
+
+    # a read larger than the cache would only push every block out of it, so it goes straight from the disk into buffer
+    # with one call per run and leaves the cache as it is, the dirty blocks it covers are copied over what was read
+    def read_direct(self, runs: list[tuple[int, int]], buffer, blocks: list[int]):
+        dirty = {}
+        with self.lock:
+            while not self.writing.isdisjoint(blocks):
+                self.io.wait()
+            if self.dirty or self.spilled:
+                for block in blocks:
+                    content = self.dirty.get(block)
+                    if content is None and block in self.spilled:
+                        content = self.shadow.read(self.spilled[block], self.block_size)
+                    if content is not None:
+                        dirty[block] = content
+        self.disk.readv(runs, buffer)
+        if not dirty:
+            return
+        view = memoryview(buffer)
+        pos = 0
+        for offset, length in runs:
+            end = offset + length
+            block = offset - offset % self.block_size
+            while block < end:
+                content = dirty.get(block)
+                if content is not None:
+                    start, stop = max(block, offset), min(block + self.block_size, end)
+                    view[pos + start - offset:pos + stop - offset] = content[start - block:stop - block]
+                block += self.block_size
+            pos += length
+
+    def writev(self, runs: list[tuple[int, int]], data):
+        if self.size == 0:
+            self.disk.writev(runs, data)
+            return
+
+        # blocks written in part are fetched first, they may have to be read from the disk
+        partial = [block for block, block_offset, count in self.pieces(runs) if count < self.block_size]
+        fetched = dict(zip(partial, self.fetch(partial))) if partial else {}
+        view = memoryview(data)
+        pos = 0
+        with self.lock:
+            written = []
+            for block, block_offset, count in self.pieces(runs):
+                if count == self.block_size:    # whole block, no need to read it first
+                    content = bytearray(view[pos:pos + count])
+                else:
+                    content = fetched[block]
+                    content[block_offset:block_offset + count] = view[pos:pos + count]
+                self.mark(block, content)
+                written.append(block)
+                pos += count
+
+            jobs = [self.take(sorted(set(written)))] if self.policy == 'write-through' and not self.held else []
+            jobs.append(self.evict())
+        for job in jobs:
+            self.write_out(job)
+
+    # (block address, offset in the block, length) of every block runs touch, in order
+    def pieces(self, runs: list[tuple[int, int]]):
+        for offset, length in runs:
+            end = offset + length
+            while offset < end:
+                block = offset - offset % self.block_size
+                count = min(self.block_size - (offset - block), end - offset)
+                yield block, offset - block, count
+                offset += count
+
+    # drops least recently used blocks over the size limit, clean ones first, called with the lock held
+    # when only dirty blocks are left the older half of them is written back at once, in runs of adjacent blocks,
+    # and while held they are spilled instead, so the dirty blocks of a transaction never take more than the size either
+    # returns the write for write_out() to do once the lock is released
+    def evict(self):
+        job = None
+        extra = len(self.clean) + len(self.dirty) - self.size
+        if extra > len(self.clean):
+            blocks = list(islice(self.dirty, max(extra - len(self.clean), len(self.dirty) // 2)))
+            job = self.spill(blocks) if self.held else self.take(sorted(blocks), keep=False)
+            extra = len(self.clean) + len(self.dirty) - self.size
+        for _ in range(extra):
+            self.clean.popitem(last=False)
+        return job
+
+    # moves dirty blocks out of memory while held without writing uncommitted content over committed content
+    # blocks that were free when the transaction began are not used by anything committed and are written where they
+    # belong, the others go to the shadow file and are read back from there when used again, release() writes them back
+    # returns the write of the fresh blocks, for write_out()
+    def spill(self, blocks: list[int]):
+        job = self.take(sorted(block for block in blocks if self.fresh(block)), keep=False)
+        rest = sorted(block for block in blocks if block in self.dirty)
+        if not rest:
+            return job
+        if self.shadow is None:
+            disk = os.path.abspath(self.disk.file.name)
+            fd, path = tempfile.mkstemp(prefix=os.path.basename(disk) + '.shadow', dir=os.path.dirname(disk))
+            os.close(fd)
+            self.shadow = Disk(path, create=True)
+        offsets = []
+        for block in rest:
+            if self.slots:
+                offsets.append(self.slots.pop())
+            else:
+                offsets.append(self.shadow_end)
+                self.shadow_end += self.block_size
+        for offset, block in zip(offsets, rest):
+            self.shadow.write(offset, self.dirty.pop(block))
+            self.spilled[block] = offset
+        return job
+
+    # reads a spilled block back into memory, it is still dirty
+    def unspill(self, block: int) -> bytearray:
+        offset = self.spilled.pop(block)
+        self.slots.append(offset)
+        content = self.dirty[block] = self.shadow.read(offset, self.block_size)
+        return content
+
+    # writes the spilled blocks where they belong, a cache full at a time, and removes the shadow file
+    def unshadow(self):
+        with self.lock:
+            if self.shadow is None:
+                return
+            spilled = sorted(self.spilled)
+        step = max(self.size, 1)
+        for i in range(0, len(spilled), step):
+            with self.lock:
+                blocks = [block for block in spilled[i:i + step] if block in self.spilled]
+                data = b''.join(self.shadow.read(self.spilled.pop(block), self.block_size) for block in blocks)
+                self.writing.update(blocks)
+                self.writebacks += len(blocks)
+            self.write_out((blocks, self.merge(blocks), data))
+        with self.lock:
+            self.drop_shadow()
+
+    def drop_shadow(self):
+        if self.shadow is None:
+            return
+        path = self.shadow.file.name
+        self.shadow.close()
+        os.remove(path)
+        self.shadow = None
+        self.spilled.clear()
+        self.slots.clear()
+        self.shadow_end = 0
+
+    # writes back every dirty block, adjacent blocks are written with one call
+    # writes started by other threads are waited for too, everything written before is on the disk when it returns
+    def flush(self):
+        with self.lock:
+            if self.held:
+                return
+            job = self.take(sorted(self.dirty))
+            started = set(self.writing)
+        self.write_out(job)
+        with self.lock:
+            while not self.writing.isdisjoint(started):
+                self.io.wait()
+
+    # writes back the dirty blocks among (start address, number of blocks) runs, before a journal record points to them
+    def write_back(self, runs: list[tuple[int, int]]):
+        with self.lock:
+            if self.held or not self.dirty and not self.writing:
+                return
+            runs = sorted(runs)
+            starts = [start for start, count in runs]
+
+            def within(block: int) -> bool:
+                i = bisect.bisect_right(starts, block) - 1
+                return i >= 0 and block < runs[i][0] + runs[i][1] * self.block_size
+            job = self.take([block for block in sorted(self.dirty) if within(block)])
+        self.write_out(job)
+        with self.lock:
+            while any(within(block) for block in self.writing):
+                self.io.wait()
+
+    # writes back the dirty blocks runs touch, for a worker process that reads or writes them on the disk itself,
+    # see processes.py, with forget the blocks are dropped too as what is cached of them is about to be stale
+    # runs are (disk offset, length), runs in a hole are skipped
+    def hand_over(self, runs: list[tuple[int, int]], forget: bool = False):
+        blocks = self.blocks_of([(offset, length) for offset, length in runs if offset != HOLE])
+        if self.size == 0 or not blocks:
+            return
+        with self.lock:
+            job = self.take([block for block in sorted(blocks) if block in self.dirty], keep=not forget)
+            if forget:
+                for block in blocks:
+                    self.clean.pop(block, None)
+        self.write_out(job)
+        with self.lock:
+            while not self.writing.isdisjoint(blocks):
+                self.io.wait()
+
+    # takes dirty blocks, sorted by address, to be written by write_out() once the lock is released, called with it held
+    # the taken blocks stay cached as clean ones unless keep is False, a block another thread is still writing is
+    # waited for so two writes of one block never race
+    def take(self, blocks: list[int], keep: bool = True) -> tuple:
+        if not blocks:
+            return None
+        while not self.writing.isdisjoint(blocks):
+            self.io.wait()
+        blocks = [block for block in blocks if block in self.dirty]
+        data = b''.join(self.dirty[block] for block in blocks)
+        for block in blocks:
+            content = self.dirty.pop(block)
+            if keep:
+                self.clean[block] = content
+        self.writing.update(blocks)
+        self.writebacks += len(blocks)
+        return blocks, self.merge(blocks), data
+
+    # writes what take() took to the disk, called without the lock
+    def write_out(self, job: tuple):
+        if job is None:
+            return
+        blocks, runs, data = job
+        try:
+            if runs:
+                self.disk.writev(runs, data)
+        finally:
+            with self.lock:
+                self.writing.difference_update(blocks)
+                self.io.notify_all()
+
+    # keeps writes over committed blocks off the disk until release(), so changes of a transaction do not reach the disk
+    # before it commits, blocks written in place would otherwise hold uncommitted content after a crash
+    # fresh(block) tells whether a block was free when the transaction began, such blocks may be written in place
+    def hold(self, fresh=lambda block: False):
+        with self.lock:
+            self.held = True
+            self.fresh = fresh
+
+    # ends hold(), spilled blocks are written back now, the others by the next flush
+    def release(self):
+        with self.lock:
+            self.held = False
+            self.fresh = None
+        self.unshadow()
+        if self.policy == 'write-through':
+            self.flush()
+        with self.lock:
+            job = self.evict()
+        self.write_out(job)
+
+    # called when a file is closed
+    def on_close(self):
+        if self.policy == 'close':
+            self.flush()
+
+    # writes back and forgets every block, used before blocks become part of the metadata area
+    def clear(self):
+        self.flush()
+        with self.lock:
+            self.clean.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'policy': self.policy,
+            'blocks': len(self.clean) + len(self.dirty),
+            'dirty': len(self.dirty) + len(self.spilled),
+            'spilled': len(self.spilled),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writebacks': self.writebacks,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def close(self):
+        if self.timer:
+            self.stopped.set()
+            self.timer.join()
+            self.timer = None
+        self.flush()
+        with self.lock:
+            self.drop_shadow()  # a transaction left open, its changes are lost as if the process had stopped
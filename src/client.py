@@ -0,0 +1,64 @@
+from settings import SOCKET_PATH
+from protocol import FRAME, encode
+import socket
+import sys
+
+# client for server.py, commands use the same syntax as the input_thread<x>.txt scripts
+# usage: python client.py [socket_path], then type commands
+#
+#   with Client() as client:
+#       client.execute("mkdir /docs")
+#       outputs = client.pipeline(["open /docs/a.txt, w", "write_to_file /docs/a.txt, hello", "close /docs/a.txt"])
+class Client:
+    def __init__(self, socket_path: str = SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.stream = self.sock.makefile('rb')
+        self.next_id = 0
+
+    # sends a command without waiting for its output, returns the request id
+    def send(self, command: str) -> int:
+        request_id = self.next_id
+        self.next_id += 1
+        self.sock.sendall(encode(request_id, command))
+        return request_id
+
+    # returns (request id, output) of the oldest request not received yet
+    def receive(self) -> tuple[int, str]:
+        header = self.stream.read(FRAME.size)
+        if len(header) < FRAME.size:
+            raise ConnectionError("The server closed the connection.")
+        length, request_id = FRAME.unpack(header)
+        return request_id, self.stream.read(length).decode()
+
+    def execute(self, command: str) -> str:
+        self.send(command)
+        return self.receive()[1]
+
+    # sends every command before reading any output, the outputs are returned in the same order
+    def pipeline(self, commands: list[str]) -> list[str]:
+        for command in commands:
+            self.send(command)
+        return [self.receive()[1] for _ in commands]
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else SOCKET_PATH
+    with Client(socket_path) as client:
+        for line in sys.stdin:
+            if line.strip().lower() == 'exit':
+                break
+            if line.strip():
+                print(client.execute(line.strip()), end='')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+from settings import DCACHE_SIZE
+from collections import OrderedDict
+import threading
+
+MISS = object()     # returned when a path is not cached, None is a cached 'does not exist'
+
+# bounded LRU cache of resolved paths, keyed by (normalized absolute path, node type)
+class DentryCache:
+    def __init__(self, size: int = DCACHE_SIZE):
+        self.size = size
+        self.entries: OrderedDict[tuple[str, type], object] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.generation = 0     # changes with every invalidation
+
+    def get(self, path: str, t):
+        with self.lock:
+            node = self.entries.get((path, t), MISS)
+            if node is MISS:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end((path, t))
+            return node
+
+    # generation is the value of self.generation before the path was resolved, a lookup that raced with
+    # an invalidation may have seen the tree before the change and is not cached
+    def put(self, path: str, t, node, generation: int):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[(path, t)] = node
+            self.entries.move_to_end((path, t))
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    # removes a single entry, used when a node is created or deleted at path
+    def invalidate(self, path: str, t):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop((path, t), None)
+
+    # removes path and everything below it, used when a directory is moved or deleted
+    def invalidate_tree(self, path: str):
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries if key[0] == path or key[0].startswith(prefix)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
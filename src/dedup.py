@@ -0,0 +1,162 @@
+from blockmap import HOLE
+import hashlib
+import bisect
+
+# blocks that more than one file uses, either because a file was cloned or because dedup found a block with the
+# same content, and the index of block contents that dedup looks blocks up in
+#
+# a shared block is freed once every file using it has let go of it, a file about to write to one gets a copy of
+# its own first, see File.unshare()
+
+# extra references of shared blocks, the number of files using a block minus one
+# kept as runs of adjacent blocks with the same count, so cloning a contiguous file adds one run
+#   starts is sorted, counts[start] is (number of blocks, extra references) of the run at address start
+class RefCounts:
+    def __init__(self, block_size: int, runs=()):
+        self.block_size = block_size
+        self.starts: list[int] = []
+        self.counts: dict[int, tuple[int, int]] = {}
+        self.total = 0      # extra references over all blocks, the blocks saved by sharing
+        for start, count, refs in runs:
+            self.starts.append(start)
+            self.counts[start] = (count, refs)
+            self.total += count * refs
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    # (start address, number of blocks, extra references) of every run, in address order
+    def items(self) -> list[tuple[int, int, int]]:
+        return [(start, *self.counts[start]) for start in self.starts]
+
+    # extra references of the block at address
+    def get(self, address: int) -> int:
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i >= 0:
+            count, refs = self.counts[self.starts[i]]
+            if address < self.starts[i] + count * self.block_size:
+                return refs
+        return 0
+
+    # (start address, number of blocks) parts of count blocks from start that are shared
+    def shared(self, start: int, count: int) -> list[tuple[int, int]]:
+        bs = self.block_size
+        end = start + count * bs
+        parts = []
+        i = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        while i < len(self.starts) and self.starts[i] < end:
+            run, (n, _) = self.starts[i], self.counts[self.starts[i]]
+            low, high = max(run, start), min(run + n * bs, end)
+            if low < high:
+                parts.append((low, (high - low) // bs))
+            i += 1
+        return parts
+
+    # adds delta references to the blocks of (start address, number of blocks) runs
+    # returns the parts that had no extra references, with a negative delta those are the blocks to free
+    def add(self, runs: list[tuple[int, int]], delta: int) -> list[tuple[int, int]]:
+        bs = self.block_size
+        unshared = []
+        for start, count in runs:
+            if start == HOLE or count == 0:
+                continue
+            end = start + count * bs
+            self.cut(start)
+            self.cut(end)
+            i = bisect.bisect_left(self.starts, start)
+            position = start
+            gaps = []
+            while i < len(self.starts) and self.starts[i] < end:
+                run = self.starts[i]
+                n, refs = self.counts[run]
+                if run > position:
+                    gaps.append((position, (run - position) // bs))
+                refs = max(refs + delta, 0)
+                self.total += (refs - self.counts[run][1]) * n
+                if refs == 0:
+                    del self.counts[run]
+                    del self.starts[i]
+                else:
+                    self.counts[run] = (n, refs)
+                    i += 1
+                position = run + n * bs
+            if position < end:
+                gaps.append((position, (end - position) // bs))
+
+            unshared.extend(gaps)
+            if delta > 0:
+                for gap, n in gaps:
+                    bisect.insort(self.starts, gap)
+                    self.counts[gap] = (n, delta)
+                    self.total += n * delta
+            self.merge(start, end)
+        return unshared
+
+    # splits the run containing address so a run starts there
+    def cut(self, address: int):
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i < 0:
+            return
+        start = self.starts[i]
+        count, refs = self.counts[start]
+        if start < address < start + count * self.block_size:
+            k = (address - start) // self.block_size
+            self.counts[start] = (k, refs)
+            self.counts[address] = (count - k, refs)
+            self.starts.insert(i + 1, address)
+
+    # joins adjacent runs with the same count from the run before start to the run after end
+    def merge(self, start: int, end: int):
+        i = max(bisect.bisect_left(self.starts, start) - 1, 0)
+        while i + 1 < len(self.starts) and self.starts[i] <= end:
+            run, following = self.starts[i], self.starts[i + 1]
+            count, refs = self.counts[run]
+            if run + count * self.block_size == following and self.counts[following][1] == refs:
+                self.counts[run] = (count + self.counts.pop(following)[0], refs)
+                del self.starts[i + 1]
+            else:
+                i += 1
+
+    # moves the references of the block at old to the block at new, used when a block is copied elsewhere
+    def move(self, old: int, new: int):
+        refs = self.get(old)
+        if refs:
+            self.add([(old, 1)], -refs)
+            self.add([(new, 1)], refs)
+
+# the block with each content among the blocks written since the disk was opened, when DEDUP is on
+# a block leaves the index before it is written in place or freed, so a block found in it still has that content
+class ContentIndex:
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.blocks: dict[bytes, int] = {}      # digest -> block address
+        self.digests: dict[int, bytes] = {}     # block address -> digest
+
+    @staticmethod
+    def digest(data) -> bytes:
+        return hashlib.sha256(data).digest()
+
+    def find(self, digest: bytes) -> int:
+        return self.blocks.get(digest)
+
+    def add(self, address: int, digest: bytes):
+        self.forget([(address, 1)])
+        if digest not in self.blocks:
+            self.blocks[digest] = address
+            self.digests[address] = digest
+
+    # drops the blocks of (start address, number of blocks) runs
+    def forget(self, runs: list[tuple[int, int]]):
+        if not self.digests:
+            return
+        for start, count in runs:
+            if start == HOLE:
+                continue
+            for address in range(start, start + count * self.block_size, self.block_size):
+                digest = self.digests.pop(address, None)
+                if digest is not None:
+                    del self.blocks[digest]
+
+    def clear(self):
+        self.blocks.clear()
+        self.digests.clear()
@@ -0,0 +1,298 @@
+from settings import DEFRAG_STEP
+from FileSystem import FileSystem
+from nodes import File
+from blockmap import HOLE, allocated
+import bisect
+import sys
+import os
+
+# moves the blocks of files so every file is contiguous and the free space is one run at the end of the data area
+# usage: python defrag.py <file_name> [steps]
+#
+# files are packed one after the other from the start of the data area, in the order of their first block, so files
+# that are already in order do not move. Blocks of other files in the way are moved after the window of the file
+# being packed first. The work is done in steps that move at most DEFRAG_STEP blocks while holding the file system
+# exclusively, so other threads and open files carry on between steps. Every move reaches the disk before it is
+# logged, and the old blocks are only freed after the record, so a crash at any point loses nothing.
+# The blocks of a snapshot never move, so a disk with snapshots is not defragmented until they are deleted.
+
+# fragmentation of the data area, 0 when every file is one run of blocks and the free space one run at the end
+# holes are not counted, a file whose blocks are contiguous around a hole is still one run
+def fragmentation(fs: FileSystem) -> float:
+    with fs.lock.read():
+        files = runs = 0
+        for file in fs.walk_files():
+            with file.lock.read():
+                count = len(pieces(file))
+            files += count > 0
+            runs += count
+        allocator = fs.allocator
+        free = len(allocator.starts)
+        if free and allocator.starts[-1] + allocator.lengths[allocator.starts[-1]] != len(allocator.free):
+            free += 1   # free space that is not at the end counts as one more run
+    ideal = files + (allocator.free_count > 0)
+    return 1 - ideal / (runs + free) if runs + free else 0.0
+
+# (start address, number of blocks) runs of the blocks of a file that are adjacent on the disk
+def pieces(file: File) -> list[tuple[int, int]]:
+    runs = []
+    for start, count in allocated(file.blocks.extents()):
+        if runs and runs[-1][0] + runs[-1][1] * file.fs.block_size == start:
+            runs[-1] = (runs[-1][0], runs[-1][1] + count)
+        else:
+            runs.append((start, count))
+    return runs
+
+# parts of the block range [start, end) that are not in [other_start, other_end)
+def subtract(start: int, end: int, other_start: int, other_end: int) -> list[tuple[int, int]]:
+    parts = [(start, min(end, other_start)), (max(start, other_end), end)]
+    return [(a, b) for a, b in parts if a < b]
+
+class Defragmenter:
+    def __init__(self, fs: FileSystem, step: int = DEFRAG_STEP):
+        self.fs = fs
+        self.step_blocks = step     # blocks moved by one call of step()
+        self.files: list[File] = None   # in the order they are packed, listed by the first step
+        self.listed: set[File] = set()  # the listed files, files created later are added at the end
+        self.index = 0      # next file to pack
+        self.cursor = 0     # block index where it goes, the blocks before it are packed
+        self.moved = 0      # blocks moved so far
+        self.stuck = False  # no free block was left to move a block out of the way
+        # which file uses a block, built from every file and corrected by the blocks moved since
+        # a stale entry is detected when the file no longer has the block, then the index is built again
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        self.owners: list[File] = []
+        self.placed: dict[int, File] = {}
+
+    # moves every file into place and returns the number of blocks moved
+    def run(self) -> int:
+        while self.step():
+            pass
+        return self.moved
+
+    # moves up to step blocks, returns whether there is work left
+    def step(self) -> bool:
+        fs = self.fs
+        if fs.transaction():
+            print("Cannot defragment inside a transaction.")
+            return False
+        if not fs.writable():
+            return False
+        if fs.snapshots:    # their directories would have to be saved again with every step
+            print("Cannot defragment while there are snapshots, their blocks stay where they are.")
+            return False
+        with fs.lock.write():
+            if self.files is None:
+                self.files = []
+                self.add_files()
+            budget = self.step_blocks
+            while budget > 0 and not self.stuck:
+                if self.index == len(self.files) and not self.add_files():
+                    break
+                file = self.files[self.index]
+                moved = self.pack(file, budget) if file.parent is not None else 0
+                if moved == 0:
+                    self.index += 1
+                budget -= moved
+                self.moved += moved
+
+            if fs.checkpoint_due:
+                fs.save()
+            return not self.stuck and (self.index < len(self.files) or self.add_files())
+
+    # lists files that have blocks and were not listed before, in the order of their first block
+    def add_files(self) -> bool:
+        found = []
+        for file in self.fs.walk_files():
+            if file not in self.listed and allocated(file.blocks.extents()):
+                found.append(file)
+                self.listed.add(file)
+        found.sort(key=lambda file: pieces(file)[0][0])
+        self.files.extend(found)
+        return len(found) > 0
+
+    # moves the first block run of file that is out of place, returns the number of blocks moved, 0 once it is in place
+    def pack(self, file: File, budget: int) -> int:
+        allocator = self.fs.allocator
+        total = sum(count for start, count in allocated(file.blocks.extents()))
+        rank = 0    # blocks of the file before the run, holes are not counted
+        position = 0
+        for start, count in file.blocks.extents():
+            if start != HOLE:
+                if allocator.to_index(start) != self.cursor + rank:
+                    return self.place(file, position, min(count, budget), self.cursor + rank, self.cursor + total)
+                rank += count
+            position += count
+        self.cursor += total
+        return 0
+
+    # moves count blocks of file from position, contiguous on the disk, to block index target
+    # blocks of other files in the way are moved after window_end first
+    def place(self, file: File, position: int, count: int, target: int, window_end: int) -> int:
+        allocator = self.fs.allocator
+        source = allocator.to_index(file.blocks[position])
+        if self.shares_itself(file, position, count):
+            # moving every use of the blocks would move the parts of the file already in place again,
+            # so this part gets a copy of its own first, which is then moved like any other
+            spare = allocator.free_after(window_end)
+            if spare is None:
+                print("Not enough free space to defragment, no free block is left after the file being moved.")
+                self.stuck = True
+                return 0
+            n = min(count, spare[1])
+            self.relocate(file, position, n, spare[0], alone=True)
+            return n
+        moved = 0
+        slot = target
+        while slot < target + count:
+            if allocator.free[slot] or source <= slot < source + count:
+                slot += 1
+                continue
+            owner, owner_position, left = self.owner(slot)
+            n = min(left, target + count - slot)
+            spare = allocator.free_after(window_end)
+            if spare is None:
+                print("Not enough free space to defragment, no free block is left after the file being moved.")
+                self.stuck = True
+                return moved
+            n = min(n, spare[1])
+            self.relocate(owner, owner_position, n, spare[0])
+            moved += n
+            slot += n
+        self.relocate(file, position, count, target)
+        return moved + count
+
+    # file using block index, the position of the block in it and how many of its blocks from there are contiguous
+    def owner(self, index: int) -> tuple[File, int, int]:
+        for attempt in range(2):
+            candidates = [self.placed.get(index)]
+            i = bisect.bisect_right(self.starts, index) - 1
+            if i >= 0 and index < self.ends[i]:
+                candidates.append(self.owners[i])
+            for file in candidates:
+                found = file is not None and file.parent is not None and self.locate(file, index)
+                if found:
+                    return (file, *found)
+            self.index_owners()
+        raise ValueError(f"Block {self.fs.allocator.to_address(index)} is marked used but belongs to no file.")
+
+    # (position of block index in file, blocks from it to the end of its extent), None if the file does not have it
+    def locate(self, file: File, index: int):
+        address = self.fs.allocator.to_address(index)
+        bs = self.fs.block_size
+        position = 0
+        for start, count in file.blocks.extents():
+            if start != HOLE and start <= address < start + count * bs:
+                offset = (address - start) // bs
+                return position + offset, count - offset
+            position += count
+        return None
+
+    def index_owners(self):
+        extents = []
+        for file in self.fs.walk_files():
+            for start, count in allocated(file.blocks.extents()):
+                index = self.fs.allocator.to_index(start)
+                extents.append((index, index + count, file))
+        extents.sort(key=lambda extent: extent[0])
+        self.starts = [extent[0] for extent in extents]
+        self.ends = [extent[1] for extent in extents]
+        self.owners = [extent[2] for extent in extents]
+        self.placed = {}
+
+    # whether the file also uses one of the count blocks from position elsewhere
+    def shares_itself(self, file: File, position: int, count: int) -> bool:
+        address = file.blocks[position]
+        if not self.fs.refs.shared(address, count):
+            return False
+        return any(owner is file and owner_position != position for owner, owner_position, offset, n in self.references(address, count))
+
+    # moves count blocks of file from position, contiguous on the disk, to the blocks from index target
+    # the target blocks are free or among the moved ones
+    # blocks the file shares with others are moved for all of them, so they stay shared and their old place is freed
+    # alone only moves them for file at position, the other files keep the old blocks, the target must then be free
+    def relocate(self, file: File, position: int, count: int, target: int, alone: bool = False):
+        fs = self.fs
+        allocator = fs.allocator
+        bs = fs.block_size
+        source = allocator.to_index(file.blocks[position])
+        address = allocator.to_address(source)
+        everyone = not alone and fs.refs.shared(address, count)
+        if everyone:
+            references = self.references(address, count)
+        else:
+            references = [(file, position, 0, count)]
+        data = bytes(fs.cache.read_runs([(address, count * bs)], count * bs))
+        with fs.alloc_lock:
+            for start, end in subtract(target, target + count, source, source + count):
+                allocator.mark_used(allocator.to_address(start), end - start)
+            # the counts of shared blocks move with their content, the freed blocks are then used by no file
+            counts = [fs.refs.get(address + i * bs) for i in range(count)] if everyone else []
+            for i, refs in enumerate(counts):
+                if refs:
+                    fs.refs.add([(address + i * bs, 1)], -refs)
+            for i, refs in enumerate(counts):
+                if refs:
+                    fs.refs.add([(allocator.to_address(target + i), 1)], refs)
+            if fs.dedup:    # blocks among the moved ones get other content
+                fs.dedup.forget([(allocator.to_address(target), count)])
+
+        fs.cache.writev([(allocator.to_address(target), count * bs)], data)
+        fs.cache.flush()    # the content is on the disk before the record that points to it
+        fs.disk.flush()
+        for owner, owner_position, offset, n in references:
+            owner.blocks.replace(owner_position, [(allocator.to_address(target + offset), n)])
+            owner.commit(owner_position)
+            for index in range(target + offset, target + offset + n):
+                self.placed[index] = owner
+        if alone:   # only drops the reference of file, blocks no other file uses are freed
+            fs.free_runs([(address, count)])
+        else:
+            fs.free_runs([(allocator.to_address(start), end - start) for start, end in subtract(source, source + count, target, target + count)])
+
+    # (file, position, offset from address, number of blocks) of every part of a file using the count blocks from address
+    # shared blocks are rare enough that the whole tree is searched for them
+    def references(self, address: int, count: int) -> list[tuple[File, int, int, int]]:
+        bs = self.fs.block_size
+        end = address + count * bs
+        found = []
+        for file in self.fs.walk_files():
+            position = 0
+            for start, n in file.blocks.extents():
+                low, high = max(start, address), min(start + n * bs, end)
+                if start != HOLE and low < high:
+                    found.append((file, position + (low - start) // bs, (low - address) // bs, (high - low) // bs))
+                position += n
+        return found
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python defrag.py <file_name> [steps]")
+        return
+
+    file_name = sys.argv[1]
+    if not os.path.exists(file_name):
+        print(f"Error: {file_name} does not exist.")
+        return
+    try:
+        fs = FileSystem(file_name)
+    except ValueError as e:
+        print(f"Error: {file_name}: {e}")
+        return
+
+    before = fragmentation(fs)
+    defragmenter = Defragmenter(fs)
+    if len(sys.argv) > 2:
+        for _ in range(int(sys.argv[2])):
+            if not defragmenter.step():
+                break
+    else:
+        defragmenter.run()
+    after = fragmentation(fs)
+    fs.save()
+    fs.unmount()
+    print(f"Moved {defragmenter.moved} blocks, fragmentation went from {before:.3f} to {after:.3f}.")
+
+if __name__ == "__main__":
+    main()
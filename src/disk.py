@@ -0,0 +1,138 @@
+from settings import TOTAL_MEMORY
+import mmap
+import os
+
+# positional block I/O on the 'disk' file, a list of runs is read or written with one call per run
+# runs are (disk offset, length) pairs, usually built by File.runs() from adjacent blocks
+class Disk:
+    mapped = False  # reads return views of memory the disk file is mapped to, see MmapDisk
+
+    def __init__(self, file_name: str, create: bool = False):
+        self.file = open(file_name, 'w+b' if create else 'r+b', buffering=0)   # unbuffered, every call is a single syscall
+        self.fd = self.file.fileno()
+        self.dirty = False  # written to since the last flush()
+
+    def read(self, offset: int, size: int) -> bytearray:
+        buffer = bytearray(size)
+        self.readv([(offset, size)], buffer)
+        return buffer
+
+    def write(self, offset: int, data: bytes):
+        self.writev([(offset, len(data))], data)
+
+    # reads every run into consecutive parts of buffer, bytes past the end of the disk file are left as they are
+    def readv(self, runs: list[tuple[int, int]], buffer):
+        view = memoryview(buffer)
+        pos = 0
+        for offset, length in runs:
+            if hasattr(os, 'preadv'):
+                os.preadv(self.fd, [view[pos:pos + length]], offset)
+            else:   # windows has no positional reads
+                self.file.seek(offset)
+                self.file.readinto(view[pos:pos + length])
+            pos += length
+
+    # returns size bytes spread over runs as a single bytes-like object
+    def read_runs(self, runs: list[tuple[int, int]], size: int):
+        buffer = bytearray(size)
+        self.readv(runs, buffer)
+        return buffer
+
+    # writes consecutive parts of data to every run
+    # dirty is set once the data is written, so a flush running meanwhile that missed it leaves it set
+    def writev(self, runs: list[tuple[int, int]], data):
+        view = memoryview(data)
+        pos = 0
+        for offset, length in runs:
+            if hasattr(os, 'pwritev'):
+                os.pwritev(self.fd, [view[pos:pos + length]], offset)
+            else:
+                self.file.seek(offset)
+                self.file.write(view[pos:pos + length])
+            pos += length
+        self.dirty = True
+
+    # makes everything written so far durable, called before and after metadata is written so file content
+    # reaches the disk before the metadata that points to it
+    # dirty is cleared first, a write finished during the flush sets it again
+    def flush(self):
+        self.dirty = False
+        os.fsync(self.fd)
+
+    # another process wrote runs to the disk file, see processes.py, the next flush makes them durable too
+    def written(self, runs: list[tuple[int, int]]):
+        self.dirty = True
+
+    # called when the disk grows, the file itself grows with the first write past its end
+    def resize(self, size: int):
+        pass
+
+    def close(self):
+        self.file.close()
+
+# same interface as Disk, but the disk file is memory-mapped
+# reads of a single run return a memoryview of the mapping instead of a copy, writes are slice assignments
+class MmapDisk(Disk):
+    mapped = True
+
+    def __init__(self, file_name: str, create: bool = False, size: int = TOTAL_MEMORY):
+        super().__init__(file_name, create)
+
+        # the mapping needs the whole disk to exist, the real size is restored on close so the file is
+        # byte-identical to one written by Disk
+        self.end = os.fstat(self.fd).st_size
+        if self.end < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, max(self.end, size))
+
+    def readv(self, runs: list[tuple[int, int]], buffer):
+        view = memoryview(buffer)
+        pos = 0
+        for offset, length in runs:
+            view[pos:pos + length] = memoryview(self.map)[offset:offset + length]
+            pos += length
+
+    def read_runs(self, runs: list[tuple[int, int]], size: int):
+        if len(runs) == 1:
+            offset, length = runs[0]
+            return memoryview(self.map)[offset:offset + length]
+        return super().read_runs(runs, size)
+
+    def writev(self, runs: list[tuple[int, int]], data):
+        view = memoryview(data)
+        pos = 0
+        for offset, length in runs:
+            self.map[offset:offset + length] = view[pos:pos + length]
+            self.end = max(self.end, offset + length)
+            pos += length
+        self.dirty = True
+
+    def written(self, runs: list[tuple[int, int]]):
+        self.end = max([self.end] + [offset + length for offset, length in runs])
+        super().written(runs)
+
+    # msync, called whenever metadata is committed
+    def flush(self):
+        self.dirty = False
+        self.map.flush()
+
+    def resize(self, size: int):
+        if size <= len(self.map):
+            return
+        os.ftruncate(self.fd, size)
+        try:
+            self.map.resize(size)
+        except BufferError:     # returned memoryviews keep the old mapping alive until they are released
+            self.map = mmap.mmap(self.fd, size)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.map.flush()
+        try:
+            self.map.close()
+        except BufferError:     # a returned memoryview is still alive, keep the file at the mapped size
+            self.file.close()
+            return
+        os.ftruncate(self.fd, self.end)
+        self.file.close()
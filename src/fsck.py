@@ -0,0 +1,118 @@
+from FileSystem import FileSystem
+from nodes import Directory, File
+from blockmap import allocated
+from dedup import RefCounts
+from bitarray import bitarray
+import sys
+import os
+
+# checks that the tree, the free bitmap, the counts of shared blocks and the snapshots of a disk agree
+# usage: python fsck.py <file_name> [snapshot]
+# with a snapshot, the disk is mounted read only with that snapshot as its tree and only it is checked
+
+# returns a list of problems, empty if the file system is consistent
+def fsck(fs: FileSystem) -> list[str]:
+    problems = []
+    allocator = fs.allocator
+    owners = check_tree(fs, fs.root, allocator.free, fs.refs, problems)
+
+    # blocks that are used but belong to no file are held for the snapshots
+    leaked = [allocator.to_address(i) for i in allocator.free.search(bitarray('0'))
+              if not fs.held[i] and allocator.to_address(i) not in owners]
+    if leaked:
+        problems.append(f"{len(leaked)} blocks are marked used but belong to no file, starting at {leaked[0]}.")
+    for i in fs.held.search(bitarray('1')):
+        block = allocator.to_address(i)
+        if block in owners:
+            problems.append(f"Block {block} of {owners[block]} is held for snapshots.")
+        if not fs.pinned[i]:
+            problems.append(f"Block {block} is held for snapshots but none of them uses it.")
+
+    for name, snapshot in fs.snapshots.items():
+        used = check_tree(fs, snapshot.root, ~snapshot.used, RefCounts(fs.block_size, snapshot.shared), problems, f"{name}:")
+        unused = [allocator.to_address(i) for i in snapshot.used.search(bitarray('1')) if allocator.to_address(i) not in used]
+        if unused:
+            problems.append(f"{len(unused)} blocks are marked used by snapshot {name} but belong to none of its files, starting at {unused[0]}.")
+        if (snapshot.used & allocator.free).any():
+            problems.append(f"Blocks of snapshot {name} are marked free.")
+
+    if allocator.free_count != allocator.free.count(True):
+        problems.append(f"Free block count is {allocator.free_count} but the bitmap has {allocator.free.count(True)}.")
+    indexed = sum(allocator.lengths[start] for start in allocator.starts)
+    if indexed != allocator.free.count(True) or any(not allocator.free[start] for start in allocator.starts):
+        problems.append("Free extent index does not match the bitmap.")
+
+    return problems
+
+# checks the tree below root against a bitmap of its free blocks and the counts of its shared blocks
+# returns block address -> path of the first file using it, prefix goes before the paths of problems
+def check_tree(fs: FileSystem, root: Directory, free: bitarray, refs: RefCounts, problems: list[str], prefix: str = '') -> dict[int, str]:
+    bs = fs.block_size
+    allocator = fs.allocator
+    owners: dict[int, str] = {}     # block address -> path of the first file using it
+    uses: dict[int, int] = {}   # block address -> number of files using it, for blocks used more than once
+
+    def check_dir(dir: Directory):
+        dir.load()
+        for (t, name), child in dir.entries.items():
+            path = prefix + fs.path_of(child)
+            if type(child) != t or child.name != name:
+                problems.append(f"{path} is listed as {t.__name__} {name}.")
+            if child.parent is not dir:
+                problems.append(f"{path} does not point back to its directory.")
+            if type(child) == Directory:
+                check_dir(child)
+            else:
+                check_file(child, path)
+
+    def check_file(file: File, path: str):
+        if len(file.blocks) != -(-file.size // bs):
+            problems.append(f"{path} has {len(file.blocks)} blocks for {file.size} bytes.")
+        blocks = (block for start, count in allocated(file.blocks.extents()) for block in range(start, start + count * bs, bs))
+        for block in blocks:
+            index = allocator.to_index(block)
+            if (block - fs.sb.free_start) % bs != 0 or not 0 <= index < len(free):
+                problems.append(f"{path} uses block {block} outside the data area.")
+                continue
+            if block in owners:
+                uses[block] = uses.get(block, 1) + 1
+                if refs.get(block) == 0:
+                    problems.append(f"Block {block} is used by both {owners[block]} and {path}.")
+            else:
+                owners[block] = path
+            if free[index]:
+                problems.append(f"Block {block} of {path} is marked free.")
+
+    check_dir(root)
+
+    for start, count, extra in refs.items():
+        for block in range(start, start + count * bs, bs):
+            if uses.get(block, 1) - 1 != extra:
+                problems.append(f"{prefix}Block {block} is counted as used by {extra + 1} files but {uses.get(block, int(block in owners))} use it.")
+    return owners
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python fsck.py <file_name> [snapshot]")
+        return
+
+    file_name = sys.argv[1]
+    if not os.path.exists(file_name):
+        print(f"Error: {file_name} does not exist.")
+        return
+
+    try:
+        fs = FileSystem(file_name, snapshot=sys.argv[2] if len(sys.argv) > 2 else None)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    problems = fsck(fs)
+    fs.unmount()
+
+    for problem in problems:
+        print(problem)
+    print(f"{len(problems)} problem(s) found." if problems else "No problems found.")
+    sys.exit(1 if problems else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+from nodes import Directory, File
+from blockmap import BlockMap, HOLE
+from bitarray import bitarray
+from array import array
+import threading
+import weakref
+import struct
+import zlib
+import sys
+import gc
+
+# binary format of a checkpointed tree, replaces pickling the node objects:
+#   header
+#   directory table  (offset, length, crc32) of the record of every directory number, as little-endian unsigned 64-bit
+#                    triples, unused numbers are all zero, the root is directory 0
+#   free bitmap      the allocator's bitarray, one bit per block of the data area
+#   shared blocks    number of runs, then (start address, number of blocks, extra references) of every run of blocks
+#                    that several files use, as little-endian unsigned 64-bit numbers, see dedup.py
+#   snapshots        number of snapshots, then the name, directory table, shared blocks and used bitmap of each, see snapshot.py
+#   held blocks      bitmap of the blocks that only snapshots use
+#   records          one per directory, its entries with their names and the extents of its files
+#                    a record that is the same in several trees, or for several directories, is stored once
+# everything before the records is the head, which is read when the disk is loaded, every record is read and checked
+# on its own the first time its directory is used, so opening a disk does not depend on the size of the tree
+# a bitmap is stored as its number of bits, a little-endian unsigned 64-bit number, followed by its bytes
+# decoding only reads numbers and strings, a damaged or hostile image raises ValueError instead of running code
+MAGIC = b'TFSI'
+VERSION = 5
+HEADER = struct.Struct('<4sHxxQIQ')     # magic, version, journal seq, directory numbers, free bitmap bits
+RECORD = struct.Struct('<IIII')     # entries, subdirectories, string table bytes, extents
+ENTRY = struct.Struct('<BIHQII')    # kind, name offset, name length, size of a file or number of a directory, first extent, extents
+# a record is the RECORD header, the numbers of its subdirectories as little-endian unsigned 32-bit integers, its entries,
+# the string table and the extent table as little-endian unsigned 64-bit (start address, number of blocks) pairs
+
+# since image version 3 files may have holes, extents that start at HOLE, version 4 added the shared blocks
+# and version 5 the snapshots and held blocks
+# version 1 stored the whole tree as a single inode table and is still read from version 3 disks
+TREE_HEADER = struct.Struct('<4sHxxQIIIQ')  # magic, version, journal seq, inodes, string table bytes, extents, free bitmap bits
+INODE = struct.Struct('<BIIHQII')   # kind, parent inode, name offset, name length, size, first extent, number of extents
+
+DIRECTORY = 0
+FILE = 1
+
+def little_endian(numbers: array) -> array:
+    if sys.byteorder == 'big':
+        numbers.byteswap()
+    return numbers
+
+# the checkpointed tree on the disk, directories are read from it when they are first used and dropped when cold
+class Image:
+    def __init__(self, fs):
+        self.fs = fs
+        self.base = 0   # disk offset of the image, records are read relative to it
+        self.table = array('Q')     # (offset, length, crc32) of every directory number
+        self.lock = threading.Lock()    # one thread reads a record while others wait for it
+        # children of dropped directories that are still used, such as open files, are taken back when the directory
+        # is read again so there is never more than one node for an entry
+        self.orphans = weakref.WeakValueDictionary()
+
+    # reads the head of an image, base is the disk offset of the image
+    # returns (root, free bitmap, journal seq, shared block runs, snapshots, held bitmap), the roots are read on first use
+    # snapshots are (name, image, used bitmap, shared block runs) with images of their own, held is None before version 5
+    def open(self, head: bytes, base: int) -> tuple[Directory, bitarray, int, list, list, bitarray]:
+        if len(head) < TREE_HEADER.size:
+            raise ValueError("Metadata is too short for its header.")
+        magic, version = struct.unpack_from('<4sH', head)
+        if magic != MAGIC:
+            raise ValueError("Metadata is not in the inode format.")
+        if version == 1:
+            return *decode(head, self.fs), [], [], None
+        if version > VERSION:
+            raise ValueError(f"Inode format version {version} is newer than supported version {VERSION}.")
+
+        seq, tables, free, shared, snapshots, held = read_head(head)
+        self.table, self.base = tables[0], base
+        opened = []
+        for (name, used, runs), table in zip(snapshots, tables[1:]):
+            image = Image(self.fs)
+            image.table, image.base = table, base
+            opened.append((name, image, used, runs))
+        return Directory('/', 0, self), free, seq, shared, opened, held
+
+    # returns the checked record of directory number
+    # known holds the records read before by where they are, the images of one disk share them
+    def record(self, number: int, known: dict = None) -> bytes:
+        if not 0 <= number < len(self.table) // 3 or self.table[3 * number + 1] == 0:
+            raise ValueError(f"Directory {number} has no record.")
+        offset, length, crc = self.table[3 * number:3 * number + 3]
+        if known is not None and (offset, length, crc) in known:
+            return known[(offset, length, crc)]
+        if self.base + offset + length > self.fs.sb.journal_start:
+            raise ValueError(f"Record of directory {number} is outside the metadata area.")
+        data = bytes(self.fs.disk.read(self.base + offset, length))
+        if zlib.crc32(data) != crc:
+            raise ValueError(f"Record of directory {number} is damaged.")
+        if known is not None:
+            known[(offset, length, crc)] = data
+        return data
+
+    # fills in the entries of a directory that was not read yet
+    def load(self, dir: Directory):
+        with self.lock:
+            if dir.entries is not None:     # another thread read it first
+                return
+            data = self.record(dir.number)
+            entry_count, subdirs, names_size, extent_count = unpack_record(data)
+            entries_start = RECORD.size + subdirs * 4
+            names_start = entries_start + entry_count * ENTRY.size
+            names = data[names_start:names_start + names_size]
+            extents = little_endian(array('Q', data[names_start + names_size:]))
+
+            entries = {}
+            reuse = len(self.orphans) > 0
+            for kind, name_start, name_length, size, first, count in ENTRY.iter_unpack(data[entries_start:names_start]):
+                if name_start + name_length > names_size:
+                    raise ValueError(f"Name of an entry of directory {dir.number} is outside the string table.")
+                if first + count > extent_count:
+                    raise ValueError(f"Extents of an entry of directory {dir.number} are outside the extent table.")
+                name = names[name_start:name_start + name_length].decode()
+                key = (Directory if kind == DIRECTORY else File, name)
+                # a node still in use since the directory was dropped is newer than its entry in the record
+                node = self.orphans.pop((dir.number, key), None) if reuse else None
+                if node is None:
+                    node = self.node(kind, name, size, extents[2 * first:2 * (first + count)])
+                node.parent = dir
+                entries[key] = node
+            dir.entries = entries
+
+    # creates the node of a record entry, extents are its (start, number of blocks) pairs flattened
+    def node(self, kind: int, name: str, size: int, extents: array):
+        if kind == DIRECTORY:
+            if not 0 < size < len(self.table) // 3:
+                raise ValueError(f"Directory {name} has an invalid number {size}.")
+            return Directory(name, size, self)
+        if kind != FILE:
+            raise ValueError(f"Entry {name} has unknown kind {kind}.")
+
+        bs = self.fs.block_size
+        sb = self.fs.sb
+        runs = list(zip(extents[::2], extents[1::2]))
+        for start, blocks in runs:
+            if start != HOLE and start < sb.free_start or (start - sb.free_start) % bs or start + blocks * bs > sb.total:
+                raise ValueError(f"File {name} has an extent outside the data area.")
+        file = File(name, self.fs)
+        file.size = size
+        file.blocks = BlockMap.from_extents(bs, runs)
+        return file
+
+    # returns the image of the tree below root and the length of its head, the part written to the slot header's checksum
+    # shared is the (start address, number of blocks, extra references) runs of the blocks several files use
+    # snapshots are saved with it, a snapshot that was never saved gets the records of the tree as it is now
+    # held is the bitmap of the blocks only snapshots use
+    def encode(self, root: Directory, free: bitarray, seq: int, shared=(), snapshots=(), held: bitarray = None) -> tuple[bytes, int]:
+        known = {}      # the trees have most records in common, each is read once
+        trees = [self.collect(root, known)]
+        for snapshot in snapshots:
+            trees.append(snapshot.image.collect(snapshot.root, known) if len(snapshot.image.table) else trees[0])
+
+        tables = [array('Q', bytes((max(records) + 1) * 24)) for records in trees]
+        parts = [HEADER.pack(MAGIC, VERSION, seq, len(tables[0]) // 3, len(free)), tables[0],
+                 bitarray(free, endian='big').tobytes(), pack_runs(shared), struct.pack('<Q', len(snapshots))]
+        for snapshot, table in zip(snapshots, tables[1:]):
+            name = snapshot.name.encode()
+            parts += [struct.pack('<H', len(name)) + name + struct.pack('<Q', len(table) // 3), table,
+                      pack_runs(snapshot.shared), pack_bits(snapshot.used)]
+        parts.append(pack_bits(held if held is not None else bitarray()))
+        head_size = sum(len(part) * getattr(part, 'itemsize', 1) for part in parts)
+
+        placed = {}     # record -> (offset, length, crc32) of where it is stored
+        body = []
+        offset = head_size
+        for records, table in zip(trees, tables):
+            for number, record in records.items():
+                if record not in placed:
+                    placed[record] = (offset, len(record), zlib.crc32(record))
+                    body.append(record)
+                    offset += len(record)
+                table[3 * number:3 * number + 3] = array('Q', placed[record])
+
+        head = b''.join(little_endian(part).tobytes() if type(part) == array else part for part in parts)
+        return b''.join([head] + body), head_size
+
+    # the records of the tree below root by directory number, directories created since the last checkpoint get a number
+    # directories that were not read are copied from the current image as they are, see record() for known
+    def collect(self, root: Directory, known: dict = None) -> dict[int, bytes]:
+        records: dict[int, bytes] = {}  # number -> record of directories copied from the current image
+        loaded = []     # directories encoded again
+        numbered = set()
+        root.number = 0
+        queue = [root]
+        for dir in queue:
+            number = dir if type(dir) == int else dir.number
+            if number is not None:
+                if number in numbered:
+                    raise ValueError(f"Directory {number} is in the tree twice.")
+                numbered.add(number)
+            if type(dir) == int or dir.entries is None:
+                records[number] = self.record(number, known)
+                entry_count, subdirs, names_size, extent_count = unpack_record(records[number])
+                queue.extend(little_endian(array('I', records[number][RECORD.size:RECORD.size + subdirs * 4])))
+            else:
+                loaded.append(dir)
+                queue.extend(child for child in dir.entries.values() if type(child) == Directory)
+
+        # directories created since the last checkpoint take the lowest numbers no other directory uses
+        number = 0
+        for dir in loaded:
+            if dir.number is None:
+                while number in numbered:
+                    number += 1
+                dir.number = number
+                dir.image = self
+                numbered.add(number)
+        for dir in loaded:
+            records[dir.number] = encode_record(dir)
+        return records
+
+    # the image returned by encode() is on the disk at base, records are read from it from now on
+    def saved(self, data: bytes, base: int, snapshots=()):
+        seq, tables = read_head(data)[:2]
+        self.table, self.base = tables[0], base
+        for snapshot, table in zip(snapshots, tables[1:]):
+            snapshot.image.table, snapshot.image.base = table, base
+
+    # drops the entries of directories not used since the last call until at most limit directories are loaded
+    # called right after a checkpoint, when every loaded directory is the same as its record
+    # the root and directories with loaded subdirectories are kept, so every loaded directory has a loaded parent
+    def evict(self, root: Directory, limit: int):
+        if root.entries is None:
+            return
+        loaded = [root]
+        for dir in loaded:
+            loaded.extend(child for child in dir.entries.values() if type(child) == Directory and child.entries is not None)
+
+        count = len(loaded)
+        for dir in reversed(loaded[1:]):    # children before their parents
+            if count <= limit:
+                break
+            if dir.used:
+                dir.used = False    # used since the last call, dropped next time unless used again
+                continue
+            if any(type(child) == Directory and child.entries is not None for child in dir.entries.values()):
+                continue
+            for key, child in dir.entries.items():
+                self.orphans[(dir.number, key)] = child
+            dir.entries = None
+            count -= 1
+
+# reads the head of an image of version 2 or later
+# returns (journal seq, directory tables of the tree and of every snapshot, free bitmap, shared block runs,
+# (name, used bitmap, shared block runs) of every snapshot, held bitmap or None before version 5)
+def read_head(head: bytes) -> tuple[int, list[array], bitarray, list, list, bitarray]:
+    magic, version, seq, directories, free_bits = HEADER.unpack_from(head)
+    table, position = read_table(head, HEADER.size, directories)
+    free, position = read_bits(head, position, free_bits)
+    tables, shared, snapshots, held = [table], [], [], None
+    if version >= 4:
+        shared, position = read_runs(head, position)
+    if version >= 5:
+        (count,), position = read_numbers(head, position, 1)
+        for _ in range(count):
+            if len(head) < position + 2:
+                raise ValueError("Metadata is shorter than its header says.")
+            length = struct.unpack_from('<H', head, position)[0]
+            name = bytes(head[position + 2:position + 2 + length]).decode()
+            (directories,), position = read_numbers(head, position + 2 + length, 1)
+            table, position = read_table(head, position, directories)
+            runs, position = read_runs(head, position)
+            (bits,), position = read_numbers(head, position, 1)
+            used, position = read_bits(head, position, bits)
+            tables.append(table)
+            snapshots.append((name, used, runs))
+        (bits,), position = read_numbers(head, position, 1)
+        held, position = read_bits(head, position, bits)
+    return seq, tables, free, shared, snapshots, held
+
+# count little-endian unsigned 64-bit numbers at position of head and the position after them
+def read_numbers(head: bytes, position: int, count: int) -> tuple[array, int]:
+    end = position + count * 8
+    if len(head) < end:
+        raise ValueError("Metadata is shorter than its header says.")
+    return little_endian(array('Q', bytes(head[position:end]))), end
+
+def read_table(head: bytes, position: int, directories: int) -> tuple[array, int]:
+    table, position = read_numbers(head, position, directories * 3)
+    if directories == 0 or table[1] == 0:
+        raise ValueError("The root directory has no record.")
+    return table, position
+
+def read_bits(head: bytes, position: int, bits: int) -> tuple[bitarray, int]:
+    end = position + -(-bits // 8)
+    if len(head) < end:
+        raise ValueError("Metadata is shorter than its header says.")
+    found = bitarray(endian='big')
+    found.frombytes(bytes(head[position:end]))
+    del found[bits:]
+    return found, end
+
+# (start address, number of blocks, extra references) runs stored after their number
+def read_runs(head: bytes, position: int) -> tuple[list, int]:
+    (count,), position = read_numbers(head, position, 1)
+    numbers, position = read_numbers(head, position, count * 3)
+    return list(zip(numbers[::3], numbers[1::3], numbers[2::3])), position
+
+def pack_runs(runs) -> bytes:
+    numbers = array('Q', (number for run in runs for number in run))
+    return struct.pack('<Q', len(numbers) // 3) + little_endian(numbers).tobytes()
+
+def pack_bits(bits: bitarray) -> bytes:
+    return struct.pack('<Q', len(bits)) + bitarray(bits, endian='big').tobytes()
+
+def unpack_record(data: bytes) -> tuple[int, int, int, int]:
+    if len(data) < RECORD.size:
+        raise ValueError("Directory record is too short for its header.")
+    entry_count, subdirs, names_size, extent_count = RECORD.unpack_from(data)
+    if len(data) != RECORD.size + subdirs * 4 + entry_count * ENTRY.size + names_size + extent_count * 16:
+        raise ValueError("Directory record is not as long as its header says.")
+    return entry_count, subdirs, names_size, extent_count
+
+# the record of a loaded directory, its subdirectories must have numbers
+def encode_record(dir: Directory) -> bytes:
+    entries = []
+    subdirs = array('I')
+    names = bytearray()
+    extents = array('Q')
+    for child in dir.entries.values():
+        name = child.name.encode()
+        if type(child) == Directory:
+            subdirs.append(child.number)
+            entries.append(ENTRY.pack(DIRECTORY, len(names), len(name), child.number, 0, 0))
+        else:
+            runs = child.blocks.extents()
+            entries.append(ENTRY.pack(FILE, len(names), len(name), child.size, len(extents) // 2, len(runs)))
+            for start, count in runs:
+                extents.append(start)
+                extents.append(count)
+        names += name
+    header = RECORD.pack(len(entries), len(subdirs), len(names), len(extents) // 2)
+    return b''.join((header, little_endian(subdirs).tobytes(), b''.join(entries), names, little_endian(extents).tobytes()))
+
+# reads a version 1 image, every node is created at once
+# returns (root, free bitmap, journal seq)
+def decode(data: bytes, fs) -> tuple[Directory, bitarray, int]:
+    magic, version, seq, inode_count, names_size, extent_count, free_bits = TREE_HEADER.unpack_from(data)
+    inodes_start = TREE_HEADER.size
+    names_start = inodes_start + inode_count * INODE.size
+    extents_start = names_start + names_size
+    free_start = extents_start + extent_count * 16
+    if inode_count == 0 or len(data) < free_start + -(-free_bits // 8):
+        raise ValueError("Metadata is shorter than its header says.")
+
+    names = bytes(data[names_start:extents_start])
+    extents = little_endian(array('Q', bytes(data[extents_start:free_start])))
+
+    # every node lives as long as the tree, collecting garbage while they are created only costs time
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        nodes = build(data[inodes_start:names_start], names, extents, fs)
+    finally:
+        if collecting:
+            gc.enable()
+
+    free = bitarray(endian='big')
+    free.frombytes(bytes(data[free_start:free_start + -(-free_bits // 8)]))
+    del free[free_bits:]
+    return nodes[0], free, seq
+
+# creates the nodes of a version 1 inode table and links them to their parents
+def build(table: bytes, names: bytes, extents: array, fs) -> list:
+    bs = fs.block_size
+    extent_count = len(extents) // 2
+    nodes = []
+    for kind, parent, name_start, name_length, size, first, count in INODE.iter_unpack(table):
+        if name_start + name_length > len(names):
+            raise ValueError(f"Name of inode {len(nodes)} is outside the string table.")
+        name = names[name_start:name_start + name_length].decode()
+
+        if kind == DIRECTORY:
+            node = Directory(name)
+        elif kind == FILE:
+            if first + count > extent_count:
+                raise ValueError(f"Extents of inode {len(nodes)} are outside the extent table.")
+            runs = [(extents[2 * i], extents[2 * i + 1]) for i in range(first, first + count)]
+            for start, blocks in runs:
+                if start < fs.sb.free_start or (start - fs.sb.free_start) % bs or start + blocks * bs > fs.sb.total:
+                    raise ValueError(f"Inode {len(nodes)} has an extent outside the data area.")
+            node = File(name, fs)
+            node.size = size
+            node.blocks = BlockMap.from_extents(bs, runs)
+        else:
+            raise ValueError(f"Inode {len(nodes)} has unknown kind {kind}.")
+
+        if nodes:   # every inode but the root names an earlier directory as its parent
+            if parent >= len(nodes) or type(nodes[parent]) != Directory:
+                raise ValueError(f"Parent of inode {len(nodes)} is not a directory before it.")
+            nodes[parent].entries[(type(node), name)] = node
+            node.parent = nodes[parent]
+        nodes.append(node)
+
+    if type(nodes[0]) != Directory:
+        raise ValueError("The root is not a directory.")
+    return nodes
@@ -0,0 +1,66 @@
+import pickle
+import struct
+import json
+
+HEADER = struct.Struct('<I')    # length of the record that follows, 0 marks the end of the journal
+
+# the journal occupies the tail of the metadata area, the checkpointed tree is stored before it
+# records are tuples of strings, numbers and lists, stored as json, disks before version 3 pickled them
+class Journal:
+    def __init__(self, disk, start: int, size: int):
+        self.disk = disk
+        self.start = start
+        self.size = size
+        self.end = 0        # offset of the next record relative to self.start
+        self.count = 0      # records written since the last checkpoint
+
+    # empties the journal, called after every checkpoint
+    def reset(self):
+        self.disk.write(self.start, HEADER.pack(0))
+        self.end = 0
+        self.count = 0
+
+    # returns False if the record does not fit, the caller should checkpoint instead
+    def append(self, record) -> bool:
+        return self.extend([record]) == 1
+
+    # appends records in order with a single write, returns how many fit, the ones after the first that does not
+    # fit are left out and the caller should checkpoint instead
+    def extend(self, records: list) -> int:
+        entries = []
+        end = self.end
+        for record in records:
+            data = json.dumps(record, separators=(',', ':')).encode()
+            entry = HEADER.pack(len(data)) + data
+            # leave space for the terminating header
+            if end + len(entry) + HEADER.size > self.size:
+                break
+            entries.append(entry)
+            end += len(entry)
+
+        if entries:
+            self.disk.write(self.start + self.end, b''.join(entries) + HEADER.pack(0))
+        self.end = end
+        self.count += len(entries)
+        return len(entries)
+
+    # records come back as lists, pickled is only for migrating disks of earlier versions
+    def read(self, pickled: bool = False) -> list:
+        region = self.disk.read(self.start, self.size)
+
+        records = []
+        pos = 0
+        while pos + HEADER.size <= len(region):
+            (length,) = HEADER.unpack_from(region, pos)
+            if length == 0 or pos + HEADER.size + length > len(region):
+                break
+            data = bytes(region[pos + HEADER.size:pos + HEADER.size + length])
+            try:
+                records.append(pickle.loads(data) if pickled else json.loads(data))
+            except Exception:   # record was only partially written
+                break
+            pos += HEADER.size + length
+
+        self.end = pos
+        self.count = len(records)
+        return records
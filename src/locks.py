@@ -0,0 +1,88 @@
+from contextlib import contextmanager
+import functools
+import threading
+
+# readers-writer lock, any number of readers or a single writer
+# both sides are reentrant and the writer may also take the read side, but a reader cannot upgrade to a writer
+# waiting writers block new readers so a steady stream of reads cannot starve them
+class RWLock:
+    __slots__ = ('mutex', 'cond', 'readers', 'writer', 'writes', 'waiting')
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.cond: threading.Condition = None   # created by the first thread that has to wait, most locks never do
+        self.readers: dict[int, int] = {}   # thread id -> nested read locks held
+        self.writer: int = None
+        self.writes = 0     # nested write locks held by the writer
+        self.waiting = 0    # writers waiting for the lock
+
+    # the caller holds the mutex
+    def wait(self):
+        if self.cond is None:
+            self.cond = threading.Condition(self.mutex)
+        self.cond.wait()
+
+    def notify(self):
+        if self.cond is not None:
+            self.cond.notify_all()
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self.mutex:
+            if me not in self.readers and self.writer != me:
+                while self.writer is not None or self.waiting:
+                    self.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self.mutex:
+            self.readers[me] -= 1
+            if self.readers[me] == 0:
+                del self.readers[me]
+                if not self.readers:
+                    self.readers.clear()    # gives back the memory the dict grew to
+                self.notify()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self.mutex:
+            if self.writer != me:
+                self.waiting += 1
+                while self.writer is not None or self.readers:
+                    self.wait()
+                self.waiting -= 1
+                self.writer = me
+            self.writes += 1
+
+    def release_write(self):
+        with self.mutex:
+            self.writes -= 1
+            if self.writes == 0:
+                self.writer = None
+                self.notify()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+# runs a FileSystem or File method as one operation, see FileSystem.guard()
+def operation(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        fs = getattr(self, 'fs', self)  # files reach their file system through fs
+        with fs.guard():
+            return method(self, *args, **kwargs)
+    return wrapper
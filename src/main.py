@@ -1,5 +1,8 @@
 from FileSystem import FileSystem
-from nodes import File
+from session import Session, Handle
+from transfer import import_tree, export_tree
+from defrag import Defragmenter, fragmentation
+import processes   # imports this module, its names are only used once both are loaded
 import threading
 import sys
 import csv
@@ -7,41 +10,69 @@ import io
 import os
 import traceback
 
-fs_lock = threading.Lock()
+BASE_DIR = os.path.dirname(__file__)
 
-def run_thread(thread_id):
-    base_dir = os.path.dirname(__file__)
+# returns the lines of input_thread<thread_id>.txt, None if it does not exist
+def read_script(thread_id, base_dir):
     input_file = os.path.join(base_dir, f"input_thread{thread_id}.txt")
-    output_file = os.path.join(base_dir, f"output_thread{thread_id}.txt")
 
     # Check if the input file exists
     if not os.path.exists(input_file):
         print(f"Error: The input file {input_file} does not exist.")
         return
 
-    # Redirect print output
-    buffer = io.StringIO()
-
     with open(input_file, 'r') as infile:
-        commands = infile.readlines()
+        return infile.readlines()
 
-    fs = FileSystem('sample.dat')
+def write_output(thread_id, base_dir, output: str):
+    with open(os.path.join(base_dir, f"output_thread{thread_id}.txt"), 'w') as out:
+        out.write(output)
 
-    with fs_lock:
-        fs.load()  # Ensure exclusive access to disk
+# in batch mode the whole script runs as one transaction, see FileSystem.begin()
+def run_thread(thread_id, base_dir=BASE_DIR, batch=False):
+    commands = read_script(thread_id, base_dir)
+    if commands is None:
+        return
 
+    # Redirect print output
+    buffer = io.StringIO()
+
+    # every thread works on the shared fs, which locks what each command touches
+    # a second FileSystem on the same disk would write to the journal with a stale tree
+    # the current directory and open files belong to the thread's own session
+    session = Session(fs)
+    if batch:
+        fs.begin()
     for command in commands:
         if command.strip().lower() == 'exit':
             break
-        result = execute(command.strip())
+        result = execute(command.strip(), session)
         if result:
             buffer.write(result)
+    session.close_all()
+    end_transaction(batch)
 
-    with open(output_file, 'w') as out:
-        out.write(buffer.getvalue())
+    write_output(thread_id, base_dir, buffer.getvalue())
+    fs.checkpoint()  # so the next run does not have to replay the journal
 
-    with fs_lock:
-        fs.save()  # Write updated state safely
+# a transaction the script left open holds every other thread back, batch mode commits it and otherwise it is aborted
+def end_transaction(commit=False):
+    if fs.transaction():
+        if commit:
+            fs.commit()
+        else:
+            fs.abort()
+
+def run_threads(num_threads, base_dir=BASE_DIR, batch=False):
+    threads = []
+
+    for i in range(num_threads):
+        t = threading.Thread(target=run_thread, args=(i, base_dir, batch))
+        threads.append(t)
+        t.start()
+
+    for t in threads:
+        t.join()
 
 def extract_cmd(str: str):
     i = str.find(' ')
@@ -73,15 +104,29 @@ def arg_to_int(arg):
         print(f"Error converting argument {arg} to integer.")
     return False
 
-fs = FileSystem("sample.dat")
+fs: FileSystem = None   # opened by main(), the server and the stress test set their own
 
 p = ''
-opened_files: dict[str, File] = {}
 
-def execute(command):
+# file content for the output, bytes that are not utf-8 are replaced
+def text(data) -> str:
+    return bytes(data).decode(errors='replace')
+
+# what the handle reads as text, None if the read is refused
+# a read of the mmap backend returns a view of the disk file, it is turned into text while the file system and the file
+# are still held, after that a checkpoint or another thread may give its blocks to something else
+def read_text(handle: Handle, start: int = None, size: int = None) -> str:
+    handle.flush()  # takes the file's write lock
+    with fs.guard(), handle.file.lock.read():
+        data = handle.read(start, size)
+        return None if data is None else text(data)
+
+# paths in commands are relative to the session's current directory, files are named as they were opened
+def execute(command, session: Session):
+    return run(extract_cmd(command), extract_args(command), session)
+
+def run(cmd: str, args: list[str], session: Session):
     output = io.StringIO()
-    cmd = extract_cmd(command)
-    args = extract_args(command)
     l = len(args)
 
     try:
@@ -89,51 +134,55 @@ def execute(command):
             case "create":
                 if warn_args("create", 1, l):
                     return ""
-                fs.create(args[0])
+                fs.create(session.path(args[0]))
                 output.write(f"File {args[0]} created.\n")
 
             case "delete_file":
                 if warn_args("delete_file", 1, l):
                     return ""
-                fs.delete_file(args[0])
+                fs.delete_file(session.path(args[0]))
                 output.write(f"File {args[0]} deleted.\n")
 
             case "delete_dir":
                 if warn_args("delete_dir", 1, l):
                     return ""
-                fs.delete_dir(args[0])
+                fs.delete_dir(session.path(args[0]))
                 output.write(f"Directory {args[0]} deleted.\n")
 
             case "mkdir":
                 if warn_args("mkdir", 1, l):
                     return ""
-                fs.mkdir(args[0])
+                fs.mkdir(session.path(args[0]))
                 output.write(f"Directory {args[0]} created.\n")
 
             case "chdir":
                 if warn_args("chdir", 1, l):
                     return ""
-                fs.chdir(args[0])
+                session.chdir(args[0])
                 output.write(f"Changed current directory to {args[0]}.\n")
 
             case "move_file":
                 if warn_args("move_file", 2, l):
                     return ""
-                fs.move_file(args[0], args[1])
+                fs.move_file(session.path(args[0]), session.path(args[1]))
                 output.write(f"File {args[0]} moved to {args[1]}.\n")
 
+            case "clone_file":
+                if warn_args("clone_file", 2, l):
+                    return ""
+                if fs.clone_file(session.path(args[0]), session.path(args[1])) is not None:
+                    output.write(f"File {args[0]} cloned to {args[1]}.\n")
+
             case "move_dir":
                 if warn_args("move_dir", 2, l):
                     return ""
-                fs.move_dir(args[0], args[1])
+                fs.move_dir(session.path(args[0]), session.path(args[1]))
                 output.write(f"Directory {args[0]} moved to {args[1]}.\n")
 
             case "open":
                 if warn_args("open", 2, l):
                     return ""
-                file = fs.open(args[0], args[1])
-                if file:
-                    opened_files[args[0]] = file
+                if session.open(args[0], args[1]) is not None:
                     output.write(f"File {args[0]} opened in {args[1]} mode.\n")
                 else:
                     output.write(f"Failed to open file {args[0]}.\n")
@@ -141,9 +190,8 @@ def execute(command):
             case "close":
                 if warn_args("close", 1, l):
                     return ""
-                if args[0] in opened_files:
-                    fs.close(opened_files[args[0]])
-                    del opened_files[args[0]]
+                if session.get(args[0]):
+                    session.close(args[0])
                     output.write(f"File {args[0]} closed.\n")
                 else:
                     output.write(f"File {args[0]} is not opened. Cannot close.\n")
@@ -151,55 +199,69 @@ def execute(command):
             case "write_to_file":
                 if l != 2 and l != 3:
                     output.write(f"write_to_file takes 2 or 3 arguments. {l} were provided.\n")
-                    return ""
-                if args[0] not in opened_files:
+                    return output.getvalue()
+                if not session.get(args[0]):
                     output.write(f"{args[0]} is not opened. Cannot write.\n")
-                    return ""
+                    return output.getvalue()
                 if l == 2:
-                    opened_files[args[0]].write_to_file(args[1].strip('"').strip("'"))
+                    session.get(args[0]).write(args[1].strip('"').strip("'"))
                     output.write(f"Data written to file {args[0]}.\n")
                 elif arg_to_int(args[2]):
-                    opened_files[args[0]].write_to_file(args[1].strip('"').strip("'"), int(args[2]))
+                    session.get(args[0]).write(args[1].strip('"').strip("'"), int(args[2]))
                     output.write(f"Data written to file {args[0]} at position {args[2]}.\n")
 
             case "read_from_file":
                 if l != 1 and l != 3:
                     output.write(f"read_from_file takes 1 or 3 arguments. {l} were provided.\n")
-                    return ""
-                if args[0] not in opened_files:
+                    return output.getvalue()
+                if not session.get(args[0]):
                     output.write(f"{args[0]} is not opened. Cannot read.\n")
-                    return ""
+                    return output.getvalue()
                 if l == 1:
-                    output.write(opened_files[args[0]].read_from_file() + '\n')
-                    output.write(f"Data read from file {args[0]}.\n")
+                    data = read_text(session.get(args[0]))
+                    if data is not None:
+                        output.write(data + '\n')
+                        output.write(f"Data read from file {args[0]}.\n")
                 elif arg_to_int(args[1]) and arg_to_int(args[2]):
-                    output.write(opened_files[args[0]].read_from_file(int(args[1]), int(args[2])) + '\n')
-                    output.write(f"Data read from file {args[0]} between positions {args[1]} and {args[2]}.\n")
+                    data = read_text(session.get(args[0]), int(args[1]), int(args[2]))
+                    if data is not None:
+                        output.write(data + '\n')
+                        output.write(f"Data read from file {args[0]} between positions {args[1]} and {args[2]}.\n")
 
             case "move_within_file":
                 if warn_args("move_within_file", 4, l):
                     return ""
-                if args[0] not in opened_files:
+                if not session.get(args[0]):
                     output.write(f"{args[0]} is not opened. Cannot move.\n")
-                    return ""
+                    return output.getvalue()
                 if arg_to_int(args[1]) and arg_to_int(args[2]) and arg_to_int(args[3]):
-                    opened_files[args[0]].move_within_file(int(args[1]), int(args[2]), int(args[3]))
+                    session.get(args[0]).move_within(int(args[1]), int(args[2]), int(args[3]))
                     output.write(f"Moved data within file {args[0]} from {args[1]} to {args[2]} with length {args[3]}.\n")
 
             case "truncate_file":
                 if warn_args("truncate_file", 2, l):
                     return ""
-                if args[0] not in opened_files:
+                if not session.get(args[0]):
                     output.write(f"{args[0]} is not opened. Cannot truncate.\n")
-                    return ""
+                    return output.getvalue()
                 if arg_to_int(args[1]):
-                    opened_files[args[0]].truncate_file(int(args[1]))
+                    session.get(args[0]).truncate(int(args[1]))
                     output.write(f"File {args[0]} truncated to {args[1]} bytes.\n")
 
+            case "punch_hole":
+                if warn_args("punch_hole", 3, l):
+                    return ""
+                if not session.get(args[0]):
+                    output.write(f"{args[0]} is not opened. Cannot punch a hole.\n")
+                    return output.getvalue()
+                if arg_to_int(args[1]) and arg_to_int(args[2]):
+                    session.get(args[0]).punch_hole(int(args[1]), int(args[2]))
+                    output.write(f"Hole punched in file {args[0]} from {args[1]} with length {args[2]}.\n")
+
             case "ls":
                 if warn_args("ls", 0, l):
                     return ""
-                output.write(fs.ls() + '\n')
+                output.write(session.ls() + '\n')
                 output.write("Listing the contents of the current directory.\n")
 
             case "show_memory_map":
@@ -208,6 +270,77 @@ def execute(command):
                 output.write("Displaying memory map.\n")
                 output.write(fs.show_memory_map() + '\n')
 
+            case "import":
+                if warn_args("import", 2, l):
+                    return ""
+                copied = import_tree(fs, args[0], session.path(args[1]))
+                if copied is not None:
+                    output.write(f"Imported {copied[0]} files of {copied[1]} bytes from {args[0]} to {args[1]}.\n")
+
+            case "export":
+                if warn_args("export", 2, l):
+                    return ""
+                copied = export_tree(fs, session.path(args[0]), args[1])
+                if copied is not None:
+                    output.write(f"Exported {copied[0]} files of {copied[1]} bytes from {args[0]} to {args[1]}.\n")
+
+            case "defrag":
+                if warn_args("defrag", 0, l):
+                    return ""
+                before = fragmentation(fs)
+                moved = Defragmenter(fs).run()
+                output.write(f"Moved {moved} blocks, fragmentation went from {before:.3f} to {fragmentation(fs):.3f}.\n")
+
+            case "snapshot":
+                if warn_args("snapshot", 1, l):
+                    return ""
+                if fs.snapshot(args[0]):
+                    output.write(f"Snapshot {args[0]} taken.\n")
+
+            case "list_snapshots":
+                if warn_args("list_snapshots", 0, l):
+                    return ""
+                names = fs.list_snapshots()
+                output.write(("\n".join(names) if names else "No snapshots") + '\n')
+                output.write("Listing the snapshots.\n")
+
+            case "rollback":
+                if warn_args("rollback", 1, l):
+                    return ""
+                if fs.rollback(args[0]):
+                    session.current_path = [fs.root]
+                    output.write(f"Rolled back to snapshot {args[0]}.\n")
+
+            case "delete_snapshot":
+                if warn_args("delete_snapshot", 1, l):
+                    return ""
+                if fs.delete_snapshot(args[0]):
+                    output.write(f"Snapshot {args[0]} deleted.\n")
+
+            case "sync":
+                if warn_args("sync", 0, l):
+                    return ""
+                fs.sync()
+                output.write("Cached file content written to disk.\n")
+
+            case "begin":
+                if warn_args("begin", 0, l):
+                    return ""
+                if fs.begin():
+                    output.write("Transaction started.\n")
+
+            case "commit":
+                if warn_args("commit", 0, l):
+                    return ""
+                if fs.commit():
+                    output.write("Transaction committed.\n")
+
+            case "abort":
+                if warn_args("abort", 0, l):
+                    return ""
+                if fs.abort():
+                    output.write("Transaction aborted.\n")
+
             case "exit":
                 output.write("Exiting the file system simulation.\n")
                 return ""
@@ -221,23 +354,35 @@ def execute(command):
 
     return output.getvalue()
 
+USAGE = "Usage: python main.py <num_threads> [--batch] [--processes] [--snapshot <name>]"
+
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python main.py <num_threads>")
+        print(USAGE)
         return
 
-    num_threads = int(sys.argv[1])
-    threads = []
-
-    for i in range(num_threads):
-        t = threading.Thread(target=run_thread, args=(i,))
-        threads.append(t)
-        t.start()
-
-    for t in threads:
-        t.join()
+    # --snapshot runs the scripts against that snapshot of the disk, mounted read only
+    snapshot = sys.argv[sys.argv.index('--snapshot') + 1] if '--snapshot' in sys.argv[2:-1] else None
+    unknown = [arg for arg in sys.argv[2:] if arg not in ('--batch', '--processes', '--snapshot', snapshot)]
+    if unknown:
+        print(f"Unknown option {unknown[0]}.")
+        print(USAGE)
+        return
+    global fs
+    try:
+        fs = FileSystem("sample.dat", snapshot=snapshot)
+    except ValueError as e:     # a disk of an earlier version or a damaged one, or no such snapshot
+        print(f"Error: {e}")
+        return
 
-    print("All threads finished.")
+    num_threads = int(sys.argv[1])
+    batch = '--batch' in sys.argv[2:]
+    if '--processes' in sys.argv[2:]:
+        processes.run_processes(fs, num_threads, BASE_DIR, batch)
+        print("All processes finished.")
+    else:
+        run_threads(num_threads, batch=batch)
+        print("All threads finished.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,92 @@
+import struct
+import zlib
+
+MAGIC = b'TFSN'
+HEADER = struct.Struct('<4sQQQI')   # magic, generation, length of the data, length of its checked part, crc32 of that part
+# slots written by version 3 disks checksum all of their data
+WHOLE_MAGIC = b'TFSM'
+WHOLE_HEADER = struct.Struct('<4sQQI')  # magic, generation, length of the data, crc32 of the data
+
+# the tree is checkpointed into two slots of the metadata area in turn, each with a generation number and a checksum
+# a checkpoint never overwrites the newest valid copy, so a crash while writing one leaves the previous one loadable
+# only the first part of the data is checksummed here, so loading does not read all of it, the rest checks itself
+class MetadataSlots:
+    def __init__(self, disk, start: int, size: int):
+        self.disk = disk
+        self.start = start
+        self.size = size // 2   # size of one slot
+        self.generation = 0     # generation of the newest valid copy
+        self.current: tuple[int, int] = None    # (disk offset, length) of the newest valid copy, must not be overwritten
+        self.base = 0   # disk offset of the data of the newest copy
+
+    # bytes of data one slot can hold
+    @property
+    def capacity(self) -> int:
+        return self.size - HEADER.size
+
+    def offset(self, slot: int) -> int:
+        return self.start + slot * self.size
+
+    # called when the metadata area grows, the newest copy stays where it is until the next write
+    def resize(self, size: int):
+        self.size = size // 2
+
+    # returns the checked part of the data of the newest valid slot, None if no slot was ever written
+    # raises ValueError if slots were written but none of them is intact
+    def read(self) -> bytes:
+        newest = None
+        written = False
+        for slot in (0, 1):
+            header = self.disk.read(self.offset(slot), HEADER.size)
+            if header[:4] == MAGIC:
+                magic, generation, length, checked, crc = HEADER.unpack(header)
+                base = self.offset(slot) + HEADER.size
+            elif header[:4] == WHOLE_MAGIC:
+                magic, generation, length, crc = WHOLE_HEADER.unpack_from(header)
+                checked = length
+                base = self.offset(slot) + WHOLE_HEADER.size
+            else:
+                continue
+            written = True
+            if length > self.capacity or checked > length or (newest and generation < newest[0]):
+                continue
+            data = bytes(self.disk.read(base, checked))
+            if zlib.crc32(data) == crc:
+                newest = (generation, base, length, data)
+
+        if newest is None:
+            if written:
+                raise ValueError("No intact copy of the metadata was found.")
+            return None
+        self.generation, self.base, length, data = newest
+        self.current = (self.base - HEADER.size, HEADER.size + length)
+        return data
+
+    # marks a copy of the metadata kept in another layout, such as a disk from before the slots existed,
+    # so the first write does not overwrite it
+    def keep(self, offset: int, length: int):
+        self.current = (offset, length)
+
+    # writes data as the next generation into a slot that does not overlap the newest copy, only the first
+    # checked bytes are checksummed, by default all of them
+    # the header goes last, once the data is on the disk, so a slot with an intact header is complete
+    # the caller flushes the disk before and after, the data becomes the newest copy once it is on the disk
+    def write(self, data: bytes, checked: int = None):
+        if len(data) > self.capacity:
+            raise MemoryError(f"Metadata of {len(data)} bytes does not fit in a slot of {self.capacity} bytes.")
+        if checked is None:
+            checked = len(data)
+        length = HEADER.size + len(data)
+        slot = 1
+        for candidate in (0, 1):
+            offset = self.offset(candidate)
+            if self.current is None or offset + length <= self.current[0] or offset >= sum(self.current):
+                slot = candidate
+                break
+
+        self.generation += 1
+        self.disk.write(self.offset(slot) + HEADER.size, data)
+        self.disk.flush()
+        self.disk.write(self.offset(slot), HEADER.pack(MAGIC, self.generation, len(data), checked, zlib.crc32(data[:checked])))
+        self.current = (self.offset(slot), length)
+        self.base = self.offset(slot) + HEADER.size
@@ -0,0 +1,44 @@
+from FileSystem import FileSystem
+from superblock import Superblock, VERSION
+import pickle
+import sys
+import os
+
+# converts disks saved by earlier versions, which pickled the directory tree, to the current inode format
+# usage: python migrate.py <file_name> [file_name ...]
+# unpickling can run code hidden in the disk, only convert disks from a trusted source
+# the old copy of the tree is kept until the new one is on the disk, so an interrupted conversion can be run again
+
+# returns the size of the tree pickled and in the inode format, None if the disk is already in the current format
+def migrate(file_name: str):
+    sb = Superblock.read(file_name)
+    if sb is not None and sb.version >= VERSION:
+        return None
+
+    fs = FileSystem(file_name, migrate=True)   # loading converts the disk
+    pickled = len(pickle.dumps({'free': fs.allocator.free, 'root': fs.root, 'seq': fs.seq}))
+    encoded = len(fs.image.encode(fs.root, fs.allocator.free, fs.seq)[0])
+    fs.unmount()
+    return pickled, encoded
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python migrate.py <file_name> [file_name ...]")
+        return
+
+    for file_name in sys.argv[1:]:
+        if not os.path.exists(file_name):
+            print(f"Error: {file_name} does not exist.")
+            continue
+        try:
+            sizes = migrate(file_name)
+        except ValueError as e:
+            print(f"Error: {file_name}: {e}")
+            continue
+        if sizes is None:
+            print(f"{file_name} is already in the current format.")
+        else:
+            print(f"Converted {file_name}, the tree takes {sizes[1]} bytes instead of {sizes[0]}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+from FileSystem import FileSystem
+import sys
+import os
+
+# creates an empty disk with a chosen geometry
+# usage: python mkfs.py <file_name> <size> [block_size] [metadata_size]
+# sizes can end in K, M or G, for example: python mkfs.py big.dat 4G 4K
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+DEFAULT_BLOCK_SIZE = 4 * 1024
+
+def parse_size(size: str) -> int:
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+# metadata area scales with the disk, 1/64 of it but at least 100 blocks, rounded to whole blocks
+def default_metadata_size(total: int, block_size: int) -> int:
+    return max(100 * block_size, total // 64 // block_size * block_size)
+
+def mkfs(file_name: str, total: int, block_size: int = DEFAULT_BLOCK_SIZE, metadata_size: int = None):
+    if metadata_size is None:
+        metadata_size = default_metadata_size(total, block_size)
+    FileSystem.format(file_name, total, block_size, metadata_size, metadata_size // 4)   # a quarter of the metadata area is journal
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: python mkfs.py <file_name> <size> [block_size] [metadata_size]")
+        return
+
+    file_name = sys.argv[1]
+    if os.path.exists(file_name):
+        print(f"Error: {file_name} already exists.")
+        return
+
+    total = parse_size(sys.argv[2])
+    block_size = parse_size(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_BLOCK_SIZE
+    metadata_size = parse_size(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    try:
+        mkfs(file_name, total, block_size, metadata_size)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    print(f"Created {file_name}: {total} bytes, {block_size} byte blocks.")
+
+if __name__ == "__main__":
+    main()
@@ -1,176 +1,442 @@
-from settings import BLOCK_SIZE, FREE_START
+from blockmap import BlockMap, HOLE, allocated
+from dedup import ContentIndex
+from locks import RWLock, operation
+import threading
+import sys
 
+LOCKS = threading.Lock()    # creating the lock of a node
+
+# nodes use __slots__ instead of an instance dict, millions of them are kept in memory for a large tree
 class TreeNode:
+    __slots__ = ('name', 'parent', '_lock', '__weakref__')
+
     def __init__(self, name):
-        self.name: str = name
+        self.name: str = sys.intern(name)   # the same names repeat across directories
+        self.parent: Directory = None   # needed to find the path of a node when logging changes to it, None once deleted
+        self._lock: RWLock = None
+        
+    # shared for reads, exclusive for changes to the node
+    # most nodes of a large tree are never locked, so the lock is only created when first needed
+    @property
+    def lock(self) -> RWLock:
+        if self._lock is None:
+            with LOCKS:     # two threads must not each give the node a lock
+                if self._lock is None:
+                    self._lock = RWLock()
+        return self._lock
+        
+    # locks cannot be pickled, every loaded node gets a new one
+    def __getstate__(self):
+        return {'name': self.name, 'parent': self.parent}
+    
+    # also reads the instance dicts pickled before nodes had slots
+    def __setstate__(self, state):
+        self.name = state['name']
+        self.parent = state.get('parent')   # missing in trees saved before nodes had parents
+        self._lock = None
 
 class Directory(TreeNode):
-    def __init__(self, name):
+    __slots__ = ('entries', 'number', 'image', 'used')
+
+    # directories of a checkpointed tree are created with their number and image and read when first used, see inodes.py
+    def __init__(self, name, number: int = None, image=None):
         super().__init__(name)
-        self.children: list[TreeNode] = []
+        # children keyed by (type, name) so lookups do not scan, dicts keep insertion order for ls
+        # None until the directory is read from the image
+        self.entries: dict[tuple[type, str], TreeNode] = None if image is not None else {}
+        self.number = number    # number of its record in the image, None until the directory is first checkpointed
+        self.image = image
+        self.used = True    # used since the last eviction, see Image.evict()
+        
+    # a pickled directory must be complete, its number and image belong to the disk it was read from
+    def __getstate__(self):
+        self.load()
+        state = super().__getstate__()
+        state['entries'] = self.entries
+        return state
+
+    # directories pickled before the index existed only have a children list
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if 'children' in state:
+            self.entries = {(type(child), child.name): child for child in state['children']}
+        else:
+            self.entries = state['entries']
+        self.number = None
+        self.image = None
+        self.used = True
+        
+    # reads the entries from the image if they were not read yet, parents first so a loaded directory is always
+    # reachable from the root through loaded directories
+    def load(self):
+        self.used = True
+        if self.entries is None:
+            if self.parent is not None:
+                self.parent.load()
+            self.image.load(self)
+        
+    @property
+    def children(self) -> list[TreeNode]:
+        self.load()
+        with self.lock.read():
+            return list(self.entries.values())
+    
+    def get(self, name: str, t) -> TreeNode:
+        self.load()
+        with self.lock.read():
+            return self.entries.get((t, name))
+    
+    def add(self, node: TreeNode):
+        self.load()
+        with self.lock.write():
+            self.entries[(type(node), node.name)] = node
+            node.parent = self
+        
+    def remove(self, node: TreeNode):
+        self.load()
+        with self.lock.write():
+            del self.entries[(type(node), node.name)]
 
 class File(TreeNode):
+    __slots__ = ('size', 'blocks', 'fs')
+
     def __init__(self, name, fs):
         super().__init__(name)
         self.size: int = 0
-        self.blocks: list[int] = []
-        self.fs = fs
+        self.blocks = BlockMap(fs.block_size)     # extents of the file's blocks, see blockmap.py
+        self.fs = fs    # one slot, deleted files that are still open have no directory to reach it through
         
-    # part of a solution for pickling files - taken from chatGPT
     # pickling causes problems if files contain a reference to FileSystem, which contains a file object
-    # so remove this reference before pickling and add it back after
+    # so the reference is left out and added back by FileSystem.set_fs() after loading
+    # the mode that files saved before sessions kept is dropped
     def __getstate__(self):
-        state = self.__dict__.copy()
-        del state['fs']
+        state = super().__getstate__()
+        state.update(size=self.size, blocks=self.blocks)
         return state
         
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        super().__setstate__(state)
+        self.size = state['size']
+        self.blocks = state['blocks']
         self.fs = None
         
     # returns remaining empty space in the last allocated block
     def last_block_remaining_size(self):
-        if self.size % BLOCK_SIZE == 0 and self.size != 0:
+        if self.size % self.fs.block_size == 0 and self.size != 0:
             return 0
         else:
-            return BLOCK_SIZE - (self.size % BLOCK_SIZE)
+            return self.fs.block_size - (self.size % self.fs.block_size)
     
-    def set_mode(self, mode: str):
-        self.mode = mode
+    # logs the new size and extents of the file, blocks before keep were not changed
+    # they are part of the directory's record, so a directory dropped since the file was opened is read again
+    # released are blocks the file no longer uses, they are freed after the record so a file given them next is logged after it
+    def commit(self, keep: int, released: list[tuple[int, int]] = ()):
+        self.parent.load()
+        extents = self.blocks.extents(keep)
+        self.fs.cache.write_back(allocated(extents))     # the content is on the disk before the record that points to it
+        with self.fs.meta_lock:     # the path must not change before the record is queued
+            self.fs.log('file', self.fs.path_of(self), self.size, keep, extents)
+        if released:
+            self.fs.free_runs(released)
+            
+    # a deleted file may still be open, writing to it would allocate blocks nothing frees
+    # so may a file in a deleted directory or in the tree a rollback replaced, and a disk may be mounted read only
+    def deleted(self) -> bool:
+        if not self.fs.attached(self):
+            print(f"File {self.name} was deleted.")
+            return True
+        return not self.fs.writable()
     
+    @operation
     def append_to_file(self, data: str):
-        if self.mode == 'r':
-            print("Attempt to write in read mode.")
-            return
+        with self.lock.write():
+            if self.deleted():
+                return
+            self.commit(*self.append(data))
 
-        if len(self.blocks) == 0:
-            self.blocks.append(self.fs.allocate())
-            
-        f = self.fs.file
-        if type(data) != bytes:
+    # returns (index of the first block that changed, blocks to free after the record)
+    def append(self, data: str) -> tuple[int, list]:
+        if type(data) == str:
             data = data.encode()
-        last_block_offset = self.size % BLOCK_SIZE
-        remaining = self.last_block_remaining_size()
-        
-        # enough space in current block
-        if len(data) <= remaining:
-            f.seek(self.blocks[-1] + last_block_offset)
-            f.write(data)
-            self.size += len(data)
-        
-        else:   # data more than space in current block
-            this_block_data = data[:remaining]
-            data = data[remaining:]
-            chunk_data = [data[i:i+BLOCK_SIZE] for i in range(0, len(data), BLOCK_SIZE)]    # split the data into chunks the size of a block
-            
-            # fill current last block
-            f.seek(self.blocks[-1] + last_block_offset)
-            f.write(this_block_data)
-            
-            # new blocks
-            for chunk in chunk_data:
-                self.blocks.append(self.fs.allocate())
-                f.seek(self.blocks[-1])
-                f.write(chunk)
-                
-            # + this_block_data as that was removed from data originally
-            self.size += len(data) + len(this_block_data)
-        self.fs.save()
+        self.remember(self.size, len(data))
+        keep, released = self.unshare(self.size, len(data))
+        keep = min(keep, self.reserve(self.size, len(data)))
+        written, deduplicated = self.write_blocks(self.size, data)
+        self.size += len(data)
+        return min(keep, written), released + deduplicated
             
+    @operation
     def write_to_file(self, data: str, write_at: int = None):
         # because python does not support overloading
         if write_at == None:
             self.append_to_file(data)
             return
         
-        if self.mode == 'r':
-            print("Attempt to write in read mode.")
-            return
-        
         if write_at < 0:
             print("Arguments cannot be negative.")
             return
         
-        if len(self.blocks) == 0:
-            self.blocks.append(self.fs.allocate())
+        with self.lock.write():
+            if self.deleted():
+                return
+            if type(data) == str:
+                data = data.encode()
+            elif type(data) == memoryview:  # read from a memory-mapped disk, the blocks it shows may be the ones written
+                data = bytes(data)
+            if data.count(0) == len(data):  # zeros, whole blocks of them are left as a hole
+                self.write_zeros(write_at, len(data))
+                return
+            
+            keep, released = self.prepare(write_at, len(data))
+            written, deduplicated = self.write_blocks(write_at, data)
+            
+            # either the data is still bound within original f size, or it has exceeded
+            # update size accordingly
+            self.size = max(self.size, write_at + len(data))
+            self.commit(min(keep, written), released + deduplicated)
+    
+    # gets the file ready for size bytes to be written at position and returns (index of the first block that changed,
+    # blocks to free after the record)
+    def prepare(self, position: int, size: int) -> tuple[int, list]:
+        # position is after end of file, the bytes up to it read as zeros
+        # what is left of the last block is cleared, whole blocks in between become a hole
+        start = min(position, self.size)
+        self.remember(start, position + size - start)
+        keep, released = self.unshare(start, position + size - start)
+        self.clear(start, position - start)
+        return min(keep, self.reserve(position, size)), released
+    
+    # a write whose data a worker process puts on the disk itself, see processes.py, the caller holds the file's lock
+    # place() returns the (disk offset, length) runs to write size bytes at position to, the blocks are taken out of the
+    # cache so nothing cached is written over them, placed() logs the write once the data is on the disk and the disk
+    # was told about it with Disk.written()
+    def place(self, position: int, size: int) -> tuple[list, int, list]:
+        keep, released = self.prepare(position, size)
+        runs = self.runs(position, size)
+        self.fs.cache.hand_over(runs, forget=True)
+        return runs, keep, released
+    
+    def placed(self, position: int, size: int, keep: int, released: list):
+        self.size = max(self.size, position + size)
+        self.commit(keep, released)
         
-        f = self.fs.file
-        if type(data) != bytes:
-            data = data.encode()
-        last_block_offset = self.size % BLOCK_SIZE
-        remaining = self.last_block_remaining_size()
-        
-        # write_at is after end of file, pad nulls until write_at
-        if write_at >= self.size:
-            # write_at is in the last block
-            if write_at - self.size < remaining:
-                  f.seek(self.blocks[-1] + last_block_offset)
-                  f.write(b'\x00' * (write_at - self.size))      # pad null bytes
-                  
-            else:   # write_at is further ahead, more blocks are needed
-                f.seek(self.blocks[-1] + last_block_offset)
-                f.write(b'\x00' * remaining)   # fill last block
-                
-                for i in range((write_at - self.size) // BLOCK_SIZE):   # new null blocks
-                    this_block = self.fs.allocate()
-                    self.blocks.append(this_block)
-                    f.seek(this_block)
-                    f.write(b'\x00' * BLOCK_SIZE)
-                
-                self.blocks.append(self.fs.allocate())
-                f.seek(self.blocks[-1])
-                f.write(b'\x00' * (write_at % BLOCK_SIZE))       # last block partially null
+    # inside a transaction, keeps what a write of size bytes at position is about to change so abort can put it back
+    # bytes past the end of the file are kept too, they are still in the last block and a truncate may be undone
+    def remember(self, position: int, size: int):
+        if self.fs.transaction() is None:
+            return
+        old_size, old_blocks = self.size, self.blocks.copy()
+        size = max(0, min(size, len(old_blocks) * self.fs.block_size - position))
+        old = bytes(self.read_blocks(position, size))
+        
+        def undo():     # blocks allocated by the write are freed by the undo reserve() added after this one
+            self.blocks = old_blocks
+            self.overwrite(position, old)
+            self.size = old_size
+        self.fs.on_abort(undo)
             
-            # f now contains padded nulls upto relevant point, simply writing data remains
-            self.size = write_at
-            self.write_to_file(data)      # same logic as normal writing
+    # makes sure there are blocks behind size bytes from position and returns the index of the first block that changed
+    # blocks between the last block and position are left as a hole, holes inside the range are given blocks
+    def reserve(self, position: int, size: int) -> int:
+        bs = self.fs.block_size
+        first = position // bs
+        end = -(-(position + size) // bs)   # ceil division
+        keep = len(self.blocks)
+        if first > keep:
+            self.blocks.append([(HOLE, first - keep)])
         
-        else:
-            start_block = write_at // BLOCK_SIZE
-            start_block_offset = write_at % BLOCK_SIZE
+        fresh = []  # (first block, number of blocks) of the ranges that get new blocks
+        index = first
+        for start, count in self.blocks.spans(first, min(end, len(self.blocks)) - first):
+            if start == HOLE:
+                fresh.append((index, count))
+            index += count
+        if end > len(self.blocks):
+            fresh.append((len(self.blocks), end - len(self.blocks)))
+        if not fresh:
+            return keep
+        
+        for index, count in fresh:
+            runs = self.fs.allocate_extent(count)
+            self.fs.on_abort(lambda runs=runs: self.fs.free_runs(runs))
+            if index < len(self.blocks):
+                self.blocks.replace(index, runs)
+            else:
+                self.blocks.append(runs)
+        
+        # new blocks still hold what was written to them before, the parts the write does not cover must read as zeros
+        # past the end of the file that is done by whatever extends the file over them
+        if fresh[0][0] == first:
+            self.clear(first * bs, position - first * bs)
+        if sum(fresh[-1]) == end:
+            self.clear(position + size, min(end * bs, self.size) - position - size)
+        return min(keep, fresh[0][0])
             
-            required_size = write_at + len(data)
-            # add new blocks if required
-            while required_size > len(self.blocks) * BLOCK_SIZE:
-                self.blocks.append(self.fs.allocate())
+    # gives the file a copy of its own of the shared blocks behind size bytes from position before they are written to,
+    # the other files and snapshots keep the old ones, and drops its blocks there from the dedup index as their content is changing
+    # only blocks the range covers in part are copied, the others are about to be written over
+    # returns (index of the first block that changed, blocks to free after the record)
+    def unshare(self, position: int, size: int) -> tuple[int, list]:
+        fs = self.fs
+        bs = fs.block_size
+        first = position // bs
+        end = min(-(-(position + size) // bs), len(self.blocks))
+        keep = len(self.blocks)
+        # without dedup only a clone of this file, which waits for its lock, can share more of its blocks,
+        # and snapshots are only taken while no file is being written
+        if first >= end or (not fs.refs and fs.dedup is None and not fs.snapshots):
+            return keep, []
+        
+        shared = []     # (file block index, start address, number of blocks)
+        index = first
+        with fs.alloc_lock:
+            for start, count in self.blocks.spans(first, end - first):
+                if start != HOLE:
+                    for part, n in fs.shared_parts(start, count):
+                        shared.append((index + (part - start) // bs, part, n))
+                    if fs.dedup:
+                        fs.dedup.forget([(start, count)])
+                index += count
+        
+        released = []
+        for index, start, n in shared:
+            runs = fs.allocate_extent(n)
+            fs.on_abort(lambda runs=runs: fs.free_runs(runs))
+            self.blocks.replace(index, runs)
+            for i in range(index, index + n):
+                if i * bs < position or (i + 1) * bs > position + size:
+                    old = start + (i - index) * bs
+                    fs.cache.writev([(self.blocks[i], bs)], fs.cache.read_runs([(old, bs)], bs))
+            released.append((start, n))
+            keep = min(keep, index)
+        return keep, released
             
-            # write remaining start block data
-            start_block_data = data[:(BLOCK_SIZE - start_block_offset)]
-            data = data[(BLOCK_SIZE - start_block_offset):]
-            f.seek(self.blocks[start_block] + start_block_offset)
-            f.write(start_block_data)
+    # writes data over the file's blocks starting at position, the blocks must already be allocated and unshared
+    # with dedup, whole blocks whose content a block written before already has are shared with that block instead
+    # returns (index of the first block that changed, blocks to free after the record)
+    def write_blocks(self, position: int, data: bytes) -> tuple[int, list]:
+        fs = self.fs
+        if fs.dedup is None:
+            fs.cache.writev(self.runs(position, len(data)), data)
+            return len(self.blocks), []
+        
+        bs = fs.block_size
+        view = memoryview(data)
+        first = -(-position // bs)
+        end = (position + len(data)) // bs
+        digests = {i: ContentIndex.digest(view[i * bs - position:(i + 1) * bs - position]) for i in range(first, end)}
+        found = {}  # file block index -> block with the same content
+        seen = {}   # digest -> first index with it in this write, later ones share its block once it is written
+        with fs.alloc_lock:
+            for i, digest in digests.items():
+                block = fs.dedup.find(digest)
+                if block is None and digest in seen:
+                    block = self.blocks[seen[digest]]
+                if block is not None and block != self.blocks[i]:
+                    found[i] = block
+                    fs.refs.add([(block, 1)], 1)
+                else:
+                    seen.setdefault(digest, i)
+        if not found:
+            fs.cache.writev(self.runs(position, len(data)), data)
+        else:
+            for block in found.values():
+                fs.on_abort(lambda block=block: fs.free_runs([(block, 1)]))
+            # the parts between found blocks are written as usual
+            pos = position
+            for i in sorted(found) + [None]:
+                stop = position + len(data) if i is None else i * bs
+                if stop > pos:
+                    fs.cache.writev(self.runs(pos, stop - pos), view[pos - position:stop - position])
+                pos = stop + bs
+        
+        released = []
+        with fs.alloc_lock:
+            for i, digest in digests.items():
+                if i in found:
+                    released.append((self.blocks[i], 1))
+                    self.blocks.replace(i, [(found[i], 1)])
+                else:
+                    fs.dedup.add(self.blocks[i], digest)
+        return min(found, default=len(self.blocks)), released
+        
+    # writes data from position over the blocks the file has, the parts in holes or after the last block are left out
+    def overwrite(self, position: int, data: bytes):
+        size = min(len(data), len(self.blocks) * self.fs.block_size - position)
+        if size <= 0:
+            return
+        runs, parts = [], []
+        pos = 0
+        for offset, length in self.runs(position, size):
+            if offset != HOLE:
+                runs.append((offset, length))
+                parts.append(data[pos:pos + length])
+            pos += length
+        if runs:
+            if self.fs.dedup:   # the blocks no longer have the content they were indexed with
+                bs = self.fs.block_size
+                blocks = [(offset - (offset - self.fs.sb.free_start) % bs, length) for offset, length in runs]
+                with self.fs.alloc_lock:
+                    self.fs.dedup.forget([(start, -(-(offset + length - start) // bs)) for (start, _), (offset, length) in zip(blocks, runs)])
+            self.fs.cache.writev(runs, b''.join(parts))
             
-            # split remaining data into chunks
-            chunk_data = [data[i:i+BLOCK_SIZE] for i in range(0, len(data), BLOCK_SIZE)]
+    # zeros size bytes from position in the blocks the file has, holes already read as zeros
+    def clear(self, position: int, size: int):
+        size = min(size, len(self.blocks) * self.fs.block_size - position)
+        if size > 0:
+            self.overwrite(position, bytes(size))
             
-            # write chunks
-            for i in range(len(chunk_data)):
-                f.seek(self.blocks[i + start_block + 1])
-                f.write(chunk_data[i])
+    # zeros size bytes from position like writing zeros would, without writing the blocks that can be a hole instead
+    def write_zeros(self, position: int, size: int):
+        self.punch_hole(position, size)
+        if position + size > self.size:
+            self.truncate_file(position + size)
             
-            # either the data is still bound within original f size, or it has exceeded
-            # update size accordingly
-            self.size = max(self.size, write_at + len(data) + len(start_block_data))
-        self.fs.save()
+    # reads size bytes from position, holes read as zeros
+    def read_blocks(self, position: int, size: int):
+        runs = self.runs(position, size)
+        if all(offset != HOLE for offset, length in runs):
+            return self.fs.cache.read_runs(runs, size)
+        buffer = bytearray(size)
+        self.fill(position, buffer)
+        return buffer
         
-    def read_entire_file(self) -> bytes:
-        if self.mode != 'r' and self.mode != 'all':
-            print("Attempt to read in wrong mode.")
-            return
-        
-        f = self.fs.file
-        data = b''
-        remaining = self.size
-        for block in self.blocks:
-            f.seek(block)
-            if remaining > BLOCK_SIZE:
-                data += f.read(BLOCK_SIZE)
+    # reads len(buffer) bytes from position into buffer, the parts in holes are zeroed
+    def fill(self, position: int, buffer):
+        view = memoryview(buffer)
+        pos = 0
+        for offset, length in self.runs(position, len(view)):
+            if offset == HOLE:
+                view[pos:pos + length] = bytes(length)
             else:
-                data += f.read(remaining)
-            remaining -= BLOCK_SIZE
+                self.fs.cache.readv([(offset, length)], view[pos:pos + length])
+            pos += length
+        
+    # returns the (disk offset, length) runs holding size bytes from position, one run per extent
+    # runs in a hole have the offset HOLE
+    def runs(self, position: int, size: int) -> list[tuple[int, int]]:
+        if size == 0:
+            return []
+        
+        block_size = self.fs.block_size
+        first = position // block_size
+        last = (position + size - 1) // block_size
+        runs = [(start, count * block_size) for start, count in self.blocks.spans(first, last - first + 1)]
+        
+        # the first and last blocks may only be partly covered
+        skip = position - first * block_size
+        start, length = runs[0]
+        runs[0] = (start + skip if start != HOLE else HOLE, length - skip)
+        runs[-1] = (runs[-1][0], runs[-1][1] - ((last + 1) * block_size - (position + size)))
+        return runs
         
-        return data
+    @operation
+    def read_entire_file(self) -> bytes:
+        # a single buffer is filled in place, one read per contiguous run
+        with self.lock.read():
+            return self.read_blocks(0, self.size)
 
+    @operation
     def read_from_file(self, start: int = None, size: int = None) -> bytes:
         # overloading
         if start == None and size == None:
@@ -180,60 +446,144 @@ class File(TreeNode):
             print("Arguments cannot be negative.")
             return
         
-        if self.mode != 'r' and self.mode != 'all':
-            print("Attempt to read in wrong mode.")
-            return
-        
-        if start > self.size:   # reading outside file
-            return b''
-        
-        if start + size > self.size:
-            size = self.size - start
-        
-        f = self.fs.file
-        start_block = start // BLOCK_SIZE
-        start_block_offset = start % BLOCK_SIZE
+        with self.lock.read():
+            if start > self.size:   # reading outside file
+                return b''
+            
+            if start + size > self.size:
+                size = self.size - start
+            
+            return self.read_blocks(start, size)
     
-        data = b''
-        remaining = size
-        current_block = start_block
-
-        while remaining > 0 and current_block < len(self.blocks):
-            f.seek(self.blocks[current_block])
-            block_data = f.read(BLOCK_SIZE)
-
-            # if start block, remove initial data before start
-            if current_block == start_block:
-                block_data = block_data[start_block_offset:]
-
-            data += block_data[:remaining]  # slices trailing data from last block, otherwise appends entire block to data
-            remaining -= len(block_data[:remaining])
-            current_block += 1
-
-        return data
+    # reads into buffer from position and returns the number of bytes read, fewer than it holds at the end of the file
+    # a caller reading a large file in parts reuses one buffer instead of getting a new bytes object each time
+    @operation
+    def readinto(self, position: int, buffer) -> int:
+        if position < 0:
+            print("Arguments cannot be negative.")
+            return 0
+        with self.lock.read():
+            size = max(0, min(len(buffer), self.size - position))
+            self.fill(position, memoryview(buffer)[:size])
+            return size
     
+    @operation
     def move_within_file(self, source, dest, size):
         if source < 0 or dest < 0 or size < 0:
             print("Arguments cannot be negative.")
             return
         
-        data = self.read_from_file(source, size)
-        self.write_to_file(b'\x00' * size, source)
-        self.write_to_file(data, dest)
+        with self.lock.write():     # no other write may come between the three steps
+            if self.deleted():
+                return
+            bs = self.fs.block_size
+            if source % bs == 0 and dest % bs == 0 and size % bs == 0 and 0 < size and source + size <= self.size:
+                self.remap(source // bs, dest // bs, size // bs)
+                return
+            data = bytes(self.read_from_file(source, size))     # a view of a memory-mapped disk would see the zeros
+            self.write_zeros(source, size)
+            self.write_to_file(data, dest)
+            
+    # moves count whole blocks from block index source to dest by changing the block map instead of copying their content
+    # the blocks at source become a hole and the blocks dest had are freed
+    def remap(self, source: int, dest: int, count: int):
+        old_size, old_blocks = self.size, self.blocks.copy()
+        def undo():
+            self.blocks = old_blocks
+            self.size = old_size
+        self.fs.on_abort(undo)
+        
+        # what is left of the last block is cleared when the blocks land past the end, as a write there would
+        bs = self.fs.block_size
+        keep, released = len(self.blocks), []
+        if dest * bs > self.size:
+            self.remember(self.size, dest * bs - self.size)
+            keep, released = self.unshare(self.size, dest * bs - self.size)
+            self.clear(self.size, dest * bs - self.size)
+        
+        runs = self.blocks.spans(source, count)
+        self.blocks.replace(source, [(HOLE, count)])
+        if dest > len(self.blocks):
+            self.blocks.append([(HOLE, dest - len(self.blocks))])
+        released += allocated(self.blocks.spans(dest, min(count, len(self.blocks) - dest)))
+        self.blocks.replace(dest, runs)
+        self.size = max(self.size, (dest + count) * bs)
+        self.commit(min(keep, source, dest), released)
+            
+    # frees the blocks that lie entirely within length bytes from offset and leaves a hole in their place
+    # the parts of the blocks at either end are zeroed, the size of the file does not change
+    @operation
+    def punch_hole(self, offset: int, length: int):
+        if offset < 0 or length < 0:
+            print("Arguments cannot be negative.")
+            return
+        
+        with self.lock.write():
+            if self.deleted():
+                return
+            end = min(offset + length, self.size)
+            if offset >= end:
+                return
+            bs = self.fs.block_size
+            first = -(-offset // bs)
+            last = end // bs if end < self.size else len(self.blocks)     # nothing after the end of the file is read
+            
+            self.remember(offset, end - offset)
+            removed = []
+            if first >= last:
+                keep, released = self.unshare(offset, end - offset)
+                self.clear(offset, end - offset)
+            else:
+                keep, released = self.unshare(offset, first * bs - offset)
+                tail_keep, tail_released = self.unshare(last * bs, end - last * bs)
+                keep, released = min(keep, tail_keep), released + tail_released
+                self.clear(offset, first * bs - offset)
+                self.clear(last * bs, end - last * bs)
+                removed = allocated(self.blocks.spans(first, last - first))
+                if removed:
+                    self.blocks.replace(first, [(HOLE, last - first)])
+                    keep = min(keep, first)
+            self.commit(keep, released + removed)
     
+    @operation
     def truncate_file(self, size):
-        start_block = size // BLOCK_SIZE
-        if size % BLOCK_SIZE != 0:
+        start_block = size // self.fs.block_size
+        if size % self.fs.block_size != 0:
             start_block += 1
             
-        for i in range(start_block, len(self.blocks)):
-            self.fs.free_spaces[(self.blocks[i] - FREE_START) // BLOCK_SIZE] = True
-        self.blocks = self.blocks[:start_block]
-        self.size = size
-        self.fs.save()
+        with self.lock.write():
+            if not self.fs.writable():
+                return
+            old_size = self.size
+            if size > old_size:
+                # the new bytes read as zeros, what is left of the last block is cleared and new blocks are a hole
+                self.remember(old_size, size - old_size)
+                keep, released = self.unshare(old_size, size - old_size)
+                self.clear(old_size, size - old_size)
+                if start_block > len(self.blocks):
+                    self.blocks.append([(HOLE, start_block - len(self.blocks))])
+                self.size = size
+            else:
+                removed = self.blocks.truncate(start_block)
+                self.size = size
+                keep = len(self.blocks)
+                released = removed  # whole extents are freed at once, after the record as in punch_hole()
+                
+                def undo():     # the removed blocks are only freed when the transaction commits
+                    self.blocks.append(removed)
+                    self.size = old_size
+                self.fs.on_abort(undo)
+            if self.parent is not None:
+                self.commit(keep, released)
+            else:
+                self.fs.free_runs(released)
         
     def get_details(self):
-        details = f"{self.name} of {self.size} bytes"
-        if len(self.blocks) > 0:
-            details += f" at blocks {self.blocks}"
-        return details
\ No newline at end of file
+        with self.lock.read():
+            details = f"{self.name} of {self.size} bytes"
+            if len(self.blocks) > 0:
+                # a hole has no blocks on the disk, it is shown as a hole instead of blocks at address 0
+                extents = ", ".join(f"(hole, {count})" if start == HOLE else f"({start}, {count})"
+                                    for start, count in self.blocks.extents())
+                details += f" in extents [{extents}]"
+            return details
\ No newline at end of file
@@ -0,0 +1,206 @@
+from FileSystem import FileSystem
+from session import Session
+from disk import Disk
+from blockmap import HOLE
+from contextlib import ExitStack
+import main as commands
+import multiprocessing
+import threading
+import io
+
+# runs the input_thread<x>.txt scripts from worker processes against the disk this process has mounted
+# this process owns the metadata: it has the only tree of the disk, takes the locks, allocates the blocks and logs the
+# records, a second FileSystem on the same disk would write to the journal with a stale tree
+# a worker reads and parses its own script and writes its own output file, the data of write_to_file and read_from_file
+# goes between the worker and the disk file directly, at the disk offsets this process hands it while it holds the
+# file's lock, every other command runs here with the worker's session on a thread of its own
+# so are writes this process has to see the data of: with dedup, in a transaction, or of zeros, which become holes
+# a worker sends commands without waiting for their outputs and only waits for the offsets of a write or read
+#
+#   worker                              this process
+#   ('run', cmd, args)              ->  output of the command
+#   ('write', name, position, size) ->  runs to write to, None to send the command instead
+#   ('written',)                    ->  the write is logged and the file unlocked
+#   ('read', name, start, size)     ->  runs to read from, holes have the offset HOLE, None to send the command instead
+#   ('done',)                       ->  the file is unlocked
+#   None                            ->  the script is done
+
+# in batch mode every script runs as one transaction, see FileSystem.begin()
+def run_processes(fs: FileSystem, num_processes: int, base_dir: str, batch: bool = False):
+    commands.fs = fs    # the command set of main.py is used as it is
+    workers = []
+    for i in range(num_processes):
+        ours, theirs = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=work, args=(i, base_dir, fs.disk.file.name, theirs))
+        process.start()
+        workers.append((process, ours))
+
+    # the workers are started first, a process forked while the threads run could inherit a lock one of them holds
+    threads = [threading.Thread(target=serve, args=(conn, batch)) for process, conn in workers]
+    for thread in threads:
+        thread.start()
+    for (process, conn), thread in zip(workers, threads):
+        process.join()
+        thread.join()
+    fs.checkpoint()     # so the next run does not have to replay the journal
+
+# runs the requests of one worker with its own session
+def serve(conn, batch: bool):
+    session = Session(commands.fs)
+    if batch:
+        commands.fs.begin()
+    try:
+        while (request := conn.recv()) is not None:
+            match request[0]:
+                case 'run':
+                    conn.send(commands.run(request[1], request[2], session))
+                case 'write':
+                    place_write(conn, session, *request[1:])
+                case 'read':
+                    place_read(conn, session, *request[1:])
+    except EOFError:    # the worker stopped
+        pass
+    session.close_all()
+    commands.end_transaction(batch)
+
+# hands the worker the runs to write size bytes at position to, or at the end of the file when position is None
+def place_write(conn, session: Session, name: str, position: int, size: int):
+    fs = commands.fs
+    handle = session.get(name)
+    if handle is None or handle.mode == 'r' or fs.read_only or fs.dedup or fs.transaction():
+        conn.send(None)
+        return
+    handle.flush()
+    file = handle.file
+    with ExitStack() as held:
+        held.enter_context(fs.guard())
+        held.enter_context(file.lock.write())
+        if not fs.attached(file):
+            conn.send(None)
+            return
+        position = file.size if position is None else position
+        runs, keep, released = file.place(position, size)
+        conn.send(runs)
+        conn.recv()
+        fs.disk.written(runs)
+        file.placed(position, size, keep, released)
+    handle.offset = position + size
+
+# hands the worker the runs holding size bytes from start, or the whole file when start is None
+def place_read(conn, session: Session, name: str, start: int, size: int):
+    fs = commands.fs
+    handle = session.get(name)
+    if handle is None or handle.mode not in ('r', 'all') or fs.transaction():     # held blocks stay off the disk
+        conn.send(None)
+        return
+    handle.flush()
+    file = handle.file
+    with ExitStack() as held:
+        held.enter_context(fs.guard())
+        held.enter_context(file.lock.read())
+        if start is None:
+            start, size = 0, file.size
+        size = max(0, min(size, file.size - start))
+        runs = file.runs(start, size)
+        fs.cache.hand_over(runs)
+        conn.send(runs)
+        conn.recv()
+    handle.offset = start + size
+
+# a worker process, runs the script of thread_id against the disk file through conn
+def work(thread_id: int, base_dir: str, disk_file: str, conn):
+    lines = commands.read_script(thread_id, base_dir)
+    if lines is None:
+        conn.send(None)
+        return
+    worker = Worker(conn, Disk(disk_file))
+    for line in lines:
+        line = line.strip()
+        if line.lower() == 'exit':
+            break
+        worker.execute(line)
+    conn.send(None)
+    worker.drain()
+    worker.disk.close()
+    commands.write_output(thread_id, base_dir, worker.output.getvalue())
+
+class Worker:
+    def __init__(self, conn, disk: Disk):
+        self.conn = conn
+        self.disk = disk
+        self.output = io.StringIO()
+        self.pending = 0    # commands sent whose outputs were not received yet
+
+    def execute(self, line: str):
+        cmd, args = commands.extract_cmd(line), commands.extract_args(line)
+        if cmd == 'write_to_file' and self.write(args) or cmd == 'read_from_file' and self.read(args):
+            return
+        self.conn.send(('run', cmd, args))
+        self.pending += 1
+
+    # adds the outputs of the commands sent so far to the output
+    def drain(self):
+        while self.pending:
+            self.output.write(self.conn.recv())
+            self.pending -= 1
+
+    # answer to the last request, it comes after the outputs of the commands sent before it
+    def receive(self):
+        self.drain()
+        return self.conn.recv()
+
+    # returns False when the command has to run in the owner instead, which also reports what is wrong with it
+    def write(self, args: list[str]) -> bool:
+        if len(args) != 2 and len(args) != 3:
+            return False
+        try:
+            position = int(args[2]) if len(args) == 3 else None
+        except ValueError:
+            return False
+        data = args[1].strip('"').strip("'").encode()
+        if position is not None and position < 0 or data.count(0) == len(data):
+            return False
+
+        self.conn.send(('write', args[0], position, len(data)))
+        runs = self.receive()
+        if runs is None:
+            return False
+        self.disk.writev(runs, data)
+        self.conn.send(('written',))
+        if position is None:
+            self.output.write(f"Data written to file {args[0]}.\n")
+        else:
+            self.output.write(f"Data written to file {args[0]} at position {args[2]}.\n")
+        return True
+
+    def read(self, args: list[str]) -> bool:
+        if len(args) == 1:
+            start = size = None
+        elif len(args) == 3:
+            try:
+                start, size = int(args[1]), int(args[2])
+            except ValueError:
+                return False
+            if start < 0 or size < 0:
+                return False
+        else:
+            return False
+
+        self.conn.send(('read', args[0], start, size))
+        runs = self.receive()
+        if runs is None:
+            return False
+        buffer = bytearray(sum(length for offset, length in runs))  # holes stay zeros
+        view = memoryview(buffer)
+        pos = 0
+        for offset, length in runs:
+            if offset != HOLE:
+                self.disk.readv([(offset, length)], view[pos:pos + length])
+            pos += length
+        self.conn.send(('done',))
+        self.output.write(commands.text(buffer) + '\n')
+        if start is None:
+            self.output.write(f"Data read from file {args[0]}.\n")
+        else:
+            self.output.write(f"Data read from file {args[0]} between positions {args[1]} and {args[2]}.\n")
+        return True
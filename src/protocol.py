@@ -0,0 +1,12 @@
+import struct
+
+# framing used between server.py and client.py
+# every request and response is a header followed by a utf-8 payload, the payload of a request is one command in the
+# input_thread<x>.txt syntax and the payload of its response is the command's output
+# responses carry the id of their request and come back in the order the requests were sent
+FRAME = struct.Struct('<II')    # payload length, request id
+MAX_PAYLOAD = 16 * 1024 * 1024  # larger frames close the connection
+
+def encode(request_id: int, text: str) -> bytes:
+    payload = text.encode()
+    return FRAME.pack(len(payload), request_id) + payload
@@ -0,0 +1,144 @@
+from settings import SOCKET_PATH
+from FileSystem import FileSystem
+from session import Session
+from protocol import FRAME, MAX_PAYLOAD, encode
+from concurrent.futures import ThreadPoolExecutor
+import main as commands
+import asyncio
+import threading
+import signal
+import io
+import socket
+import sys
+import os
+
+# serves one file system to many clients over a unix domain socket, see protocol.py for the framing
+# usage: python server.py [disk_file] [socket_path]
+# every connection has its own session and a thread that runs its commands, so a slow write does not stall other
+# connections and a transaction, which belongs to a thread, stays with its connection
+# a client may send requests without waiting for responses, the requests of one connection run one after another
+class Server:
+    def __init__(self, fs: FileSystem, socket_path: str = SOCKET_PATH):
+        self.fs = fs
+        self.socket_path = socket_path
+        self.output = Output(sys.stdout)
+        commands.fs = fs    # the command set of main.py is used as it is
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = Session(self.fs)
+        executor = ThreadPoolExecutor(1)
+        queue = asyncio.Queue()
+        responder = asyncio.create_task(self.respond(queue, session, executor, writer))
+
+        # reading goes on while commands run, so pipelined requests are queued instead of waiting in the socket
+        try:
+            while True:
+                length, request_id = FRAME.unpack(await reader.readexactly(FRAME.size))
+                if length > MAX_PAYLOAD:
+                    print(f"Request of {length} bytes is too large, closing the connection.")
+                    break
+                payload = await reader.readexactly(length)
+                await queue.put((request_id, payload.decode(errors='replace')))
+        except (asyncio.IncompleteReadError, ConnectionError):   # client disconnected
+            pass
+
+        await queue.put(None)
+        await responder
+        await asyncio.get_running_loop().run_in_executor(executor, self.disconnect, session)
+        executor.shutdown()
+        writer.close()
+
+    async def respond(self, queue: asyncio.Queue, session: Session, executor: ThreadPoolExecutor, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        connected = True
+        while (request := await queue.get()) is not None:
+            request_id, command = request
+            output = await loop.run_in_executor(executor, self.output.capture, commands.execute, command.strip(), session)
+            if not connected:
+                continue
+            try:
+                writer.write(encode(request_id, output))
+                await writer.drain()
+            except ConnectionError:     # the remaining requests still run, their outputs are dropped
+                connected = False
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            if in_use(self.socket_path):
+                raise OSError(f"A server is already listening on {self.socket_path}.")
+            os.remove(self.socket_path)     # left behind by a server that did not stop cleanly
+
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        print(f"Serving on {self.socket_path}.")
+
+        # stops on ctrl+c or kill, the caller then checkpoints and unmounts
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        sys.stdout = self.output
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            sys.stdout = self.output.stdout
+
+    # closes what the client left open, an unfinished transaction is aborted
+    def disconnect(self, session: Session):
+        session.close_all()
+        commands.end_transaction()
+
+    def close(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+# sys.stdout while serving, the file system reports refused operations with print()
+# what a command prints on a connection's thread goes back to its client in front of the command's output,
+# anything else printed still goes to the console
+class Output:
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()  # buffer of the command running on each thread
+
+    def write(self, text: str) -> int:
+        buffer = getattr(self.local, 'buffer', None)
+        return (self.stdout if buffer is None else buffer).write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+    # runs a command and returns what it printed followed by its output
+    def capture(self, execute, *args) -> str:
+        self.local.buffer = io.StringIO()
+        try:
+            output = execute(*args)
+        finally:
+            printed, self.local.buffer = self.local.buffer.getvalue(), None
+        return printed + output
+
+def in_use(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+            return True
+        except OSError:
+            return False
+
+def main():
+    file_name = sys.argv[1] if len(sys.argv) > 1 else "sample.dat"
+    socket_path = sys.argv[2] if len(sys.argv) > 2 else SOCKET_PATH
+
+    try:
+        fs = FileSystem(file_name)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    server = Server(fs, socket_path)
+    try:
+        asyncio.run(server.serve())
+    finally:
+        server.close()
+        fs.checkpoint()
+        fs.unmount()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+from settings import CHUNK_BLOCKS
+from nodes import Directory, File
+import os
+
+# an open file, the mode belongs to the handle so one file can be open in different modes by different sessions
+# besides the commands it can be used as a stream: seek() and tell() move the offset, readinto() and iterating over
+# the handle read from it, write_chunk() writes at it, so a large file passes through in a fixed amount of memory
+class Handle:
+    def __init__(self, file: File, mode: str):
+        self.file = file
+        self.mode = mode    # r, w, a or all
+        self.offset = 0     # position after the last read or write
+        # written with write_chunk() but not yet passed to the file, less than CHUNK_BLOCKS whole blocks past the first
+        # block boundary and what is written of the block after them
+        self.pending = bytearray()
+
+    def readable(self) -> bool:
+        if self.mode != 'r' and self.mode != 'all':
+            print("Attempt to read in wrong mode.")
+            return False
+        return True
+
+    def writable(self) -> bool:
+        if self.mode == 'r':
+            print("Attempt to write in read mode.")
+            return False
+        return True
+
+    def write(self, data: str, write_at: int = None):
+        if not self.writable():
+            return
+        self.flush()
+        self.file.write_to_file(data, write_at)
+        size = len(data.encode()) if type(data) == str else len(data)
+        self.offset = self.file.size if write_at is None else write_at + size
+
+    def read(self, start: int = None, size: int = None) -> bytes:
+        if not self.readable():
+            return
+        self.flush()
+        data = self.file.read_from_file(start, size)
+        if data is not None:
+            self.offset = (start or 0) + len(data)
+        return data
+
+    def move_within(self, source: int, dest: int, size: int):
+        if self.writable():
+            self.flush()
+            self.file.move_within_file(source, dest, size)
+
+    def truncate(self, size: int):
+        if self.writable():
+            self.flush()
+            self.file.truncate_file(size)
+            self.offset = min(self.offset, size)
+
+    def punch_hole(self, offset: int, length: int):
+        if self.writable():
+            self.flush()
+            self.file.punch_hole(offset, length)
+
+    def tell(self) -> int:
+        return self.offset
+
+    # moves the offset like os.lseek, whence is os.SEEK_SET, os.SEEK_CUR or os.SEEK_END, returns the new offset
+    # the offset may go past the end of the file, writing there leaves a hole
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self.flush()
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.offset, os.SEEK_END: self.file.size}.get(whence)
+        if base is None:
+            print(f"Invalid whence: {whence}")
+        elif base + offset < 0:
+            print("Arguments cannot be negative.")
+        else:
+            self.offset = base + offset
+        return self.offset
+
+    # reads from the offset into buffer and returns the number of bytes read, 0 at the end of the file
+    def readinto(self, buffer) -> int:
+        if not self.readable():
+            return 0
+        self.flush()
+        count = self.file.readinto(self.offset, buffer)
+        self.offset += count
+        return count
+
+    # yields the content from the offset to the end of the file in parts of size bytes, rounded to whole blocks
+    # the first part ends at a block boundary, so every read after it covers whole blocks
+    def chunks(self, size: int = None):
+        if not self.readable():
+            return
+        self.flush()
+        bs = self.file.fs.block_size
+        size = max(bs, (size or CHUNK_BLOCKS * bs) // bs * bs)
+        while True:
+            buffer = bytearray(size - self.offset % bs)
+            count = self.file.readinto(self.offset, buffer)
+            if count == 0:
+                return
+            self.offset += count
+            yield buffer if count == len(buffer) else buffer[:count]
+
+    def __iter__(self):
+        return self.chunks()
+
+    # writes data at the offset, or at the end of the file in append mode, and moves the offset after it
+    # whole blocks are passed to the file CHUNK_BLOCKS at a time, in one write and one journal record, the rest stays
+    # in the handle until more data completes a chunk or flush() is called, so many small writes are not each a write
+    def write_chunk(self, data):
+        if not self.writable():
+            return
+        if type(data) == str:
+            data = data.encode()
+        if not self.pending and self.mode == 'a':
+            self.offset = self.file.size
+        self.pending += data
+        self.offset += len(data)
+
+        start = self.offset - len(self.pending)
+        bs = self.file.fs.block_size
+        complete = self.offset // bs * bs - start   # bytes up to the last block boundary
+        if complete >= CHUNK_BLOCKS * bs:
+            self.file.write_to_file(bytes(self.pending[:complete]), start)
+            del self.pending[:complete]
+
+    # passes the data kept by write_chunk() to the file, called before anything else reads or changes it through the handle
+    def flush(self):
+        if self.pending:
+            data = bytes(self.pending)
+            self.pending.clear()
+            self.file.write_to_file(data, self.offset - len(data))
+
+# state of one thread or client: its current directory and the files it has open
+# paths given to a session are relative to its own current directory
+class Session:
+    def __init__(self, fs):
+        self.fs = fs
+        self.current_path: list[Directory] = [fs.root]
+        self.handles: dict[int, Handle] = {}    # file descriptor -> open file
+        self.names: dict[str, int] = {}     # name a file was opened with -> file descriptor
+
+    # absolute path of path
+    def path(self, path: str) -> str:
+        if self.fs.is_abs(path):
+            return path
+        if not self.fs.attached(self.current_path[-1]):
+            print("Current directory was deleted, returning to /.")
+            self.current_path = [self.fs.root]
+        return self.fs.path_of(self.current_path[-1]).rstrip('/') + '/' + path
+
+    def chdir(self, path: str):
+        # to go backwards
+        if path == ".." and len(self.current_path) > 1:
+            self.current_path.pop()
+            return
+
+        node, path_list = self.fs.str_to_path(path)
+        if self.fs.is_abs(path):
+            self.current_path = [self.fs.root]
+
+        for i in range(len(path_list)):
+            found = self.fs.search_dir(self.current_path[-1], path_list[i], Directory)
+            if found:
+                self.current_path.append(found)
+            else:
+                print(f"Directory {'/' * self.fs.is_abs(path) + '/'.join(path_list[:i+1])} does not exist.")
+
+    def ls(self):
+        output = ''
+        children = self.current_path[-1].children
+        if len(children) == 0:
+            output = "Empty"
+        else:
+            for child in children:
+                output += f"{child.name}\n"
+        return output
+
+    def print_current_path(self):
+        print("PS /", end='')
+        for dir in self.current_path[1:-1]:
+            print(dir.name, end='/')
+        if len(self.current_path) > 1:
+            print(f"{self.current_path[-1].name}", end='')
+        print("> ", end='')
+
+    # returns the new file descriptor, the lowest one not in use
+    # a name refers to one open file, the same name after a chdir is refused until the first file is closed
+    def open(self, name: str, mode: str) -> int:
+        path = self.path(name)
+        found = self.fs.search_path(path, File)
+        if found and any(handle.file is found for handle in self.handles.values()):
+            print(f"File {name} already opened.")
+            return
+        if name in self.names:
+            print(f"Another file opened as {name} is still open, close it first.")
+            return
+
+        file = self.fs.open(path, mode)
+        if not file:
+            return
+
+        fd = 0
+        while fd in self.handles:
+            fd += 1
+        self.handles[fd] = Handle(file, 'all' if len(mode) == 2 else mode[0])    # r+, a+ and w+ allow both
+        self.names[name] = fd
+        return fd
+
+    # name is the name the file was opened with or its file descriptor
+    def get(self, name) -> Handle:
+        fd = self.names.get(name) if type(name) == str else name
+        return self.handles.get(fd)
+
+    def close(self, name) -> bool:
+        fd = self.names.get(name) if type(name) == str else name
+        if fd not in self.handles:
+            print("File not open.")
+            return False
+        handle = self.handles.pop(fd)
+        handle.flush()
+        self.fs.close(handle.file)
+        self.names = {key: value for key, value in self.names.items() if value != fd}
+        return True
+
+    # closes every file the session still has open
+    def close_all(self):
+        for fd in list(self.handles):
+            self.close(fd)
@@ -1,4 +1,25 @@
 # 'disk' size constants
 BLOCK_SIZE = 32   # size of one block in 'disk memory'
 FREE_START = 100 * BLOCK_SIZE   # free space for file content starts at block 1, block 0 is for file metadata and directory structure
-TOTAL_MEMORY = 1024 * 10  # total 'disk memory'
\ No newline at end of file
+TOTAL_MEMORY = 1024 * 10  # total 'disk memory'
+
+# metadata journal, changes are logged here and replayed on top of the last checkpoint of the tree
+JOURNAL_SIZE = 32 * BLOCK_SIZE  # the journal takes the last part of the metadata area
+CHECKPOINT_INTERVAL = 64    # maximum number of journal records before the whole tree is saved again
+
+DCACHE_SIZE = 1024  # number of resolved paths kept in the path lookup cache
+DIRECTORY_CACHE = 4096  # directories kept in memory, colder ones are dropped at checkpoints and read from the disk again when used
+DISK_BACKEND = 'file'   # 'file' for positional reads and writes, 'mmap' to memory-map the disk file
+AUTO_GROW = True    # grow the disk instead of failing when it runs out of blocks
+DEFRAG_STEP = 256   # blocks moved by one step of the defragmenter, other threads run between steps
+DEDUP = False   # whole blocks written with the same content as a block written before share it, see dedup.py
+
+# block cache between files and the disk
+CACHE_BLOCKS = 256  # number of data blocks kept in memory, 0 reads and writes the disk directly
+CACHE_POLICY = 'close'  # when dirty blocks are written back: 'write-through', 'close', 'interval' or 'sync'
+FLUSH_INTERVAL = 500    # milliseconds between write-backs with the 'interval' policy
+CHUNK_BLOCKS = 256  # blocks in each chunk when iterating over an open file or copying files to and from the host
+TRANSFER_THREADS = 8    # threads reading or writing host files when trees are imported or exported, see transfer.py
+
+# file system server
+SOCKET_PATH = 'fs.sock'     # unix domain socket the server listens on
@@ -0,0 +1,20 @@
+from nodes import Directory
+from bitarray import bitarray
+
+# a snapshot keeps the whole tree as it was when it was taken, see FileSystem.snapshot()
+#
+# nothing is copied to take one: it gets the directory table of the image the tree was just checkpointed to, so all its
+# directory records are the tree's, and a bitmap of the blocks its files use. Only what changes afterwards costs anything:
+#   a directory that changes gets a new record at the next checkpoint and the snapshot keeps the old one, a record that
+#   is the same in several trees is stored once, see inodes.py
+#   the blocks of a snapshot are pinned, a file about to write to one gets a copy of its own first like with a shared
+#   block, see File.unshare(), and a pinned block the tree lets go of is held for the snapshots instead of being freed
+# rolling back makes a copy of the snapshot's directory table the tree, the blocks only the old tree used are freed
+# a snapshot is never changed, a disk mounted with one as its tree is read only
+class Snapshot:
+    def __init__(self, name: str, image, used: bitarray, shared: list):
+        self.name = name
+        self.image = image  # its own directory table into the same image as the tree's, empty until it is first saved
+        self.root = Directory('/', 0, image)    # read on first use like the tree's
+        self.used = used    # blocks its files use, by block index
+        self.shared = shared    # (start address, number of blocks, extra references) runs of the blocks several of its files use
@@ -0,0 +1,125 @@
+from FileSystem import FileSystem
+from nodes import File
+from fsck import fsck
+import main as runner
+import processes
+import tempfile
+import random
+import sys
+import os
+
+# runs random command scripts in the input_thread<x>.txt format on many threads against one shared disk,
+# then reloads the disk, checks it with fsck and compares every file with what its script wrote
+# usage: python stress.py <threads> [commands_per_thread] [seed] [--batch] [--processes]
+# with --processes the scripts run from worker processes instead of threads, see processes.py
+
+SHARED_DIRS = 4     # directories in /shared that every thread creates, deletes and moves things between
+
+# returns the commands of one thread and the content each of its own files should end with
+def make_script(thread_id: int, count: int, rng: random.Random):
+    home = f"/t{thread_id}"
+    commands = [f"mkdir {home}", f"chdir {home}"]   # files of this thread are named relative to its own directory
+    expected: dict[str, bytearray] = {}
+
+    for i in range(count):
+        r = rng.random()
+        path = f"f{rng.randint(0, 7)}"
+        if r < 0.4:     # write to a file of this thread, the content says where it came from
+            data = f"{thread_id}.{i}" * rng.randint(1, 6)
+            content = expected.setdefault(path, bytearray())
+            if rng.random() < 0.5 or not content:
+                commands += [f"open {path}, a", f"write_to_file {path}, {data}"]
+                content += data.encode()
+            else:   # sometimes past the end of the file, the gap reads as zeros
+                at = rng.randint(0, len(content) + 64)
+                commands += [f"open {path}, a", f"write_to_file {path}, {data}, {at}"]
+                content.extend(bytes(max(0, at - len(content))))
+                content[at:at + len(data)] = data.encode()
+            commands.append(f"close {path}")
+        elif r < 0.45 and path in expected:
+            size = rng.randint(0, len(expected[path]) + 64)
+            commands += [f"open {path}, a", f"truncate_file {path}, {size}", f"close {path}"]
+            del expected[path][size:]
+            expected[path].extend(bytes(size - len(expected[path])))
+        elif r < 0.5 and path in expected:
+            content = expected[path]
+            offset = rng.randint(0, len(content))
+            length = rng.randint(0, 96)
+            commands += [f"open {path}, a", f"punch_hole {path}, {offset}, {length}", f"close {path}"]
+            content[offset:offset + length] = bytes(len(content[offset:offset + length]))
+        elif r < 0.55 and path in expected:
+            commands.append(f"delete_file {path}")
+            del expected[path]
+        elif r < 0.6 and path in expected:    # the clone shares the blocks until either file is written to
+            other = f"f{rng.randint(0, 7)}"
+            if other not in expected:
+                commands.append(f"clone_file {path}, {other}")
+                expected[other] = bytearray(expected[path])
+        else:   # namespace changes that race with the other threads, their outcome is not checked
+            a = f"/shared/d{rng.randint(0, SHARED_DIRS - 1)}"
+            b = f"/shared/d{rng.randint(0, SHARED_DIRS - 1)}"
+            name = f"n{rng.randint(0, 3)}"
+            commands.append(rng.choice([
+                f"mkdir {a}",
+                f"mkdir {a}/{name}",
+                f"create {a}/{name}.txt",
+                f"delete_file {a}/{name}.txt",
+                f"delete_dir {a}/{name}",
+                f"delete_dir {a}",
+                f"move_file {a}/{name}.txt, {b}",
+                f"clone_file {a}/{name}.txt, {b}/{name}.txt",
+                f"move_dir {a}/{name}, {b}",
+                f"snapshot s{name}",    # the files written after it get copies of its blocks
+                f"delete_snapshot s{name}",
+                "ls",
+            ]))
+    return commands, {f"{home}/{path}": content for path, content in expected.items()}
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python stress.py <threads> [commands_per_thread] [seed] [--batch] [--processes]")
+        return
+
+    batch = '--batch' in sys.argv  # every script runs as one transaction
+    worker_processes = '--processes' in sys.argv
+    argv = [arg for arg in sys.argv if arg not in ('--batch', '--processes')]
+    num_threads = int(argv[1])
+    count = int(argv[2]) if len(argv) > 2 else 500
+    rng = random.Random(int(argv[3]) if len(argv) > 3 else 0)
+
+    work_dir = tempfile.mkdtemp()
+    runner.fs = FileSystem(os.path.join(work_dir, "sample.dat"))
+
+    expected = {}
+    for i in range(num_threads):
+        commands, files = make_script(i, count, rng)
+        expected.update(files)
+        with open(os.path.join(work_dir, f"input_thread{i}.txt"), 'w') as f:
+            f.write('\n'.join(commands) + '\n')
+
+    runner.fs.mkdir("/shared")
+    sys.setswitchinterval(1e-5)     # switch threads as often as possible to make races likely
+    if worker_processes:
+        processes.run_processes(runner.fs, num_threads, work_dir, batch)
+    else:
+        runner.run_threads(num_threads, work_dir, batch)
+    runner.fs.unmount()
+
+    fs = FileSystem(os.path.join(work_dir, "sample.dat"))
+    problems = fsck(fs)
+    for path, content in expected.items():
+        file = fs.search_path(path, File)
+        if file is None:
+            problems.append(f"{path} is missing.")
+            continue
+        if bytes(file.read_from_file()) != bytes(content):
+            problems.append(f"{path} does not have the content its script wrote.")
+    fs.unmount()
+
+    for problem in problems:
+        print(problem)
+    print(f"{num_threads} threads, {count} commands each, {len(problems)} problem(s) found in {work_dir}.")
+    sys.exit(1 if problems else 0)
+
+if __name__ == "__main__":
+    main()
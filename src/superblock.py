@@ -0,0 +1,55 @@
+from settings import BLOCK_SIZE, FREE_START, TOTAL_MEMORY, JOURNAL_SIZE
+import struct
+
+MAGIC = b'TFSB'
+VERSION = 4     # 1 pickled the tree right after the superblock, 2 into two checksummed slots, 3 stores it as an inode table,
+                # 4 as a record per directory
+SUPERBLOCK_SIZE = 64    # the superblock is at offset 0, metadata is stored after it
+FORMAT = struct.Struct('<4sIIIQQ')  # magic, version, block size, journal size, free start, total size
+
+# disk geometry, stored at the start of every disk so it no longer depends on settings.py
+class Superblock:
+    def __init__(self, block_size: int = BLOCK_SIZE, free_start: int = FREE_START, total: int = TOTAL_MEMORY,
+                 journal_size: int = JOURNAL_SIZE, version: int = VERSION):
+        self.version = version
+        self.block_size = block_size
+        self.free_start = free_start    # end of the metadata area, file content starts here
+        self.total = total
+        self.journal_size = journal_size
+
+    @property
+    def journal_start(self) -> int:
+        return self.free_start - self.journal_size
+
+    # number of blocks in the data area
+    @property
+    def blocks(self) -> int:
+        return (self.total - self.free_start) // self.block_size
+
+    def pack(self) -> bytes:
+        data = FORMAT.pack(MAGIC, self.version, self.block_size, self.journal_size, self.free_start, self.total)
+        return data + b'\x00' * (SUPERBLOCK_SIZE - len(data))
+
+    # returns None for disks written before the superblock existed
+    @staticmethod
+    def unpack(data: bytes):
+        if len(data) < FORMAT.size or data[:len(MAGIC)] != MAGIC:
+            return None
+        magic, version, block_size, journal_size, free_start, total = FORMAT.unpack_from(data)
+        if version > VERSION:
+            raise ValueError(f"Disk format version {version} is newer than supported version {VERSION}.")
+        return Superblock(block_size, free_start, total, journal_size, version)
+
+    @staticmethod
+    def read(file_name: str):
+        with open(file_name, 'rb') as f:
+            return Superblock.unpack(f.read(SUPERBLOCK_SIZE))
+
+    # checks that the areas fit together, used before formatting a disk
+    def validate(self):
+        if self.block_size <= 0 or self.free_start % self.block_size != 0:
+            raise ValueError("The metadata area must end on a block boundary.")
+        if self.journal_start <= SUPERBLOCK_SIZE:
+            raise ValueError("The journal leaves no space for the directory tree in the metadata area.")
+        if self.total < self.free_start + self.block_size:
+            raise ValueError("The disk has no space left for file content.")
@@ -0,0 +1,9 @@
+# changes made by one thread between FileSystem.begin() and commit() or abort()
+# the tree is changed as usual, but the journal records are only written on commit, as one record
+# so a crash never replays half of a transaction
+class Transaction:
+    def __init__(self):
+        self.records: list[tuple] = []  # journal records without their sequence numbers
+        self.undo: list = []    # functions that revert the changes in memory, run last to first on abort
+        self.freed: list[tuple[int, int]] = []  # runs freed by the transaction, given back to the allocator on commit
+        self.failed = False     # an operation raised, the transaction can only be aborted
@@ -0,0 +1,220 @@
+from settings import CHUNK_BLOCKS, TRANSFER_THREADS
+from FileSystem import FileSystem
+from nodes import Directory, File
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import sys
+import os
+
+# copies whole directory trees from the host into a disk and back
+# usage: python transfer.py import <file_name> <host_path> [path]
+#        python transfer.py export <file_name> <path> <host_path>
+# the tree at the source path becomes the tree at the destination path, existing files are overwritten
+#
+# an import runs as a single transaction, or as part of the one the caller has open, so its changes are logged with
+# one record at the end, or checkpointed if they do not fit, while a pool of threads reads the next host files ahead
+# of the ones being written
+# a small file is read whole and written with one call, the blocks of the small files copied next, up to CHUNK_BLOCKS
+# of them, come from one allocation, larger files are copied in parts of CHUNK_BLOCKS blocks, parts that are all zeros
+# become holes
+# an export writes files to the host from the pool, holes are skipped over so the host file is sparse too
+
+# path of the entry name in the directory at path
+def child(path: str, name: str) -> str:
+    return path.rstrip('/') + '/' + name
+
+# a name read from a disk must not lead outside the host directory it is exported to
+def safe(name: str) -> bool:
+    return name not in ('', '.', '..') and '/' not in name and os.sep not in name and '\0' not in name
+
+# (directory paths, (host path, path, size) of files) below host_path, parents before their children
+def host_tree(host_path: str, path: str, dirs: list, files: list):
+    with os.scandir(host_path) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            target = child(path, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(target)
+                host_tree(entry.path, target, dirs, files)
+            elif entry.is_file(follow_symlinks=False):
+                files.append((entry.path, target, entry.stat().st_size))
+
+# returns (files, bytes) copied from host_path to path, None if host_path does not exist or the disk is read only
+def import_tree(fs: FileSystem, host_path: str, path: str = '/', threads: int = TRANSFER_THREADS):
+    if not fs.writable():
+        return None
+    dirs, files = [], []
+    if os.path.isdir(host_path):
+        dirs.append(path)
+        host_tree(host_path, path, dirs, files)
+    elif os.path.isfile(host_path):
+        files.append((host_path, path, os.path.getsize(host_path)))
+    else:
+        print(f"{host_path} does not exist.")
+        return None
+
+    chunk = CHUNK_BLOCKS * fs.block_size
+
+    def read(entry) -> bytes:   # in the pool, None for a file that is copied in parts
+        host, target, size = entry
+        if size > chunk:
+            return None
+        with open(host, 'rb') as f:
+            return f.read()
+
+    copied = [0, 0]
+    own = fs.transaction() is None
+    if own and not fs.begin():
+        return None
+    try:
+        with ThreadPoolExecutor(threads) as pool:
+            for target in dirs:
+                if fs.search_path(target, Directory) is None:
+                    fs.mkdir(target)
+
+            # (entry, future of its content), the pool reads two groups and two files per thread ahead
+            ahead = deque()
+            blocks = 0  # of the small files in ahead
+            for entry in files:
+                ahead.append((entry, pool.submit(read, entry)))
+                blocks += small_blocks(entry, fs.block_size, chunk)
+                if len(ahead) >= 2 * threads and blocks >= 2 * CHUNK_BLOCKS or len(ahead) >= 2 * CHUNK_BLOCKS:
+                    blocks -= copy_group(fs, ahead, chunk, copied)
+            while ahead:
+                copy_group(fs, ahead, chunk, copied)
+    except Exception:
+        if own:
+            fs.abort()
+        raise
+    if own and not fs.commit():
+        return None
+    return tuple(copied)
+
+# blocks a host file takes if it is written with one call, 0 for a file copied in parts
+def small_blocks(entry, block_size: int, chunk: int) -> int:
+    host, target, size = entry
+    return -(-size // block_size) if size <= chunk else 0
+
+# copies the files at the front of ahead, as many as have small files of up to CHUNK_BLOCKS blocks
+# the blocks of the small files are allocated with one call, returns how many
+def copy_group(fs: FileSystem, ahead: deque, chunk: int, copied: list) -> int:
+    group = []
+    blocks = 0
+    while ahead and (not group or blocks + small_blocks(ahead[0][0], fs.block_size, chunk) <= CHUNK_BLOCKS):
+        group.append(ahead.popleft())
+        blocks += small_blocks(group[-1][0], fs.block_size, chunk)
+    if blocks and fs.dedup is None:     # with dedup a block may be shared with an earlier one instead of taking its own
+        fs.allocate_ahead(blocks)
+    try:
+        for entry, content in group:
+            copy_in(fs, entry, content, chunk, copied)
+    finally:
+        fs.release_ahead()
+    return blocks
+
+# writes one host file to its path in the disk, adds it to copied
+def copy_in(fs: FileSystem, entry, content, chunk: int, copied: list):
+    host, target, size = entry
+    try:
+        data = content.result()
+    except OSError as e:
+        print(f"Cannot read {host}: {e.strerror}")
+        return
+
+    file = fs.search_path(target, File)
+    if file is not None:
+        file.truncate_file(0)
+    else:
+        file = fs.create(target)
+        if file is None:
+            return
+
+    if data is not None:
+        file.write_to_file(data, 0)
+        position = len(data)
+    else:
+        position = 0
+        try:
+            with open(host, 'rb') as f:
+                while data := f.read(chunk):
+                    file.write_to_file(data, position)
+                    position += len(data)
+        except OSError as e:
+            print(f"Cannot read {host}: {e.strerror}")
+    copied[0] += 1
+    copied[1] += position
+
+# returns (files, bytes) copied from path to host_path, None if path does not exist
+def export_tree(fs: FileSystem, path: str, host_path: str, threads: int = TRANSFER_THREADS):
+    files = []
+    node = fs.search_path(path, Directory)
+    if node is not None:
+        os.makedirs(host_path, exist_ok=True)
+        disk_tree(node, host_path, files)
+    else:
+        node = fs.search_path(path, File)
+        if node is None:
+            print(f"{path} does not exist.")
+            return None
+        files.append((node, host_path))
+
+    chunk = CHUNK_BLOCKS * fs.block_size
+    with ThreadPoolExecutor(threads) as pool:
+        sizes = list(pool.map(lambda entry: copy_out(*entry, chunk), files))
+    return len(files), sum(sizes)
+
+# (file, host path) of every file below dir, its directories are created on the host on the way
+def disk_tree(dir: Directory, host_path: str, files: list):
+    for node in dir.children:
+        if not safe(node.name):
+            print(f"Skipping {node.name!r}, it is not a valid name on the host.")
+            continue
+        target = os.path.join(host_path, node.name)
+        if type(node) == Directory:
+            os.makedirs(target, exist_ok=True)
+            disk_tree(node, target, files)
+        else:
+            files.append((node, target))
+
+# writes one file to the host in parts of chunk bytes and returns its size
+def copy_out(file: File, host: str, chunk: int) -> int:
+    buffer = bytearray(chunk)
+    position = 0
+    with open(host, 'wb') as f:
+        while count := file.readinto(position, buffer):
+            if buffer.count(0, 0, count) == count:  # zeros, left as a hole if the host supports them
+                f.seek(count, os.SEEK_CUR)
+            else:
+                f.write(memoryview(buffer)[:count])
+            position += count
+        f.truncate(position)
+    return position
+
+def main():
+    if len(sys.argv) < 4 or sys.argv[1] not in ('import', 'export') or (sys.argv[1] == 'export' and len(sys.argv) < 5):
+        print("Usage: python transfer.py import <file_name> <host_path> [path]")
+        print("       python transfer.py export <file_name> <path> <host_path>")
+        return
+
+    command, file_name = sys.argv[1], sys.argv[2]
+    if command == 'export' and not os.path.exists(file_name):
+        print(f"Error: {file_name} does not exist.")
+        return
+    try:
+        fs = FileSystem(file_name)
+    except ValueError as e:
+        print(f"Error: {file_name}: {e}")
+        return
+
+    if command == 'import':
+        path = sys.argv[4] if len(sys.argv) > 4 else '/'
+        copied = import_tree(fs, sys.argv[3], path)
+        source, target = sys.argv[3], path
+    else:
+        copied = export_tree(fs, sys.argv[3], sys.argv[4])
+        source, target = sys.argv[3], sys.argv[4]
+    fs.unmount()
+    if copied is not None:
+        print(f"Copied {copied[0]} files of {copied[1]} bytes from {source} to {target}.")
+
+if __name__ == "__main__":
+    main()
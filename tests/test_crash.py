@@ -0,0 +1,51 @@
+# crashes a process in the middle of using a disk and checks what the next load finds
+import os
+import sys
+import subprocess
+
+SRC = os.path.join(os.path.dirname(__file__), '..', 'src')
+sys.path.insert(0, SRC)
+
+from FileSystem import FileSystem
+from nodes import File
+
+# runs code in a new process with fs open on the disk, the process ends without unmounting like a crash
+def crash_after(disk: str, code: str):
+    script = f"from FileSystem import FileSystem\nfrom nodes import File\nimport os\nfs = FileSystem({disk!r})\n{code}\nos._exit(0)\n"
+    subprocess.run([sys.executable, "-c", script], cwd=SRC, check=True)
+
+# blocks freed by a deleted file and given to a new one must not show the old content after the journal is replayed,
+# the new content reaches the disk before the record that points to it
+def test_reused_blocks_after_crash(tmp_path):
+    disk = str(tmp_path / "disk.dat")
+    secret = b'TOP SECRET PAYLOAD 1234567890'
+    fs = FileSystem(disk)
+    fs.create('/secret.txt').write_to_file(secret, 0)
+    fs.checkpoint()
+    fs.unmount()
+
+    crash_after(disk, "fs.delete_file('/secret.txt')\n"
+                      "fs.create('/public.txt').write_to_file(b'x' * 29, 0)")
+
+    fs = FileSystem(disk)
+    assert fs.search_path('/secret.txt', File) is None
+    assert bytes(fs.search_path('/public.txt', File).read_from_file()) == b'x' * 29
+    fs.unmount()
+
+# every change a process made before it crashed is found after the journal is replayed
+def test_changes_survive_crash(tmp_path):
+    disk = str(tmp_path / "disk.dat")
+    crash_after(disk, "fs.mkdir('/docs')\n"
+                      "for i in range(20):\n"
+                      "    fs.create(f'/docs/{i}.txt').write_to_file(str(i) * 100, 0)\n"
+                      "fs.search_path('/docs/3.txt', File).truncate_file(10)\n"
+                      "fs.delete_file('/docs/4.txt')")
+
+    fs = FileSystem(disk)
+    for i in range(20):
+        file = fs.search_path(f'/docs/{i}.txt', File)
+        if i == 4:
+            assert file is None
+        else:
+            assert bytes(file.read_from_file()) == (str(i) * 100).encode()[:10 if i == 3 else None]
+    fs.unmount()
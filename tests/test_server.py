@@ -0,0 +1,62 @@
+# client-side checks of server.py, the server runs as its own process on a fresh disk
+import os
+import sys
+import time
+import signal
+import subprocess
+
+SRC = os.path.join(os.path.dirname(__file__), '..', 'src')
+sys.path.insert(0, SRC)
+
+from client import Client
+
+def start_server(tmp_path) -> tuple[subprocess.Popen, str]:
+    socket_path = str(tmp_path / "fs.sock")
+    server = subprocess.Popen([sys.executable, "server.py", str(tmp_path / "disk.dat"), socket_path], cwd=SRC,
+                              stdout=subprocess.PIPE, text=True)
+    for _ in range(200):
+        if os.path.exists(socket_path):
+            return server, socket_path
+        time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("The server did not start.")
+
+def stop_server(server: subprocess.Popen) -> str:
+    server.send_signal(signal.SIGTERM)
+    return server.communicate(timeout=30)[0]
+
+# a refused operation reports why to the client that sent it, not on the server's console
+def test_refused_read_and_write(tmp_path):
+    server, socket_path = start_server(tmp_path)
+    try:
+        with Client(socket_path) as client:
+            assert client.execute("open /a.txt, w") == "File /a.txt opened in w mode.\n"
+            assert client.execute("write_to_file /a.txt, hello") == "Data written to file /a.txt.\n"
+            assert client.execute("read_from_file /a.txt") == "Attempt to read in wrong mode.\n"
+            client.execute("close /a.txt")
+
+            client.execute("open /a.txt, r")
+            assert client.execute("write_to_file /a.txt, bye").startswith("Attempt to write in read mode.\n")
+            assert client.execute("read_from_file /a.txt") == "hello\nData read from file /a.txt.\n"
+            client.execute("close /a.txt")
+            assert client.execute("write_to_file /a.txt, bye") == "/a.txt is not opened. Cannot write.\n"
+    finally:
+        console = stop_server(server)
+    assert "Attempt to" not in console
+
+# what one connection's command prints does not end up in the response of another
+def test_messages_stay_with_their_connection(tmp_path):
+    server, socket_path = start_server(tmp_path)
+    try:
+        with Client(socket_path) as first, Client(socket_path) as second:
+            first.execute("open /a.txt, w")
+            second.execute("create /b.txt")
+            second.execute("open /b.txt, r")
+            for _ in range(50):
+                first.send("read_from_file /a.txt")
+                second.send("write_to_file /b.txt, x")
+            for _ in range(50):
+                assert first.receive()[1] == "Attempt to read in wrong mode.\n"
+                assert second.receive()[1].startswith("Attempt to write in read mode.\n")
+    finally:
+        stop_server(server)